@@ -0,0 +1,96 @@
+"""Build ACK frames from byte templates instead of hl7 message objects.
+
+hl7.Message.create_ack parses the received MSH, builds a new message tree and
+serializes it, on every message's critical path. The ACK differs from one message
+to the next only in its timestamp, its own control ID and the control ID it
+acknowledges; everything else follows from the sender/receiver fields, trigger,
+processing ID and version, which repeat for every message of an interface. Those
+parts are kept as precomputed byte templates, and an ACK is a join of the template
+with the few per-message fields, already framed for MLLP.
+
+The output matches create_ack field for field (MSH-3..6 swapped, ACK^<trigger>^ACK,
+MSH-11/12 and MSA-2 copied from the received MSH), in the received bytes' encoding.
+"""
+import datetime
+import itertools
+import os
+import time
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+from hl7.mllp.streams import (
+    CARRIAGE_RETURN,
+    END_BLOCK,
+    START_BLOCK,
+)
+
+# Bound on the number of distinct sender/receiver combinations with a template.
+_TEMPLATE_CACHE_SIZE = 1024
+_FRAME_END = END_BLOCK + CARRIAGE_RETURN
+_ACK_CODES = {code: code.encode() for code in ("AA", "AE", "AR")}
+
+# (before MSH-7, between MSH-7 and MSH-10, between MSH-10 and MSA-1, after MSA-1)
+Template = Tuple[bytes, bytes, bytes, bytes]
+
+_templates: Dict[Tuple[bytes, ...], Template] = {}
+_clock = {"second": None, "timestamp": b"", "id_prefix": b""}
+_sequence = itertools.count()
+# Distinguishes the control IDs of processes sharing a port.
+_ID_SUFFIX = b"%04d" % (os.getpid() % 10000)
+
+
+def _template(fields: List[bytes], separator: bytes) -> Template:
+    encoding_characters = fields[1]
+    component = encoding_characters[0:1]
+    repetition = encoding_characters[1:2]
+    trigger = b""
+    message_type = fields[8].split(repetition)[0] if repetition else fields[8]
+    components = message_type.split(component) if component else [message_type]
+    if len(components) > 1:
+        trigger = components[1]
+    return (
+        separator.join([
+            START_BLOCK + b"MSH", encoding_characters, fields[4], fields[5], fields[2], fields[3], b""
+        ]),
+        separator.join([b"", b"", component.join([b"ACK", trigger, b"ACK"]), b""]),
+        separator.join([b"", fields[10], fields[11]]) + b"\rMSA" + separator,
+        separator,
+    )
+
+
+def _now() -> Tuple[bytes, bytes]:
+    """MSH-7 timestamp and the control ID prefix, formatted once per second."""
+    second = int(time.time())
+    if second != _clock["second"]:
+        now = datetime.datetime.fromtimestamp(second, datetime.timezone.utc)
+        _clock["second"] = second
+        _clock["timestamp"] = now.strftime("%Y%m%d%H%M%S").encode()
+        # Same layout as hl7's 20 character control IDs: a timestamp without the
+        # decade, then a counter and the process instead of random characters.
+        _clock["id_prefix"] = now.strftime("%y%j%H%M%S")[1:].encode()
+    return _clock["timestamp"], _clock["id_prefix"]
+
+
+def ack_frame(msh_segment: bytes, ack_code: str = "AA") -> bytes:
+    """Return the MLLP-framed ACK for a message with the given MSH segment."""
+    separator = msh_segment[3:4]
+    fields = msh_segment.split(separator)
+    if len(fields) < 12:
+        fields += [b""] * (12 - len(fields))
+    key = (separator, *fields[1:6], fields[8], fields[10], fields[11])
+    template = _templates.get(key)
+    if template is None:
+        template = _template(fields, separator)
+        if len(_templates) < _TEMPLATE_CACHE_SIZE:
+            _templates[key] = template
+    timestamp, id_prefix = _now()
+    head, type_part, version_part, msa_part = template
+    return b"".join((
+        head, timestamp, type_part,
+        id_prefix, b"%06d" % (next(_sequence) % 1000000), _ID_SUFFIX,
+        version_part, _ACK_CODES.get(ack_code) or ack_code.encode(),
+        msa_part, fields[9], _FRAME_END,
+    ))
@@ -0,0 +1,103 @@
+"""Global admission control across all MLLP connections.
+
+When the broker slows down, publishes stay outstanding and every connection keeps
+reading and holding more messages. The AdmissionController counts the messages
+and bytes being published across all connections. Once either crosses its high
+water mark, connections stop reading their next frame, so the unread data backs up
+in the socket buffers and TCP flow control pushes back on the senders. Reading
+resumes when both are back under their low water marks. The number of open
+connections is capped as well.
+
+A listener (feed) with its own limits has its own controller, so that a noisy feed
+is paused before it takes up the global limits.
+"""
+import asyncio
+import math
+from typing import Optional
+
+from covera.loglib import configure_get_logger
+
+from hl7_listener import metrics
+
+logger = configure_get_logger()
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        max_messages: float = math.inf,
+        max_bytes: float = math.inf,
+        max_connections: float = math.inf,
+        low_water_ratio: float = 0.5,
+        feed: Optional[str] = None,
+    ):
+        self.feed = feed
+        if feed is None:
+            self._admitted_bytes = metrics.ADMITTED_BYTES
+            self._paused = metrics.ADMISSION_PAUSED
+            self._refused = metrics.CONNECTIONS_REFUSED
+        else:
+            self._admitted_bytes, self._paused, self._refused = metrics.feed_admission_metrics(feed)
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.low_messages = max_messages * low_water_ratio
+        self.low_bytes = max_bytes * low_water_ratio
+        self.max_connections = max_connections
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self._reading = asyncio.Event()
+        self._reading.set()
+
+    @property
+    def paused(self) -> bool:
+        return not self._reading.is_set()
+
+    def connect(self) -> bool:
+        """Count a new connection; False if it exceeds the cap and must be closed."""
+        if self.connections >= self.max_connections:
+            self._refused.inc()
+            return False
+        self.connections += 1
+        return True
+
+    def disconnect(self) -> None:
+        self.connections -= 1
+
+    async def wait_for_capacity(self) -> None:
+        """Return once connections may read their next message."""
+        await self._reading.wait()
+
+    def admit(self, size: int) -> None:
+        """Count a message that is being published."""
+        self.messages += 1
+        self.bytes += size
+        self._admitted_bytes.set(self.bytes)
+        if not self.paused and (self.messages >= self.max_messages or self.bytes >= self.max_bytes):
+            self._reading.clear()
+            self._paused.set(1)
+            logger.warning(
+                "In-flight limit reached, pausing reads from all connections"
+                if self.feed is None
+                else "In-flight limit of a listener reached, pausing reads from its connections",
+                logging_code="HL7LLOG021",
+                feed=self.feed,
+                in_flight_messages=self.messages,
+                in_flight_bytes=self.bytes
+            )
+
+    def release(self, size: int) -> None:
+        """Count a message whose publish finished, successfully or not."""
+        self.messages -= 1
+        self.bytes -= size
+        self._admitted_bytes.set(self.bytes)
+        if self.paused and self.messages <= self.low_messages and self.bytes <= self.low_bytes:
+            self._reading.set()
+            self._paused.set(0)
+            logger.info(
+                "In-flight messages below the low water mark, resuming reads",
+                logging_code="HL7LLOG022",
+                feed=self.feed,
+                in_flight_messages=self.messages,
+                in_flight_bytes=self.bytes
+            )
@@ -0,0 +1,133 @@
+"""Record received MLLP traffic for replaying it offline.
+
+Production performance problems depend on the real mix of message types, sizes
+and arrival patterns, which synthetic load does not reproduce. With capture
+enabled, every received frame is appended to a capture file together with its
+arrival time and the sender's peer host; the benchmark package's replay tool
+sends a capture back to a listener at recorded or accelerated speed.
+
+The file starts with MAGIC, followed by one record per frame: a header (arrival
+time as UNIX seconds, stored length, peer length, flags), the peer host and the
+stored message. A record is written whole and never rewritten, so a capture cut
+short by a crash is read up to its last complete record. Messages can be
+compressed (zlib) and passed through an encryption hook, a "module:function"
+mapping bytes to bytes, since they carry PHI; replaying needs the matching
+decryption hook. Captures are written from the event loop into a buffered file
+without fsync, and stop at max_bytes.
+"""
+import importlib
+import struct
+import time
+import zlib
+from typing import (
+    BinaryIO,
+    Callable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Union,
+)
+
+from covera.loglib import configure_get_logger
+
+logger = configure_get_logger()
+
+MAGIC = b"HL7CAP\x00\x01"
+# Record header: arrival time, stored message length, peer length, flags.
+_RECORD_HEADER = struct.Struct("<dIHB")
+_FLAG_COMPRESSED = 0x01
+_FLAG_ENCRYPTED = 0x02
+# Fast over small: capturing must not slow down the listener being observed.
+_COMPRESSION_LEVEL = 1
+_BUFFER_BYTES = 1048576
+
+Hook = Callable[[bytes], bytes]
+
+
+class CapturedFrame(NamedTuple):
+    # UNIX time the frame was received.
+    timestamp: float
+    peer: str
+    # The HL7 message, without the MLLP start and end blocks.
+    message: bytes
+
+
+def load_hook(path: Optional[str]) -> Optional[Hook]:
+    """Import a "module:function" hook; None if path is unset."""
+    if not path:
+        return None
+    module, _, function = path.partition(":")
+    return getattr(importlib.import_module(module), function)
+
+
+class CaptureWriter:
+    def __init__(
+        self,
+        path: str,
+        compress: bool = False,
+        encrypt: Optional[Hook] = None,
+        max_bytes: float = float("inf"),
+    ):
+        self.path = path
+        self.compress = compress
+        self.encrypt = encrypt
+        self.max_bytes = max_bytes
+        self._file: BinaryIO = open(path, "ab", buffering=_BUFFER_BYTES)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        self.written = self._file.tell()
+        self.full = False
+
+    def record(self, frame: Union[bytes, memoryview], peer: str) -> None:
+        """Append a received message, unless the capture reached max_bytes."""
+        if self.full:
+            return
+        flags = 0
+        message = frame
+        if self.compress:
+            message = zlib.compress(message, _COMPRESSION_LEVEL)
+            flags |= _FLAG_COMPRESSED
+        if self.encrypt is not None:
+            message = self.encrypt(bytes(message))
+            flags |= _FLAG_ENCRYPTED
+        peer_bytes = peer.encode()
+        size = _RECORD_HEADER.size + len(peer_bytes) + len(message)
+        if self.written + size > self.max_bytes:
+            self.full = True
+            logger.warning(
+                "Capture file reached its maximum size, no longer capturing",
+                logging_code="HL7LLOG027",
+                path=self.path,
+                written_bytes=self.written
+            )
+            return
+        self._file.write(_RECORD_HEADER.pack(time.time(), len(message), len(peer_bytes), flags))
+        self._file.write(peer_bytes)
+        self._file.write(message)
+        self.written += size
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_capture(path: str, decrypt: Optional[Hook] = None) -> Iterator[CapturedFrame]:
+    """The frames of a capture file, in arrival order; stops at a truncated record."""
+    with open(path, "rb") as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not an HL7 capture file")
+        while True:
+            header = capture.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return
+            timestamp, length, peer_length, flags = _RECORD_HEADER.unpack(header)
+            peer = capture.read(peer_length)
+            message = capture.read(length)
+            if len(peer) < peer_length or len(message) < length:
+                return
+            if flags & _FLAG_ENCRYPTED:
+                if decrypt is None:
+                    raise ValueError(f"{path} is encrypted; a decryption hook is required")
+                message = decrypt(message)
+            if flags & _FLAG_COMPRESSED:
+                message = zlib.decompress(message)
+            yield CapturedFrame(timestamp, peer.decode(), message)
@@ -0,0 +1,94 @@
+"""Recognize messages an HL7 sender retransmitted after a slow ACK.
+
+Senders retransmit a message when its ACK does not arrive in time, which happens
+exactly when the listener or the broker is slow; publishing the retransmissions
+again adds to the load that caused them. DuplicateCache remembers the messages
+being published and the ones published in the last ttl_s seconds. A message with
+the same sending facility (MSH-4), control ID (MSH-10) and bytes is not published
+again: it is ACKed like its original, once the original's publish finished.
+
+Published messages are kept least recently seen first, which is the eviction
+order; each entry is the two MSH fields, a 16 byte digest of the frame and an
+expiry time.
+"""
+import asyncio
+import hashlib
+import time
+from collections import OrderedDict
+from typing import (
+    Dict,
+    Optional,
+    Tuple,
+    Union,
+)
+
+from hl7_listener import metrics
+from hl7_listener.header import MSHHeader
+
+# (MSH-4 sending facility, MSH-10 control ID, digest of the frame)
+Key = Tuple[str, str, bytes]
+
+
+class DuplicateCache:
+    def __init__(self, max_entries: int, ttl_s: float):
+        self.max_entries = max_entries
+        self.ttl = ttl_s
+        self._expiries: "OrderedDict[Key, float]" = OrderedDict()
+        # Messages being published; each future is set to whether the publish succeeded.
+        self._in_flight: Dict[Key, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._expiries)
+
+    @staticmethod
+    def key(header: MSHHeader, frame: Union[bytes, memoryview]) -> Key:
+        return (
+            header.sending_facility,
+            header.control_id,
+            hashlib.blake2b(frame, digest_size=16).digest(),
+        )
+
+    def original(self, key: Key) -> Optional[asyncio.Future]:
+        """Look up a message; counts a hit or a miss.
+
+        For a retransmission, return a future of whether its original was published:
+        done if that was within the TTL, pending while the original is still being
+        published. Otherwise the message is tracked as being published until
+        finished() is called, and None is returned.
+        """
+        in_flight = self._in_flight.get(key)
+        if in_flight is not None:
+            metrics.DUPLICATE_LOOKUPS["hit"].inc()
+            return in_flight
+        future = asyncio.get_running_loop().create_future()
+        expiry = self._expiries.get(key)
+        if expiry is not None and expiry > time.monotonic():
+            # Its expiry is not extended; a sender retransmitting for longer than the
+            # TTL gets its message published again.
+            self._expiries.move_to_end(key)
+            metrics.DUPLICATE_LOOKUPS["hit"].inc()
+            future.set_result(True)
+            return future
+        metrics.DUPLICATE_LOOKUPS["miss"].inc()
+        self._in_flight[key] = future
+        return None
+
+    def finished(self, key: Key, published: bool) -> None:
+        """End the publish of a message original() returned None for; only a published
+        message is remembered."""
+        self._in_flight.pop(key).set_result(published)
+        if published:
+            self._add(key)
+
+    def _add(self, key: Key) -> None:
+        now = time.monotonic()
+        expiries = self._expiries
+        expiries[key] = now + self.ttl
+        expiries.move_to_end(key)
+        while len(expiries) > self.max_entries:
+            expiries.popitem(last=False)
+        # Entries are mostly in expiry order; an expired one further back is dropped
+        # once it reaches the front.
+        while expiries and next(iter(expiries.values())) <= now:
+            expiries.popitem(last=False)
+        metrics.DUPLICATE_CACHE_ENTRIES.set(len(expiries))
@@ -0,0 +1,118 @@
+"""The MLLP listeners (feeds) served by one process.
+
+The main listener is configured by HL7_MLLP_HOST, HL7_MLLP_PORT and
+HL7_MLLP_ENCODING; HL7_LISTENERS adds more, each with its own port, charset,
+destination and limits. All feeds share the process's messager connection, health
+check and metrics. Each feed counts its own connections and in-flight messages
+next to the global admission controller, so one noisy feed is paused at its own
+limits instead of using up the global ones.
+"""
+from typing import (
+    List,
+    Optional,
+)
+
+from hl7_listener import metrics
+from hl7_listener.admission import AdmissionController
+from hl7_listener.settings import (
+    ListenerConfig,
+    Settings,
+)
+
+# Name of the feed of HL7_MLLP_PORT.
+DEFAULT_FEED = "default"
+
+
+class Feed:
+    def __init__(self, config: ListenerConfig, settings: Settings, shared: AdmissionController):
+        self.config = config
+        self.name = config.name
+        self.settings = settings
+        self.shared = shared
+        self.admission = AdmissionController(
+            max_messages=_limit(config.max_inflight_messages),
+            max_bytes=_limit(config.max_inflight_bytes),
+            max_connections=_limit(config.max_connections),
+            low_water_ratio=settings.ADMISSION_LOW_WATER_RATIO,
+            feed=config.name,
+        )
+        labels = {"feed": config.name}
+        self.messages_received = metrics.REGISTRY.counter(
+            "hl7_listener_feed_messages_received_total", "HL7 messages received, per listener.", labels
+        )
+        self.bytes_received = metrics.REGISTRY.counter(
+            "hl7_listener_feed_bytes_received_total", "Bytes of HL7 messages received, per listener.", labels
+        )
+
+    @property
+    def host(self) -> str:
+        return self.config.host or self.settings.HL7_MLLP_HOST
+
+    @property
+    def port(self) -> int:
+        return self.config.port
+
+    @property
+    def encoding(self) -> str:
+        return self.config.encoding or self.settings.HL7_MLLP_ENCODING
+
+    @property
+    def destination(self) -> Optional[str]:
+        return self.config.destination
+
+    @property
+    def raw_bytes(self) -> bool:
+        """Whether messages are forwarded as received, labelled with the feed's charset."""
+        return self.settings.HL7_RAW_BYTES
+
+    def connect(self) -> bool:
+        """Count a new connection, globally and for the feed; False if it must be closed."""
+        if not self.shared.connect():
+            return False
+        if not self.admission.connect():
+            self.shared.disconnect()
+            return False
+        return True
+
+    def disconnect(self) -> None:
+        self.shared.disconnect()
+        self.admission.disconnect()
+
+    async def wait_for_capacity(self) -> None:
+        await self.shared.wait_for_capacity()
+        await self.admission.wait_for_capacity()
+
+    def admit(self, size: int) -> None:
+        self.shared.admit(size)
+        self.admission.admit(size)
+
+    def release(self, size: int) -> None:
+        self.shared.release(size)
+        self.admission.release(size)
+
+
+class DefaultFeed(Feed):
+    """The feed of HL7_MLLP_PORT; it follows the settings as they are."""
+
+    def __init__(self, settings: Settings, shared: AdmissionController):
+        super().__init__(ListenerConfig(name=DEFAULT_FEED, port=0), settings, shared)
+
+    @property
+    def port(self) -> int:
+        return int(self.settings.HL7_MLLP_PORT)
+
+
+def _limit(value: Optional[int]) -> float:
+    return float("inf") if value is None else value
+
+
+def build_feeds(settings: Settings, shared: AdmissionController) -> List[Feed]:
+    """The main listener's feed, then one per HL7_LISTENERS entry."""
+    names = {DEFAULT_FEED}
+    feeds = [DefaultFeed(settings, shared)]
+    for config in settings.HL7_LISTENERS:
+        if config.name in names:
+            raise ValueError(f"Duplicate HL7_LISTENERS name: {config.name}")
+        names.add(config.name)
+        feeds.append(Feed(config, settings, shared))
+    return feeds
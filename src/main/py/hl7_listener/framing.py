@@ -0,0 +1,130 @@
+import asyncio
+import math
+import tempfile
+from typing import (
+    BinaryIO,
+    Optional,
+    Union,
+)
+
+from hl7.mllp.exceptions import InvalidBlockError
+from hl7.mllp.streams import (
+    CARRIAGE_RETURN,
+    END_BLOCK,
+    START_BLOCK,
+)
+
+
+FRAME_END = END_BLOCK + CARRIAGE_RETURN
+# asyncio's default StreamReader limit. A reader stops reading from its socket once
+# it buffers twice its limit, so this bounds what an idle connection holds.
+READER_LIMIT = 65536
+
+
+class FrameTooLarge(Exception):
+    """A frame over the size cap was read and discarded.
+
+    head is the start of the message, for answering it with a reject ACK.
+    """
+
+    def __init__(self, head: bytes, size: int):
+        super().__init__(f"HL7 message of {size} bytes exceeds the maximum frame size")
+        self.head = head
+        self.size = size
+
+
+class LargeFrame:
+    """A message larger than the spill threshold, spilled to a temporary file as it
+    was received instead of being held in memory.
+
+    head holds the first bytes of the message (at least the MSH segment of any
+    well-formed message); len() is the size of the whole message.
+    """
+
+    def __init__(self, head: bytes, file: BinaryIO, size: int):
+        self.head = head
+        self.file = file
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+    def close(self) -> None:
+        self.file.close()
+
+
+async def read_frame(
+    hl7_reader, max_bytes: float = math.inf, spill_bytes: float = math.inf
+) -> Union[memoryview, LargeFrame]:
+    """Read one MLLP frame and return the HL7 message it carries.
+
+    Unlike HL7StreamReader.readblock, the start and end block characters are dropped
+    with a memoryview slice instead of copying the message again.
+
+    The reader's buffer (its limit) is kept small, so that a connection that is not
+    being read from stops reading from its socket early. A frame that does not fit
+    it is read in chunks of at most that size and collected here; once the message
+    exceeds spill_bytes, the chunks are written to a LargeFrame's file instead. Once
+    it exceeds max_bytes, they are discarded and FrameTooLarge is raised after the
+    end of the frame was read, so the connection stays in sync.
+    """
+    try:
+        block = await hl7_reader.readuntil(FRAME_END)
+    except asyncio.LimitOverrunError as exp:
+        return await _read_large_frame(hl7_reader, exp.consumed, max_bytes, spill_bytes)
+    if block[0:1] != START_BLOCK:
+        raise InvalidBlockError("Block does not begin with Start Block character <VT>")
+    frame = memoryview(block)[1:-len(FRAME_END)]
+    if len(frame) > max_bytes:
+        raise FrameTooLarge(bytes(frame), len(frame))
+    return frame
+
+
+async def _read_large_frame(
+    hl7_reader, available: int, max_bytes: float, spill_bytes: float
+) -> Union[memoryview, LargeFrame]:
+    first = await hl7_reader.readexactly(available)
+    if first[0:1] != START_BLOCK:
+        raise InvalidBlockError("Block does not begin with Start Block character <VT>")
+    head = first[1:]
+    size = len(head)
+    # The message so far, until it is spilled to file or found to be too large.
+    message: Optional[bytearray] = bytearray(head) if size <= max_bytes else None
+    file: Optional[BinaryIO] = None
+    try:
+        while True:
+            try:
+                chunk = (await hl7_reader.readuntil(FRAME_END))[:-len(FRAME_END)]
+                last = True
+            except asyncio.LimitOverrunError as exp:
+                chunk = await hl7_reader.readexactly(exp.consumed)
+                last = False
+            size += len(chunk)
+            if size > max_bytes:
+                message = None
+                if file is not None:
+                    file.close()
+                    file = None
+            elif file is not None:
+                # Chunks are at most the reader's limit; writing them to the page
+                # cache takes far less time than receiving them.
+                file.write(chunk)
+            elif message is not None:
+                message += chunk
+                if size > spill_bytes:
+                    file = tempfile.TemporaryFile()
+                    file.write(message)
+                    message = None
+            if last:
+                break
+    except BaseException:
+        if file is not None:
+            file.close()
+        raise
+
+    if file is not None:
+        file.seek(0)
+        return LargeFrame(head, file, size)
+    if message is None:
+        raise FrameTooLarge(head, size)
+    return memoryview(message)
@@ -0,0 +1,98 @@
+"""Read the MSH header of a received HL7 message without parsing the whole message.
+
+The listener only needs a handful of MSH fields per message (type, trigger, control ID,
+sender) for logging, acknowledging and publishing. hl7.parse builds the full segment,
+field and component tree, which for large ORU messages with embedded documents costs
+far more than everything else done with the message. scan_msh reads only the MSH
+segment from the received bytes.
+"""
+import re
+from typing import (
+    NamedTuple,
+    Union,
+)
+
+from hl7.exceptions import ParseException
+
+
+# Segments are terminated by <CR>; some senders use <LF> or <CR><LF>.
+_SEGMENT_END = re.compile(rb"[\r\n]")
+# Whitespace (including blank segments) some senders put before the MSH segment.
+_LEADING_WHITESPACE = re.compile(rb"\s*")
+# Initial number of bytes looked at for the end of the MSH segment.
+_MSH_PROBE_SIZE = 1024
+
+
+class MSHHeader(NamedTuple):
+    field_separator: str
+    encoding_characters: str
+    sending_application: str
+    sending_facility: str
+    receiving_application: str
+    receiving_facility: str
+    message_type: str
+    trigger_event: str
+    control_id: str
+    processing_id: str
+    version_id: str
+    # The MSH segment as received, without the segment terminator.
+    segment: bytes
+
+    @property
+    def type(self) -> str:
+        return f"{self.message_type}^{self.trigger_event}"
+
+
+def msh_segment(data: Union[bytes, bytearray, memoryview]) -> bytes:
+    """Return the first segment of data after any leading whitespace, copying only
+    the bytes up to the end of that segment."""
+    view = memoryview(data)
+    probe_size = _MSH_PROBE_SIZE
+    while True:
+        head = bytes(view[:probe_size])
+        start = _LEADING_WHITESPACE.match(head).end()
+        end = _SEGMENT_END.search(head, start)
+        if end:
+            return head[start:end.start()]
+        if probe_size >= len(view):
+            return head[start:]
+        probe_size *= 4
+
+
+def scan_msh(data: Union[bytes, bytearray, memoryview], encoding: str = "utf-8") -> MSHHeader:
+    """Extract the MSH fields of a received message.
+
+    The field separator (MSH-1) and the component separator (first character of
+    MSH-2) declared by the message are honoured. Raises ParseException if data does
+    not start with an MSH segment.
+    """
+    segment = msh_segment(data)
+    if segment[:3] != b"MSH" or len(segment) < 8:
+        raise ParseException("First segment is not MSH")
+
+    text = segment.decode(encoding, "replace")
+    field_separator = text[3]
+    fields = text.split(field_separator)
+    encoding_characters = fields[1]
+    if not encoding_characters:
+        raise ParseException("MSH-2 encoding characters are missing")
+    component_separator = encoding_characters[0]
+
+    # fields[0] is "MSH" and MSH-1 is the separator itself, so MSH-n is fields[n - 1].
+    fields += [""] * (12 - len(fields))
+    message_type = fields[8].split(component_separator)
+    message_type += [""] * (2 - len(message_type))
+    return MSHHeader(
+        field_separator=field_separator,
+        encoding_characters=encoding_characters,
+        sending_application=fields[2],
+        sending_facility=fields[3],
+        receiving_application=fields[4],
+        receiving_facility=fields[5],
+        message_type=message_type[0],
+        trigger_event=message_type[1],
+        control_id=fields[9],
+        processing_id=fields[10].split(component_separator)[0],
+        version_id=fields[11].split(component_separator)[0],
+        segment=segment,
+    )
@@ -1,13 +1,48 @@
+from typing import Callable
+
 from aiohttp import web
 
+from hl7_listener.metrics import REGISTRY
+
 
 async def health_check_handler(request):
     return web.Response(text="Success! Hl7 listener is running.")
 
 
-async def start_health_check_server():
+def readiness_handler(is_ready: Callable[[], bool]):
+    async def handler(request):
+        if is_ready():
+            return web.Response(text="Ready")
+        return web.Response(status=503, text="Not ready")
+    return handler
+
+
+def metrics_handler(render_metrics: Callable[[], str]):
+    async def handler(request):
+        return web.Response(
+            body=render_metrics().encode(),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+    return handler
+
+
+async def start_health_check_server(
+    render_metrics: Callable[[], str] = REGISTRY.render,
+    is_ready: Callable[[], bool] = lambda: True,
+):
+    """Serve /ping, /ready and /metrics; a supervisor passes the render of all workers'
+    metrics.
+
+    /ready answers 503 until the listener accepts connections and again once it is
+    shutting down, so a load balancer only routes senders to a listener that is
+    serving.
+    """
     app = web.Application()
-    app.add_routes([web.get('/ping', health_check_handler)])
+    app.add_routes([
+        web.get('/ping', health_check_handler),
+        web.get('/ready', readiness_handler(is_ready)),
+        web.get('/metrics', metrics_handler(render_metrics)),
+    ])
     runner = web.AppRunner(app)
     await runner.setup()
     site = web.TCPSite(runner)
@@ -0,0 +1,54 @@
+"""Track the open MLLP connections so that a shutdown can drain them.
+
+Senders keep their connection open for as long as the listener runs, so a
+shutdown cannot wait for connections to end by themselves. When draining, a
+connection that is waiting for its next message is closed right away. One that is
+in the middle of a message is closed once that message was ACKed, or when the
+drain deadline passes, whichever comes first. A sender that gets no ACK for a
+message retransmits it once it reconnects to another instance.
+"""
+import asyncio
+from typing import Dict
+
+
+class Connections:
+    def __init__(self):
+        # The connection handler tasks, and whether each is waiting for a message.
+        self._idle: Dict[asyncio.Task, bool] = {}
+        self.draining = False
+
+    def __len__(self) -> int:
+        return len(self._idle)
+
+    def opened(self) -> None:
+        """Register the calling connection handler."""
+        self._idle[asyncio.current_task()] = True
+
+    def closed(self) -> None:
+        self._idle.pop(asyncio.current_task(), None)
+
+    def ready_for_message(self) -> bool:
+        """Mark the calling connection as waiting for its next message.
+
+        Returns False once the listener is draining; the connection should then close.
+        """
+        self._idle[asyncio.current_task()] = True
+        return not self.draining
+
+    def busy(self) -> None:
+        """Mark the calling connection as handling a message it has not ACKed yet."""
+        self._idle[asyncio.current_task()] = False
+
+    async def drain(self, timeout_s: float) -> None:
+        """Close every connection, letting the ones handling a message finish it first."""
+        self.draining = True
+        for task, idle in self._idle.items():
+            if idle:
+                task.cancel()
+        tasks = list(self._idle)
+        if not tasks:
+            return
+        _, pending = await asyncio.wait(tasks, timeout=timeout_s)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,201 @@
+"""Sampled, rate-limited and queue-backed structured logging.
+
+The per-message info logs (HL7LLOG003, 007, 008, ...) are formatted as JSON and
+written synchronously on the event loop, which shows at high message rates. This
+module reconfigures covera.loglib's structlog pipeline:
+
+- LogSampler drops a share of the events of a logging code (LOG_SAMPLING) or
+  caps them per second (LOG_RATE_LIMITS). Warnings and errors always pass.
+- With LOG_ASYNC_ENABLED, the event loop only queues the event dict; the qcc
+  processors (JSON rendering) and the write run on a background thread.
+- With LOG_SUMMARY_INTERVAL_S, a summary line with the message and ACK counts and
+  the number of suppressed events is logged periodically, so per-message info logs
+  can be sampled down to almost nothing.
+"""
+import asyncio
+import queue
+import sys
+import threading
+import time
+from collections import Counter as CountBy
+from typing import (
+    Dict,
+    Optional,
+    TextIO,
+)
+
+import structlog
+from covera import loglib
+from covera.loglib import configure_get_logger
+
+from hl7_listener import metrics
+
+logger = configure_get_logger()
+
+# Levels that are never sampled or rate limited.
+_ALWAYS_LOGGED = {"warning", "warn", "error", "exception", "critical", "fatal"}
+
+
+class LogSampler:
+    """structlog processor sampling and rate limiting events by logging_code."""
+
+    def __init__(self, sampling: Dict[str, float], rate_limits: Dict[str, int]):
+        # Sampling keeps every n-th event; cheaper and steadier than random draws.
+        self.keep_every = {code: max(1, round(1 / rate)) for code, rate in sampling.items() if rate > 0}
+        self.dropped_codes = {code for code, rate in sampling.items() if rate <= 0}
+        self.rate_limits = rate_limits
+        self.seen = CountBy()
+        self.window = {}
+        self.suppressed = CountBy()
+
+    def __call__(self, _, method_name: str, event_dict: dict) -> dict:
+        code = event_dict.get("logging_code")
+        if code is None or method_name in _ALWAYS_LOGGED:
+            return event_dict
+        if code in self.dropped_codes:
+            self.suppress(code)
+        keep_every = self.keep_every.get(code)
+        if keep_every is not None:
+            self.seen[code] += 1
+            if self.seen[code] % keep_every:
+                self.suppress(code)
+        limit = self.rate_limits.get(code)
+        if limit is not None:
+            second = int(time.monotonic())
+            window_second, count = self.window.get(code, (second, 0))
+            if window_second != second:
+                count = 0
+            if count >= limit:
+                self.suppress(code)
+            self.window[code] = (second, count + 1)
+        return event_dict
+
+    def suppress(self, code: str) -> None:
+        self.suppressed[code] += 1
+        raise structlog.DropEvent
+
+    def take_suppressed(self) -> Dict[str, int]:
+        suppressed, self.suppressed = dict(self.suppressed), CountBy()
+        return suppressed
+
+
+class QueueLogger:
+    """structlog logger that hands event dicts to a LogWriter instead of writing."""
+
+    def __init__(self, writer: "LogWriter"):
+        self._writer = writer
+
+    def __getattr__(self, method_name: str):
+        def enqueue(event_dict: dict) -> None:
+            self._writer.put(method_name, event_dict)
+        return enqueue
+
+
+def _to_queue(_, __, event_dict: dict) -> dict:
+    # Final processor on the event loop: QueueLogger's method gets the event dict.
+    return {"event_dict": event_dict}
+
+
+class LogWriter:
+    """Background thread running the rendering processors and writing the lines."""
+
+    def __init__(self, processors: list, queue_size: int, stream: TextIO = None):
+        self.processors = processors
+        self.stream = stream or sys.stdout
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+
+    def start(self) -> None:
+        self.thread.start()
+
+    def put(self, method_name: str, event_dict: dict) -> None:
+        try:
+            self.queue.put_nowait((method_name, event_dict))
+        except queue.Full:
+            # Never block the event loop on logging.
+            metrics.LOG_EVENTS_DROPPED.inc()
+
+    def run(self) -> None:
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                self.stream.flush()
+                return
+            method_name, event_dict = entry
+            try:
+                for processor in self.processors:
+                    event_dict = processor(None, method_name, event_dict)
+            except structlog.DropEvent:
+                continue
+            except Exception as exp:
+                event_dict = f"Log event could not be rendered: {exp!r}"
+            self.stream.write(f"{event_dict}\n")
+            if self.queue.empty():
+                self.stream.flush()
+
+    def stop(self, timeout: float = 5) -> None:
+        """Write the queued events and stop the thread."""
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+
+class LogPipeline:
+    def __init__(self, sampler: Optional[LogSampler], writer: Optional[LogWriter]):
+        self.sampler = sampler
+        self.writer = writer
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.stop()
+
+    async def log_summaries(self, interval_s: float) -> None:
+        """Log the message and ACK counts of every interval, replacing per-message logs."""
+        last = _summary_counts()
+        while True:
+            await asyncio.sleep(interval_s)
+            counts = _summary_counts()
+            logger.info(
+                "HL7 Listener summary",
+                logging_code="HL7LLOG023",
+                interval_seconds=interval_s,
+                **{name: counts[name] - last[name] for name in counts},
+                suppressed_logs=self.sampler.take_suppressed() if self.sampler else {}
+            )
+            last = counts
+
+
+def _summary_counts() -> Dict[str, float]:
+    return {
+        "messages_received": metrics.MESSAGES_RECEIVED.value,
+        "bytes_received": metrics.BYTES_RECEIVED.value,
+        **{f"acks_{code}": counter.value for code, counter in metrics.ACKS_SENT.items()},
+    }
+
+
+def configure_logging(settings) -> LogPipeline:
+    """Install sampling and the background writer as configured; a no-op by default."""
+    sampler = None
+    if settings.LOG_SAMPLING or settings.LOG_RATE_LIMITS:
+        sampler = LogSampler(settings.LOG_SAMPLING, settings.LOG_RATE_LIMITS)
+    if sampler is None and not settings.LOG_ASYNC_ENABLED:
+        return LogPipeline(None, None)
+
+    # Context variables must be merged where the event was logged.
+    loop_processors = [structlog.contextvars.merge_contextvars]
+    if sampler is not None:
+        loop_processors.append(sampler)
+    writer = None
+    if settings.LOG_ASYNC_ENABLED:
+        writer = LogWriter(loglib.get_qcc_processors(), settings.LOG_QUEUE_SIZE)
+        writer.start()
+        loglib.configure(
+            log_level=settings.LOG_LEVEL,
+            logging_processors=[*loop_processors, _to_queue],
+            logger_factory=lambda *args: QueueLogger(writer),
+        )
+    else:
+        loglib.configure(
+            log_level=settings.LOG_LEVEL,
+            logging_processors=[*loop_processors, *loglib.get_qcc_processors()],
+        )
+    return LogPipeline(sampler, writer)
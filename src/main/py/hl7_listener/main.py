@@ -3,31 +3,106 @@
 1) Connect to the configured HL7 MLLP host and then listen for incoming HL7 messages.
 2) Received messages will be sent to the configured NATS JetStream server Subject. If the message sent to the
 NATS server fails, the process of listening for incomming HL7 messages will halt.
+With SPOOL_ENABLED, messages are instead ACKed once written to a local spool and sent to the server in the
+background, with retries while it is unavailable.
 
 Preconditions:
 - HL7 MLLP host and port are available for use.
 - NATS JetStream server is running and configured with expected Subject.
 """
 import asyncio
+import functools
+import math
+import os
 import re
+import signal
+import time
+from typing import (
+    List,
+    Optional,
+    Union,
+)
 
 import hl7
 
-from covera.tracelib import traced,configure_tracing
+from covera.tracelib import configure_tracing
 from covera.loglib import (
     configure_get_logger,
     logs_inject_correlation_id,
 )
 from hl7.mllp import start_hl7_server
+from hl7_listener.ack import ack_frame
+from hl7_listener.admission import AdmissionController
+from hl7_listener.capture import (
+    CaptureWriter,
+    load_hook,
+)
+from hl7_listener.dedupe import DuplicateCache
+from hl7_listener.feeds import (
+    Feed,
+    build_feeds,
+)
+from hl7_listener.framing import (
+    FrameTooLarge,
+    LargeFrame,
+    READER_LIMIT,
+    read_frame,
+)
+from hl7_listener.header import (
+    MSHHeader,
+    scan_msh,
+)
+from hl7_listener import metrics
 from hl7_listener.healthcheck import start_health_check_server
+from hl7_listener.lifecycle import Connections
+from hl7_listener.log_pipeline import (
+    LogPipeline,
+    configure_logging,
+)
 from hl7_listener.messaging.settings import (
     settings as messager_settings,
     messager
 )
+from hl7_listener.offload import (
+    Offloader,
+    validate,
+)
+from hl7_listener.routing import Router
+from hl7_listener.scheduler import FairScheduler
 from hl7_listener.settings import settings
+from hl7_listener.supervisor import Supervisor
+from hl7_listener.tracing import MessageTracer
 
 logger = configure_get_logger()
 
+# Without ADMISSION_ENABLED nothing is limited.
+admission = AdmissionController(
+    max_messages=settings.ADMISSION_MAX_INFLIGHT_MESSAGES,
+    max_bytes=settings.ADMISSION_MAX_INFLIGHT_BYTES,
+    max_connections=settings.ADMISSION_MAX_CONNECTIONS,
+    low_water_ratio=settings.ADMISSION_LOW_WATER_RATIO,
+) if settings.ADMISSION_ENABLED else AdmissionController()
+router = Router(settings.ROUTING_RULES) if settings.ROUTING_RULES else None
+message_tracer = MessageTracer(settings.TRACING_SAMPLE_RATIO)
+duplicates = DuplicateCache(
+    settings.DEDUPE_MAX_ENTRIES, settings.DEDUPE_TTL_S
+) if settings.DEDUPE_ENABLED else None
+scheduler = FairScheduler(
+    settings.SCHEDULER_MAX_CONCURRENT_SENDS,
+    settings.SCHEDULER_CLASSES,
+    flow_key=settings.SCHEDULER_FLOW_KEY,
+) if settings.SCHEDULER_ENABLED else None
+connections = Connections()
+offloader = Offloader(
+    settings.OFFLOAD_EXECUTOR,
+    workers=settings.OFFLOAD_WORKERS,
+    min_bytes=settings.OFFLOAD_MIN_BYTES,
+    max_pending=settings.OFFLOAD_MAX_PENDING,
+)
+feeds = build_feeds(settings, admission)
+# Opened by the process serving the listeners (open_capture) with CAPTURE_ENABLED.
+capture: Optional[CaptureWriter] = None
+
 
 def exception_formatter(exception_text: str):
     exception_text = re.sub(r'\"MSH\|.*\"', "<hl7message>", exception_text)
@@ -36,39 +111,208 @@ def exception_formatter(exception_text: str):
     return exception_text
 
 
-@traced
-async def process_received_hl7_messages(hl7_reader, hl7_writer):
+# Stands in for the MSH segment of a frame whose header could not be read, so that
+# the frame can still be answered with a reject ACK.
+UNREADABLE_MSH = b"MSH|^~\\&|||||||^|||"
+
+
+def streams_large_frames() -> bool:
+    """Whether frames above HL7_STREAM_THRESHOLD_BYTES are spilled and streamed; only
+    known once the messager is connected."""
+    return bool(settings.HL7_STREAM_THRESHOLD_BYTES) and messager.supports_streaming
+
+
+def reader_limit() -> int:
+    """The StreamReader limit of the MLLP connections; larger frames are read in
+    chunks by read_frame."""
+    if streams_large_frames():
+        return min(settings.HL7_STREAM_THRESHOLD_BYTES, READER_LIMIT)
+    return READER_LIMIT
+
+
+def spill_bytes() -> float:
+    """Size above which a received message is spilled to a temporary file."""
+    return settings.HL7_STREAM_THRESHOLD_BYTES if streams_large_frames() else math.inf
+
+
+def message_head(frame: Union[memoryview, LargeFrame]) -> memoryview:
+    """The bytes of a received message that hold its MSH segment."""
+    return frame.head if isinstance(frame, LargeFrame) else frame
+
+
+def oversized_frame_header(exp: FrameTooLarge, peername, feed: Feed) -> Optional[MSHHeader]:
+    """Log a frame over HL7_MAX_FRAME_BYTES and return its header, if readable, for the
+    reject ACK."""
+    logger.error(
+        "Received HL7 message exceeds the maximum frame size",
+        logging_code="HL7LERR014",
+        peername=peername,
+        size=exp.size,
+        max_frame_bytes=settings.HL7_MAX_FRAME_BYTES
+    )
+    try:
+        return scan_msh(exp.head, feed.encoding)
+    except hl7.exceptions.ParseException:
+        return None
+
+
+def record_received_message(
+    header: MSHHeader, frame: Union[memoryview, LargeFrame], feed: Feed, peer: str = ""
+) -> None:
+    """Log and count a received message, and capture it with CAPTURE_ENABLED."""
+    metrics.MESSAGES_RECEIVED.inc()
+    metrics.BYTES_RECEIVED.inc(len(frame))
+    feed.messages_received.inc()
+    feed.bytes_received.inc(len(frame))
+    logger.info(
+        "HL7 Listener received a message",
+        logging_code="HL7LLOG003",
+        type=header.type,
+        feed=feed.name)
+    # Streamed messages are not captured; they were never held in memory.
+    if capture is not None and not isinstance(frame, LargeFrame):
+        capture.record(frame, peer)
+
+
+def outbound_payload(frame: memoryview, feed: Feed) -> Union[str, memoryview]:
+    """The received message as handed to the messager.
+
+    In raw-bytes mode this is the received bytes themselves, in the sender's charset.
+    Otherwise the message is decoded once to str.
+    """
+    if feed.raw_bytes:
+        return frame
+    return str(frame, feed.encoding)
+
+
+def write_ack(hl7_writer, header: Optional[MSHHeader], ack_code: str = "AA") -> None:
+    """Write the ACK for a received message, built from its MSH segment alone."""
+    hl7_writer.write(ack_frame(header.segment if header else UNREADABLE_MSH, ack_code))
+    metrics.ACKS_SENT[ack_code].inc()
+
+
+async def publish_message(
+    frame: Union[memoryview, LargeFrame],
+    header: MSHHeader,
+    peer: str = "",
+    feed: Optional[Feed] = None,
+) -> None:
+    """Hand a received message to the messager; returns once the messager accepted it.
+
+    A retransmission of a message being published or published within DEDUPE_TTL_S
+    is not published again; it returns, or raises, as its original did. A LargeFrame
+    is streamed from its file and is not checked for retransmission.
+    """
+    feed = feed or feeds[0]
+    large = isinstance(frame, LargeFrame)
+    duplicate_key = None
+    if duplicates is not None and not large:
+        duplicate_key = duplicates.key(header, frame)
+        original = duplicates.original(duplicate_key)
+        if original is not None:
+            logger.info(
+                "HL7 Listener received a retransmitted message, ACKing it without publishing",
+                logging_code="HL7LLOG025",
+                type=header.type,
+                control_id=header.control_id
+            )
+            # Shielded: this connection closing must not fail the original's waiters.
+            if not await asyncio.shield(original):
+                raise Exception("The original of the retransmitted message was not published")
+            return
+    published = False
+    feed.admit(len(frame))
+    metrics.PUBLISHES_IN_FLIGHT.inc()
+    started = time.perf_counter()
+    try:
+        destination = (router.route(header) if router else None) or feed.destination
+        if scheduler is not None:
+            await scheduler.acquire(scheduler.flow(header, peer), len(frame))
+        try:
+            with message_tracer.message_span(header, peer):
+                if large:
+                    await messager.send_stream(
+                        frame.file, len(frame), header.control_id or None, destination
+                    )
+                else:
+                    await messager.send_msg(
+                        msg=outbound_payload(frame, feed),
+                        msg_id=header.control_id or None,
+                        destination=destination,
+                        encoding=feed.encoding if feed.raw_bytes else None
+                    )
+        finally:
+            if scheduler is not None:
+                scheduler.release()
+        published = True
+    finally:
+        if duplicate_key is not None:
+            duplicates.finished(duplicate_key, published)
+        if large:
+            frame.close()
+        feed.release(len(frame))
+        metrics.PUBLISHES_IN_FLIGHT.dec()
+        metrics.PUBLISH_SECONDS.observe(time.perf_counter() - started)
+
+
+async def refuse_connection(hl7_writer, peername) -> None:
+    logger.warning(
+        "HL7 Listener connection refused, too many open connections",
+        logging_code="HL7LERR013",
+        peername=peername
+    )
+    hl7_writer.close()
+    await hl7_writer.wait_closed()
+
+
+async def process_received_hl7_messages(hl7_reader, hl7_writer, feed: Optional[Feed] = None):
     """This will be called every time a socket connects to the receiver/listener."""
+    feed = feed or feeds[0]
     peername = hl7_writer.get_extra_info("peername")
     logger.info(
         "HL7 Listener connection established",
         logging_code="HL7LLOG002",
         peername=peername
     )
+    if not feed.connect():
+        await refuse_connection(hl7_writer, peername)
+        return
+    peer = metrics.peer_label(peername)
+    metrics.ACTIVE_CONNECTIONS.inc(peer)
+    connections.opened()
     try:
         # Note: IncompleteReadError can occur if the HL7 message sender ends and fails to
         # close its writer (reader for this function). It results in a empty byte buffer (b'') which
         # causes the IncompleteReadError. This function's hl7_reader.at_eof() will
         # then be True.
-        hl7_message = None
-        while not hl7_reader.at_eof():
-            hl7_message = await hl7_reader.readmessage()
-            # This may not be needed since the hl7_mllp sender should fail if the message
-            # was not valid hl7 message.
-            _parsed = hl7.parse(str(hl7_message))
-            _type, _trigger = _parsed['MSH.F9.R1.1'], _parsed['MSH.F9.R1.2']
-            
-            logger.info(
-                "HL7 Listener received a message",
-                logging_code="HL7LLOG003",
-                type=f"{_type}^{_trigger}")
+        header = None
+        while not hl7_reader.at_eof() and connections.ready_for_message():
+            header = None
+            await feed.wait_for_capacity()
+            started = time.perf_counter()
+            frame = await read_frame(
+                hl7_reader, settings.HL7_MAX_FRAME_BYTES, spill_bytes()
+            )
+            # On shutdown the message is still sent and ACKed before the connection closes.
+            connections.busy()
+            received = time.perf_counter()
+            metrics.FRAME_READ_SECONDS.observe(received - started)
+            # Only the MSH header is read; the message is fully parsed only when
+            # validation is enabled, and never when it was too large to buffer.
+            header = scan_msh(message_head(frame), feed.encoding)
+            record_received_message(header, frame, feed, peer)
+            if settings.HL7_VALIDATE_MESSAGES and not isinstance(frame, LargeFrame):
+                await offloader.run(len(frame), validate, frame, feed.encoding)
+            metrics.PARSE_SECONDS.observe(time.perf_counter() - received)
 
-            await messager.send_msg(msg=str(hl7_message))
+            await publish_message(frame, header, peer, feed)
 
             # Send ACK to acknowledge receipt of the message.
-            hl7_writer.writemessage(hl7_message.create_ack())
+            started = time.perf_counter()
+            write_ack(hl7_writer, header)
             # The drain() will fail if the hl7 sender does not process the ACK.
             await hl7_writer.drain()
+            metrics.ACK_DRAIN_SECONDS.observe(time.perf_counter() - started)
 
     except hl7.exceptions.ParseException as exp:
         logger.error(
@@ -78,7 +322,11 @@ async def process_received_hl7_messages(hl7_reader, hl7_writer):
             exception=Exception(exception_formatter(str(exp)))
         )
         # Send ack code Application Reject (AR).
-        hl7_writer.writemessage(hl7_message.create_ack(ack_code="AR"))
+        write_ack(hl7_writer, header, ack_code="AR")
+
+    except FrameTooLarge as exp:
+        # Send ack code Application Reject (AR).
+        write_ack(hl7_writer, oversized_frame_header(exp, peername, feed), ack_code="AR")
 
     except asyncio.IncompleteReadError as exp:
         if hl7_reader.at_eof():
@@ -95,9 +343,9 @@ async def process_received_hl7_messages(hl7_reader, hl7_writer):
                 peername=peername,
                 exception=Exception(exception_formatter(str(exp)))
             )
-            if hl7_message:
+            if header:
                 # Send ack code Application Error (AE).
-                hl7_writer.writemessage(hl7_message.create_ack(ack_code="AE"))
+                write_ack(hl7_writer, header, ack_code="AE")
             else:
                 raise Exception(exception_formatter(str(exp)))
 
@@ -108,9 +356,9 @@ async def process_received_hl7_messages(hl7_reader, hl7_writer):
             peername=peername,
             exception=Exception(exception_formatter(str(exp)))
         )
-        if hl7_message:
+        if header:
             # Send ack code Application Error (AE).
-            hl7_writer.writemessage(hl7_message.create_ack(ack_code="AE"))
+            write_ack(hl7_writer, header, ack_code="AE")
         else:
             raise Exception(exception_formatter(str(exp)))
 
@@ -120,6 +368,9 @@ async def process_received_hl7_messages(hl7_reader, hl7_writer):
             await hl7_writer.wait_closed()
         # Note: the message sender will close the hl7_reader (writer from the
         # sender perspective).
+        metrics.ACTIVE_CONNECTIONS.dec(peer)
+        feed.disconnect()
+        connections.closed()
         logger.info(
             "HL7 Listener connection closed",
             logging_code="HL7LLOG004",
@@ -127,16 +378,216 @@ async def process_received_hl7_messages(hl7_reader, hl7_writer):
         )
 
 
-async def hl7_receiver():
-    """Receive HL7 MLLP messages on the configured host and port."""
-    logger.info(f"Starting the hl7 server on {settings.HL7_MLLP_HOST}:{settings.HL7_MLLP_PORT}")
+def stop_connection(hl7_writer, stopped):
+    """Stop reading from a pipelined connection and close it once pending writes flush."""
+    stopped.set()
+    hl7_writer.close()
+
+
+async def write_acks_in_order(in_flight, window, hl7_writer, peername, stopped):
+    """Write one ACK per in-flight message, strictly in arrival order.
+
+    Each entry of `in_flight` is a (header, publish) pair where publish is the
+    task sending the message to the messager, or None if the message must be
+    rejected (AR). A None entry ends the connection. After the first failure no
+    further ACKs are written; the remaining publishes are cancelled so the sender
+    retransmits everything it has not seen acknowledged, exactly as it would after
+    a failure in sequential mode.
+    """
+    while True:
+        entry = await in_flight.get()
+        if entry is None:
+            return
+        header, publish = entry
+        try:
+            if stopped.is_set():
+                if publish:
+                    publish.cancel()
+                continue
+            if publish is None:
+                # Send ack code Application Reject (AR).
+                write_ack(hl7_writer, header, ack_code="AR")
+                stop_connection(hl7_writer, stopped)
+                continue
+            try:
+                await publish
+            except Exception as exp:
+                logger.error(
+                    "Unknown error during HL7 receive message processing",
+                    logging_code="HL7LERR007",
+                    peername=peername,
+                    exception=Exception(exception_formatter(str(exp)))
+                )
+                # Send ack code Application Error (AE).
+                write_ack(hl7_writer, header, ack_code="AE")
+                stop_connection(hl7_writer, stopped)
+                continue
+
+            # Send ACK to acknowledge receipt of the message.
+            started = time.perf_counter()
+            write_ack(hl7_writer, header)
+            # The drain() will fail if the hl7 sender does not process the ACK.
+            await hl7_writer.drain()
+            metrics.ACK_DRAIN_SECONDS.observe(time.perf_counter() - started)
+        except Exception as exp:
+            logger.error(
+                "Unknown error during HL7 receive message processing",
+                logging_code="HL7LERR007",
+                peername=peername,
+                exception=Exception(exception_formatter(str(exp)))
+            )
+            stop_connection(hl7_writer, stopped)
+        finally:
+            window.release()
+
+
+async def process_received_hl7_messages_pipelined(
+    hl7_reader, hl7_writer, feed: Optional[Feed] = None
+):
+    """Pipelined variant of process_received_hl7_messages.
+
+    Up to HL7_PIPELINE_WINDOW messages per connection may be waiting on the messager
+    while the next frames are read. ACKs are still written in arrival order and only
+    after the message's own send completed, so a sender sees the same ordering and
+    durability guarantees as in sequential mode.
+    """
+    feed = feed or feeds[0]
+    peername = hl7_writer.get_extra_info("peername")
+    logger.info(
+        "HL7 Listener connection established",
+        logging_code="HL7LLOG002",
+        peername=peername
+    )
+    if not feed.connect():
+        await refuse_connection(hl7_writer, peername)
+        return
+    peer = metrics.peer_label(peername)
+    metrics.ACTIVE_CONNECTIONS.inc(peer)
+    in_flight = asyncio.Queue()
+    window = asyncio.Semaphore(settings.HL7_PIPELINE_WINDOW)
+    stopped = asyncio.Event()
+    ack_writer = asyncio.create_task(
+        write_acks_in_order(in_flight, window, hl7_writer, peername, stopped)
+    )
+    # The read loop is never busy: on shutdown it stops at once and the ACK writer
+    # finishes the messages already read.
+    connections.opened()
+    try:
+        header = None
+        while (
+            not hl7_reader.at_eof()
+            and not stopped.is_set()
+            and connections.ready_for_message()
+        ):
+            # Do not read ahead past the window; unread frames stay in the socket
+            # so TCP flow control pushes back on the sender.
+            await window.acquire()
+            header = None
+            try:
+                await feed.wait_for_capacity()
+                started = time.perf_counter()
+                frame = await read_frame(
+                    hl7_reader, settings.HL7_MAX_FRAME_BYTES, spill_bytes()
+                )
+                received = time.perf_counter()
+                metrics.FRAME_READ_SECONDS.observe(received - started)
+                header = scan_msh(message_head(frame), feed.encoding)
+                record_received_message(header, frame, feed, peer)
+                if settings.HL7_VALIDATE_MESSAGES and not isinstance(frame, LargeFrame):
+                    await offloader.run(len(frame), validate, frame, feed.encoding)
+                metrics.PARSE_SECONDS.observe(time.perf_counter() - received)
+            except BaseException:
+                window.release()
+                raise
+            publish = asyncio.create_task(publish_message(frame, header, peer, feed))
+            in_flight.put_nowait((header, publish))
+
+    except hl7.exceptions.ParseException as exp:
+        logger.error(
+            "Received HL7 message is not a valid",
+            logging_code="HL7LERR006",
+            peername=peername,
+            exception=Exception(exception_formatter(str(exp)))
+        )
+        await window.acquire()
+        in_flight.put_nowait((header, None))
+
+    except FrameTooLarge as exp:
+        header = oversized_frame_header(exp, peername, feed)
+        await window.acquire()
+        in_flight.put_nowait((header, None))
+
+    except asyncio.IncompleteReadError as exp:
+        if hl7_reader.at_eof():
+            logger.info(
+                "HL7 Listener connection from a sender peer is closing",
+                logging_code="HL7LLOG011",
+                peername=peername
+            )
+        else:
+            logger.error(
+                "HL7 MLLP Unexpected incomplete message read error",
+                loggin_code='HL7LERR004',
+                peername=peername,
+                exception=Exception(exception_formatter(str(exp)))
+            )
+
+    except Exception as exp:
+        logger.error(
+            "Unknown error during HL7 receive message processing",
+            logging_code="HL7LERR007",
+            peername=peername,
+            exception=Exception(exception_formatter(str(exp)))
+        )
+
+    finally:
+        # Let the outstanding publishes finish and their ACKs go out before closing.
+        in_flight.put_nowait(None)
+        await ack_writer
+        if hl7_writer:
+            hl7_writer.close()
+            await hl7_writer.wait_closed()
+        metrics.ACTIVE_CONNECTIONS.dec(peer)
+        feed.disconnect()
+        connections.closed()
+        logger.info(
+            "HL7 Listener connection closed",
+            logging_code="HL7LLOG004",
+            peername=peername
+        )
+
+
+async def hl7_receiver(
+    reuse_port: bool = False,
+    listening: Optional[asyncio.Event] = None,
+    feed: Optional[Feed] = None,
+):
+    """Receive HL7 MLLP messages on the host and port of a feed, by default the main
+    listener's.
+
+    With reuse_port, several worker processes can listen on the same port. listening
+    is set once the port is bound. Cancelling the receiver closes the port; the
+    connections already open are left to Connections.drain.
+    """
+    feed = feed or feeds[0]
+    logger.info(f"Starting the hl7 server {feed.name} on {feed.host}:{feed.port}")
     try:
         async with await start_hl7_server(
-                process_received_hl7_messages,  # Callback function.
-                host=settings.HL7_MLLP_HOST,
-                port=int(settings.HL7_MLLP_PORT),
-                encoding='UTF-8'
+                # Callback function.
+                functools.partial(
+                    process_received_hl7_messages_pipelined
+                    if settings.HL7_PIPELINE_ENABLED
+                    else process_received_hl7_messages,
+                    feed=feed
+                ),
+                host=feed.host,
+                port=feed.port,
+                encoding=feed.encoding,
+                limit=reader_limit(),
+                reuse_port=reuse_port
         ) as hl7_server:
+            if listening is not None:
+                listening.set()
             # Listen forever or until a cancel occurs.
             await hl7_server.serve_forever()
 
@@ -160,7 +611,15 @@ async def hl7_receiver():
 async def main():
     # Create the logger and add the correlation_id to the logs.
     configure_tracing()
+    log_pipeline = configure_logging(settings)
     logs_inject_correlation_id(logger)
+    try:
+        await serve(log_pipeline)
+    finally:
+        log_pipeline.close()
+
+
+async def serve(log_pipeline: LogPipeline) -> None:
     logger.info(
         "HL7 Listener started",
         logging_code='HL7LLOG001',
@@ -168,14 +627,152 @@ async def main():
         messager_settings=messager_settings.model_dump()
     )
 
-    #In case of cloud connect, the connect method will return empty handed
+    if settings.HL7_WORKERS > 1:
+        await Supervisor(
+            settings.HL7_WORKERS,
+            run_worker,
+            stop_timeout_s=settings.HL7_WORKER_STOP_TIMEOUT_S,
+            worker_env=worker_env,
+            not_ready_delay_s=settings.SHUTDOWN_NOT_READY_DELAY_S,
+        ).run()
+        return
+
+    loop = asyncio.get_running_loop()
+    stopping = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(signum, stopping.set)
+    listening = [asyncio.Event() for _ in feeds]
+    await start_health_check_server(
+        is_ready=lambda: all(event.is_set() for event in listening) and not stopping.is_set()
+    )
+
+    # The ports are bound only once the messager is connected, so the first senders
+    # are not held up by the messager's startup. For NATS this opens the server
+    # connection; for Cloud it opens the pool of long-lived Service Bus clients.
+    await messager.connect()
+    open_capture()
+    receivers = start_receivers(listening)
+    background = [
+        asyncio.create_task(
+            metrics.monitor_event_loop_lag(settings.METRICS_LOOP_LAG_INTERVAL_S)
+        ),
+    ]
+    if settings.LOG_SUMMARY_INTERVAL_S:
+        background.append(asyncio.create_task(
+            log_pipeline.log_summaries(settings.LOG_SUMMARY_INTERVAL_S)
+        ))
+    stop = asyncio.create_task(stopping.wait())
+    try:
+        await asyncio.wait([*receivers, stop], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        # /ready reports not ready as soon as stopping is set.
+        if stopping.is_set():
+            await asyncio.sleep(settings.SHUTDOWN_NOT_READY_DELAY_S)
+        await stop_serving(receivers, [stop, *background])
+    # Raises if a receiver failed.
+    for receiver in receivers:
+        await receiver
+
+
+def start_receivers(
+    listening: List[asyncio.Event], reuse_port: bool = False
+) -> List[asyncio.Task]:
+    """Start one receiver per feed; each sets its listening event once bound."""
+    return [
+        asyncio.create_task(hl7_receiver(reuse_port=reuse_port, listening=event, feed=feed))
+        for feed, event in zip(feeds, listening)
+    ]
+
+
+async def stop_serving(receivers: List[asyncio.Task], background: List[asyncio.Task]) -> None:
+    """Stop accepting connections, drain the open ones, then close the messager."""
+    logger.info(
+        "HL7 Listener stopping",
+        logging_code="HL7LLOG024",
+        open_connections=len(connections),
+        drain_timeout_seconds=settings.SHUTDOWN_DRAIN_TIMEOUT_S
+    )
+    for receiver in receivers:
+        receiver.cancel()
+    await connections.drain(settings.SHUTDOWN_DRAIN_TIMEOUT_S)
+    for task in background:
+        task.cancel()
+    await asyncio.gather(*receivers, *background, return_exceptions=True)
+    offloader.shutdown()
+    if capture is not None:
+        capture.close()
+    # Sends whatever the messager still holds before closing its connections.
+    await messager.close()
+
+
+def worker_env(index: int) -> dict:
+    # Workers must not share a spool or a capture file.
+    return {
+        "SPOOL_DIR": os.path.join(settings.SPOOL_DIR, f"worker-{index}"),
+        "CAPTURE_PATH": f"{settings.CAPTURE_PATH}.worker-{index}",
+    }
+
+
+def open_capture() -> None:
+    """Start capturing received messages, in the process serving them."""
+    global capture
+    if settings.CAPTURE_ENABLED:
+        capture = CaptureWriter(
+            settings.CAPTURE_PATH,
+            compress=settings.CAPTURE_COMPRESS,
+            encrypt=load_hook(settings.CAPTURE_ENCRYPT_HOOK),
+            max_bytes=settings.CAPTURE_MAX_BYTES,
+        )
+
+
+async def serve_worker(metrics_connection, log_pipeline: LogPipeline) -> None:
+    """Run one worker of a multi-process listener until the supervisor stops it."""
+    loop = asyncio.get_running_loop()
+    stopped = asyncio.Event()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set)
+    # Ctrl-C reaches the whole process group; the supervisor coordinates the stop.
+    loop.add_signal_handler(signal.SIGINT, lambda: None)
+
     await messager.connect()
-    asyncio.create_task(hl7_receiver())
-    await start_health_check_server()
-    await asyncio.Event().wait()
+    open_capture()
+    listening = [asyncio.Event() for _ in feeds]
+    receivers = start_receivers(listening, reuse_port=True)
+    background = [
+        asyncio.create_task(
+            metrics.monitor_event_loop_lag(settings.METRICS_LOOP_LAG_INTERVAL_S)
+        ),
+        asyncio.create_task(
+            push_snapshots_when_listening(metrics_connection, listening)
+        ),
+    ]
+    if settings.LOG_SUMMARY_INTERVAL_S:
+        background.append(asyncio.create_task(
+            log_pipeline.log_summaries(settings.LOG_SUMMARY_INTERVAL_S)
+        ))
+    stop = asyncio.create_task(stopped.wait())
+    try:
+        # A receiver that fails ends the worker, which the supervisor restarts.
+        await asyncio.wait([*receivers, stop], return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        await stop_serving(receivers, [stop, *background])
+
+
+async def push_snapshots_when_listening(
+    metrics_connection, listening: List[asyncio.Event]
+) -> None:
+    # The supervisor counts a worker as ready once it reported metrics.
+    await asyncio.gather(*(event.wait() for event in listening))
+    await metrics.push_snapshots(metrics_connection, settings.METRICS_PUSH_INTERVAL_S)
+
 
-    if messager.conn and hasattr(messager.conn, "close"):
-        await messager.conn.close()
+def run_worker(index: int, metrics_connection) -> None:
+    configure_tracing()
+    log_pipeline = configure_logging(settings)
+    logs_inject_correlation_id(logger)
+    try:
+        asyncio.run(serve_worker(metrics_connection, log_pipeline))
+    finally:
+        log_pipeline.close()
 
 
 if __name__ == "__main__":
@@ -1,14 +1,74 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional
+
+
+class OutboundMessage(NamedTuple):
+    """One message of a batch, with the same fields as the send_msg arguments."""
+    msg: Any
+    msg_id: Optional[str] = None
+    destination: Optional[str] = None
+    # The trace context of a traced message, captured where it was sent.
+    trace_context: Optional[Dict[str, str]] = None
+    encoding: Optional[str] = None
 
 
 class MessagingInterface(ABC):
+    # Whether send_stream is available; checked once connected.
+    supports_streaming = False
 
     @abstractmethod
-    def send_msg(self, msg: Any) -> None:
+    def send_msg(
+        self,
+        msg: Any,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
+        """Send one message.
+
+        msg_id is the message's HL7 control ID (MSH-10), if it has one. Backends that
+        support deduplication use it to drop retransmitted messages. destination is
+        the subject or queue chosen by routing; None means the configured default.
+        encoding is the charset of a raw bytes msg, as received from its sender; None
+        means HL7_MLLP_ENCODING.
+        """
         raise NotImplementedError
 
     @abstractmethod
     def connect(self) -> None:
         raise NotImplementedError
 
+    async def send_batch(self, msgs: List[OutboundMessage]) -> None:
+        """Send several messages as one unit; raises if any of them was not sent.
+
+        Backends override this when they have a cheaper way to send many messages
+        than one send_msg call each.
+        """
+        await asyncio.gather(*(
+            self.send_msg(msg.msg, msg.msg_id, msg.destination, msg.encoding) for msg in msgs
+        ))
+
+    async def send_stream(
+        self,
+        stream: BinaryIO,
+        size: int,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+    ) -> None:
+        """Send a message too large to be held in memory, read from stream in chunks."""
+        raise NotImplementedError
+
+    def is_unavailable(self, exp: Exception) -> bool:
+        """Whether exp, raised by a send, means the broker could not be reached, so
+        the same send can succeed later."""
+        return False
+
+    def is_rejected(self, exp: Exception) -> bool:
+        """Whether exp, raised by a send, means the broker refused the messages
+        themselves, so sending them again cannot succeed."""
+        return False
+
+    async def close(self) -> None:
+        """Release the messager's connections. Called once on shutdown."""
+        pass
@@ -0,0 +1,128 @@
+import asyncio
+from typing import (
+    Any,
+    BinaryIO,
+    List,
+    Optional,
+    Set,
+    Tuple,
+)
+
+from hl7_listener import tracing
+from hl7_listener.messaging.base import (
+    MessagingInterface,
+    OutboundMessage,
+)
+
+
+def _encoded_size(msg: Any) -> int:
+    """Size of a message as sent; the messagers send str payloads UTF-8 encoded."""
+    if isinstance(msg, str) and not msg.isascii():
+        return len(msg.encode())
+    return len(msg)
+
+
+class BatchingMessager(MessagingInterface):
+    """Collects messages from all connections and sends them in batches.
+
+    A batch is flushed to the wrapped messager's send_batch when it holds
+    max_messages messages or max_bytes bytes, or max_delay_ms after its first
+    message arrived, whichever comes first. send_msg returns only once the batch
+    holding its message has been confirmed, so a sender is still only ACKed after its
+    message was persisted by the broker.
+    """
+
+    def __init__(
+        self,
+        messager: MessagingInterface,
+        max_messages: int,
+        max_bytes: int,
+        max_delay_ms: float,
+    ):
+        self.messager = messager
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay_ms / 1000
+        self._pending: List[Tuple[OutboundMessage, asyncio.Future]] = []
+        self._pending_bytes = 0
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._flushes: Set[asyncio.Task] = set()
+
+    @property
+    def conn(self):
+        return self.messager.conn
+
+    @property
+    def supports_streaming(self) -> bool:
+        return self.messager.supports_streaming
+
+    async def connect(self) -> bool:
+        return await self.messager.connect()
+
+    def is_unavailable(self, exp: Exception) -> bool:
+        return self.messager.is_unavailable(exp)
+
+    def is_rejected(self, exp: Exception) -> bool:
+        return self.messager.is_rejected(exp)
+
+    async def close(self) -> None:
+        """Send whatever is still pending, then close the wrapped messager."""
+        self.flush()
+        if self._flushes:
+            await asyncio.wait(self._flushes)
+        await self.messager.close()
+
+    async def send_msg(
+        self,
+        msg: Any,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((
+            OutboundMessage(msg, msg_id, destination, tracing.trace_context(), encoding), future
+        ))
+        self._pending_bytes += _encoded_size(msg)
+        if len(self._pending) >= self.max_messages or self._pending_bytes >= self.max_bytes:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self.flush)
+        await future
+
+    async def send_batch(self, msgs: List[OutboundMessage]) -> None:
+        await self.messager.send_batch(msgs)
+
+    async def send_stream(
+        self,
+        stream: BinaryIO,
+        size: int,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+    ) -> None:
+        # Large messages are not batched.
+        await self.messager.send_stream(stream, size, msg_id, destination)
+
+    def flush(self) -> None:
+        """Start sending the pending batch, if any."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        batch, self._pending, self._pending_bytes = self._pending, [], 0
+        task = asyncio.create_task(self._send(batch))
+        self._flushes.add(task)
+        task.add_done_callback(self._flushes.discard)
+
+    async def _send(self, batch: List[Tuple[OutboundMessage, asyncio.Future]]) -> None:
+        try:
+            await self.messager.send_batch([msg for msg, _ in batch])
+        except Exception as exp:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(exp)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
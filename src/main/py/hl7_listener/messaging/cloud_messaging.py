@@ -1,45 +1,334 @@
+import asyncio
+import functools
+import time
 from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
     Union,
 )
 
+from azure.identity.aio import DefaultAzureCredential
+from azure.servicebus import ServiceBusMessage
+from azure.servicebus.aio import (
+    ServiceBusClient,
+    ServiceBusSender,
+)
+from azure.servicebus.exceptions import (
+    MessageSizeExceededError,
+    MessagingEntityDisabledError,
+    MessagingEntityNotFoundError,
+    OperationTimeoutError,
+    ServiceBusAuthenticationError,
+    ServiceBusAuthorizationError,
+    ServiceBusCommunicationError,
+    ServiceBusConnectionError,
+    ServiceBusQuotaExceededError,
+    ServiceBusServerBusyError,
+)
 from covera.loglib import configure_get_logger
 from covera.tracelib import traced
 
 import hl7_listener.messaging.settings as msgr_config
-from hl7_listener.messaging.base import MessagingInterface
+from hl7_listener import (
+    metrics,
+    tracing,
+)
+from hl7_listener.messaging.base import (
+    MessagingInterface,
+    OutboundMessage,
+)
+from hl7_listener.messaging.compression import Compressor
+from hl7_listener.settings import settings as listener_settings
 from covera_cloud_integration import create_client,CloudClient,CloudMessage
 
 logger = configure_get_logger()
 
+_SEND_TIMEOUT_S = 5
+# Send errors meaning Service Bus or the queue could not be used for now. Missing or
+# disabled queues and credentials are configuration problems no message can get
+# past. OSError includes socket errors and timeouts.
+UNAVAILABLE_ERRORS = (
+    MessagingEntityDisabledError,
+    MessagingEntityNotFoundError,
+    OperationTimeoutError,
+    ServiceBusAuthenticationError,
+    ServiceBusAuthorizationError,
+    ServiceBusCommunicationError,
+    ServiceBusConnectionError,
+    ServiceBusQuotaExceededError,
+    ServiceBusServerBusyError,
+    OSError,
+)
+# Send errors meaning Service Bus refused the message itself.
+REJECTED_ERRORS = (MessageSizeExceededError,)
+
+
+class PooledSender:
+    """A long-lived Service Bus client that is reused across messages.
+
+    Single messages are sent with the covera_cloud_integration client. Batches are
+    sent with azure-servicebus directly, which can pack messages into Service Bus
+    batches; its client is created on the first batch, with one sender per queue.
+    """
+
+    def __init__(self):
+        self._client_cm = None
+        self.client = None
+        self._credential: Optional[DefaultAzureCredential] = None
+        self._service_bus: Optional[ServiceBusClient] = None
+        self._queue_senders: Dict[str, ServiceBusSender] = {}
+
+    @property
+    def is_open(self) -> bool:
+        return self.client is not None
+
+    async def open(self) -> None:
+        self._client_cm = create_client(CloudClient.AZURE_ASYNC_SERVICE_BUS,
+                                        **{"namespace":msgr_config.settings.MSG_NAMESPACE
+                                           })
+        self.client = await self._client_cm.__aenter__()
+        logger.info(
+            "Opened Cloud messaging client",
+            logging_code="HL7LLOG012",
+            msg_namespace=msgr_config.settings.MSG_NAMESPACE
+        )
+
+    async def send_batch(self, queue_name: str, messages: List[CloudMessage]) -> None:
+        """Send messages to queue_name, in order, in as few Service Bus batches as they
+        fit in.
+
+        Raises MessageSizeExceededError for a message too large for a batch of its own.
+        """
+        if self._service_bus is None:
+            self._credential = DefaultAzureCredential()
+            self._service_bus = ServiceBusClient(
+                msgr_config.settings.MSG_NAMESPACE, self._credential
+            )
+        sender = self._queue_senders.get(queue_name)
+        if sender is None:
+            sender = self._queue_senders[queue_name] = self._service_bus.get_queue_sender(
+                queue_name
+            )
+        batch = await sender.create_message_batch()
+        batched = 0
+        for message in messages:
+            service_bus_message = ServiceBusMessage(
+                message.data,
+                content_type=message.content_type,
+                application_properties=message.properties,
+            )
+            try:
+                batch.add_message(service_bus_message)
+            except MessageSizeExceededError:
+                if not batched:
+                    raise
+                await sender.send_messages(batch, timeout=_SEND_TIMEOUT_S)
+                batch = await sender.create_message_batch()
+                batch.add_message(service_bus_message)
+                batched = 0
+            batched += 1
+        await sender.send_messages(batch, timeout=_SEND_TIMEOUT_S)
+
+    async def close(self) -> None:
+        client_cm, self._client_cm, self.client = self._client_cm, None, None
+        service_bus, self._service_bus = self._service_bus, None
+        credential, self._credential = self._credential, None
+        queue_senders, self._queue_senders = self._queue_senders, {}
+        closers = [sender.close for sender in queue_senders.values()]
+        closers += [client.close for client in (service_bus, credential) if client is not None]
+        if client_cm is not None:
+            closers.append(functools.partial(client_cm.__aexit__, None, None, None))
+        for close in closers:
+            try:
+                await close()
+            except Exception as exp:
+                # The link is already broken or the client is shutting down; nothing
+                # else can be done with it.
+                logger.warning(
+                    "Error closing Cloud messaging client",
+                    logging_code="HL7LERR009",
+                    exception=exp
+                )
+
+
 class CloudMessager(MessagingInterface):
+    conn: Optional[Any] = None
+    # Set when COMPRESSION_ALGORITHM is configured.
+    compressor: Optional[Compressor] = None
+
+    def __init__(self):
+        self._senders: Optional[asyncio.Queue] = None
+        # Sends that went out on an already open client vs. ones that had to open
+        # (or re-open) a client first.
+        self.warm_sends = 0
+        self.cold_sends = 0
 
     @traced
     async def connect(self) -> bool:
-        """Dont need this method so basically just putting a pass on it since we create client with context manager from cloud lib
+        """Open the pool of long-lived Service Bus clients used by send_msg.
 
-        Returns:
-            bool: _description_
+        Clients are opened eagerly so the first messages do not pay for the client,
+        auth and link setup. A client that fails to open here is opened again on
+        first use.
         """
-        pass
-    
-    @traced
-    async def send_msg(self, msg: Union[str, bytes]) -> None:
-        """Sends a msg to an cloud messaging queue."""
-        assert isinstance(msg, (str, bytes))
+        self._senders = asyncio.Queue()
+        for _ in range(max(1, msgr_config.settings.CLOUD_SENDER_POOL_SIZE)):
+            sender = PooledSender()
+            try:
+                await sender.open()
+            except Exception as exp:
+                logger.error(
+                    "Error opening Cloud messaging client",
+                    logging_code="HL7LERR008",
+                    exception=exp
+                )
+            self._senders.put_nowait(sender)
+        return True
+
+    async def close(self) -> None:
+        """Close every pooled client."""
+        if self._senders is None:
+            return
+        senders, self._senders = self._senders, None
+        while not senders.empty():
+            await senders.get_nowait().close()
+        logger.info(
+            "Closed Cloud messaging clients",
+            logging_code="HL7LLOG013",
+            warm_sends=self.warm_sends,
+            cold_sends=self.cold_sends
+        )
+
+    def is_unavailable(self, exp: Exception) -> bool:
+        return isinstance(exp, UNAVAILABLE_ERRORS)
 
-        to_send = msg
-        if isinstance(msg, bytes):
-            to_send = msg.decode()
+    def is_rejected(self, exp: Exception) -> bool:
+        return isinstance(exp, REJECTED_ERRORS)
 
+    async def send_msg(
+        self,
+        msg: Union[str, bytes, memoryview],
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
+        """Sends a msg to an cloud messaging queue.
+
+        The message goes out on a pooled client. If the client's link fails, the
+        client is rebuilt and the send is retried once before the error is raised.
+        """
         logger.info(
             "Sending message to Cloud",
             logging_code="HL7LLOG009",
-            outbound_queue_name=msgr_config.settings.OUTBOUND_QUEUE_NAME
+            outbound_queue_name=destination or msgr_config.settings.OUTBOUND_QUEUE_NAME
+        )
+        with tracing.child_span("servicebus.send"):
+            await self.send_on_pooled_client(
+                [await self.cloud_message(msg, tracing.trace_context(), encoding)], destination
+            )
+
+    async def send_batch(self, msgs: List[OutboundMessage]) -> None:
+        """Sends the msgs to the cloud messaging queue in Service Bus batches.
+
+        A Service Bus batch goes to a single queue, so routed messages are sent per
+        destination; messages beyond the batch size limit go in further batches.
+        """
+        logger.info(
+            "Sending message batch to Cloud",
+            logging_code="HL7LLOG015",
+            outbound_queue_name=msgr_config.settings.OUTBOUND_QUEUE_NAME,
+            batch_size=len(msgs)
+        )
+        cloud_messages = await asyncio.gather(*(
+            self.cloud_message(msg.msg, msg.trace_context, msg.encoding) for msg in msgs
+        ))
+        by_destination = {}
+        for msg, cloud_message in zip(msgs, cloud_messages):
+            by_destination.setdefault(msg.destination, []).append(cloud_message)
+        await asyncio.gather(*(
+            self.send_on_pooled_client(messages, destination)
+            for destination, messages in by_destination.items()
+        ))
+
+    async def cloud_message(
+        self,
+        msg: Union[str, bytes, memoryview],
+        trace_context: Optional[Dict[str, str]] = None,
+        encoding: Optional[str] = None,
+    ) -> CloudMessage:
+        """Wrap msg for Service Bus, compressing it when a compressor is configured.
+
+        A compressed message has content type application/gzip or application/zstd;
+        it decompresses to text in UTF-8 (str messages) or the sender's charset (raw
+        bytes). The trace context of a traced message is set as message properties.
+        """
+        assert isinstance(msg, (str, bytes, memoryview))
+
+        # Only traced messages carry properties.
+        properties = {"properties": trace_context} if trace_context else {}
+        if self.compressor is not None:
+            data, content_encoding = await self.compressor.compress(
+                msg.encode() if isinstance(msg, str) else msg
+            )
+            if content_encoding:
+                return CloudMessage(
+                    data=bytes(data), content_type=f"application/{content_encoding}", **properties
+                )
+
+        if isinstance(msg, str):
+            return CloudMessage(data=msg,content_type="text/plain", **properties)
+
+        # Raw bytes are sent in the sender's charset, as received.
+        return CloudMessage(
+            data=bytes(msg),
+            content_type=f"text/plain; charset={encoding or listener_settings.HL7_MLLP_ENCODING}",
+            **properties
         )
 
-        async with create_client(CloudClient.AZURE_ASYNC_SERVICE_BUS,
-                                 **{"namespace":msgr_config.settings.MSG_NAMESPACE
-                                    }) as client:
-            message_to_send = CloudMessage(data=to_send,content_type="text/plain")
-            await client.send_message(msgr_config.settings.OUTBOUND_QUEUE_NAME,message_to_send,timeout=5)
-            logger.info("Sent message to Cloud", logging_code="HL7LLOG010")
+    async def send_on_pooled_client(
+        self, messages_to_send: List[CloudMessage], destination: Optional[str] = None
+    ) -> None:
+        if self._senders is None:
+            await self.connect()
+        senders = self._senders
+        sender = await senders.get()
+        try:
+            if sender.is_open:
+                try:
+                    await self._send(sender, messages_to_send, destination)
+                    self.warm_sends += 1
+                    metrics.CLOUD_SENDS["warm"].inc()
+                    return
+                except Exception as exp:
+                    logger.warning(
+                        "Cloud send failed, reconnecting the client",
+                        logging_code="HL7LERR010",
+                        exception=exp
+                    )
+                    await sender.close()
+            await sender.open()
+            await self._send(sender, messages_to_send, destination)
+            self.cold_sends += 1
+            metrics.CLOUD_SENDS["cold"].inc()
+        except Exception:
+            await sender.close()
+            raise
+        finally:
+            senders.put_nowait(sender)
+
+    async def _send(
+        self,
+        sender: PooledSender,
+        messages_to_send: List[CloudMessage],
+        destination: Optional[str] = None,
+    ) -> None:
+        queue_name = destination or msgr_config.settings.OUTBOUND_QUEUE_NAME
+        started = time.perf_counter()
+        if len(messages_to_send) == 1:
+            await sender.client.send_message(queue_name,messages_to_send[0],timeout=_SEND_TIMEOUT_S)
+        else:
+            await sender.send_batch(queue_name, messages_to_send)
+        metrics.BROKER_SEND_SECONDS["cloud"].observe(time.perf_counter() - started)
+        logger.info("Sent message to Cloud", logging_code="HL7LLOG010")
@@ -0,0 +1,83 @@
+"""Optional compression of large outbound payloads.
+
+ORU messages carrying base64 documents in OBX-5 compress very well, and broker
+storage, egress and the JetStream max message size are all paid per byte. Payloads
+of at least min_bytes are compressed with gzip or, if the zstandard package is
+installed, zstd; the messagers mark them with a Content-Encoding header (NATS) or
+content type (Cloud). Payloads of offload_bytes or more are compressed in the
+default executor so the event loop keeps serving other connections.
+"""
+import asyncio
+import threading
+import time
+import zlib
+from typing import (
+    Optional,
+    Tuple,
+    Union,
+)
+
+from hl7_listener import metrics
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+GZIP = "gzip"
+ZSTD = "zstd"
+_DEFAULT_LEVELS = {GZIP: 6, ZSTD: 3}
+# Window bits selecting the gzip container for zlib.
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class Compressor:
+    def __init__(
+        self,
+        algorithm: str,
+        min_bytes: int,
+        offload_bytes: int,
+        level: Optional[int] = None,
+    ):
+        if algorithm not in _DEFAULT_LEVELS:
+            raise ValueError(f"Unsupported compression algorithm {algorithm!r}")
+        if algorithm == ZSTD and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        self.algorithm = algorithm
+        self.min_bytes = min_bytes
+        self.offload_bytes = offload_bytes
+        self.level = _DEFAULT_LEVELS[algorithm] if level is None else level
+        # zstd compression contexts are reused, one per thread, since compressions
+        # run both on the event loop and in the executor.
+        self._contexts = threading.local()
+
+    def _compress(self, data: Union[bytes, memoryview]) -> bytes:
+        if self.algorithm == ZSTD:
+            context = getattr(self._contexts, "zstd", None)
+            if context is None:
+                context = self._contexts.zstd = zstandard.ZstdCompressor(level=self.level)
+            return context.compress(data)
+        # zlib contexts cannot be reset after a flush, so gzip gets a new one each time.
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, _GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    async def compress(
+        self, data: Union[bytes, memoryview]
+    ) -> Tuple[Union[bytes, memoryview], Optional[str]]:
+        """Return the payload to send and its content encoding, None if sent as is."""
+        size = len(data)
+        if size < self.min_bytes:
+            return data, None
+        started = time.perf_counter()
+        if size >= self.offload_bytes:
+            compressed = await asyncio.get_running_loop().run_in_executor(
+                None, self._compress, data
+            )
+        else:
+            compressed = self._compress(data)
+        metrics.COMPRESSION_SECONDS.observe(time.perf_counter() - started)
+        if len(compressed) >= size:
+            return data, None
+        metrics.COMPRESSION_INPUT_BYTES.inc(size)
+        metrics.COMPRESSION_OUTPUT_BYTES.inc(len(compressed))
+        return compressed, self.algorithm
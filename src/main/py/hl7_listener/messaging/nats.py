@@ -1,4 +1,13 @@
+import asyncio
+import codecs
+import time
+import uuid
+from functools import lru_cache
 from typing import (
+    BinaryIO,
+    Dict,
+    List,
+    Optional,
     Union,
 )
 
@@ -6,15 +15,75 @@ from covera.loglib import configure_get_logger
 from covera.tracelib import traced
 from nats.aio.client import Client as NATS
 from nats.aio.errors import ErrNoServers
+from nats.errors import (
+    BadSubjectError,
+    ConnectionClosedError,
+    ConnectionDrainingError,
+    ConnectionReconnectingError,
+    MaxPayloadError,
+    NoRespondersError,
+    NoServersError,
+    OutboundBufferLimitError,
+    StaleConnectionError,
+)
+from nats.js import JetStreamContext
+from nats.js.errors import (
+    BadRequestError,
+    BucketNotFoundError,
+    NoStreamResponseError,
+    ServiceUnavailableError,
+)
+from nats.js.object_store import ObjectStore
 
 import hl7_listener.messaging.settings as msgr_config
-from hl7_listener.messaging.base import MessagingInterface
+from hl7_listener import (
+    metrics,
+    tracing,
+)
+from hl7_listener.messaging.base import (
+    MessagingInterface,
+    OutboundMessage,
+)
+from hl7_listener.messaging.compression import Compressor
+from hl7_listener.settings import settings as listener_settings
 
 logger = configure_get_logger()
 PILOT_HEADER = {"record_id": "pilot:pilot", "payload_type": "hl7", "trigger": "pilot"}
+MSG_ID_HEADER = "Nats-Msg-Id"
+CONTENT_TYPE_HEADER = "Content-Type"
+CONTENT_ENCODING_HEADER = "Content-Encoding"
+# Headers of the claim check published for a message sent through the object store.
+OBJECT_BUCKET_HEADER = "HL7-Object-Bucket"
+OBJECT_NAME_HEADER = "HL7-Object-Name"
+OBJECT_SIZE_HEADER = "HL7-Object-Size"
+OBJECT_DIGEST_HEADER = "HL7-Object-Digest"
+# Send errors meaning the server or stream could not be reached. OSError includes
+# socket errors and timeouts.
+UNAVAILABLE_ERRORS = (
+    ConnectionClosedError,
+    ConnectionDrainingError,
+    ConnectionReconnectingError,
+    NoRespondersError,
+    NoServersError,
+    NoStreamResponseError,
+    OutboundBufferLimitError,
+    ServiceUnavailableError,
+    StaleConnectionError,
+    OSError,
+)
+# Send errors meaning the server refused the message itself.
+REJECTED_ERRORS = (BadRequestError, BadSubjectError, MaxPayloadError)
 
 
 class NATSMessager(MessagingInterface):
+    conn: Optional[NATS] = None
+    # Set when NATS_JETSTREAM_ENABLED; messages are then published through JetStream
+    # with at most NATS_PUBACK_WINDOW PubAcks outstanding.
+    js: Optional[JetStreamContext] = None
+    # Set when COMPRESSION_ALGORITHM is configured.
+    compressor: Optional[Compressor] = None
+    # Opened on the first large message.
+    _object_store: Optional[ObjectStore] = None
 
     @traced
     async def connect(self) -> bool:
@@ -27,6 +96,9 @@ class NATSMessager(MessagingInterface):
                 logging_code="HL7LLOG006",
                 nats_server_url=msgr_config.settings.NATS_SERVER_URL
             )
+            if msgr_config.settings.NATS_JETSTREAM_ENABLED:
+                self.js = self.conn.jetstream(timeout=msgr_config.settings.NATS_PUBLISH_TIMEOUT)
+                self._puback_window = asyncio.Semaphore(msgr_config.settings.NATS_PUBACK_WINDOW)
             return True
 
         except ErrNoServers as exp:
@@ -37,33 +109,203 @@ class NATSMessager(MessagingInterface):
             )
             raise exp
 
-    @traced
-    async def send_msg(self, msg: Union[str, bytes]) -> None:
+    async def close(self) -> None:
+        """Drain and close the NATS connection.
+
+        Draining flushes what is still buffered for the server and lets the replies
+        of outstanding requests arrive before the connection closes.
+        """
+        if self.conn is None:
+            return
+        if self.conn.is_connected:
+            await self.conn.drain()
+        else:
+            await self.conn.close()
+
+    def is_unavailable(self, exp: Exception) -> bool:
+        return isinstance(exp, UNAVAILABLE_ERRORS)
+
+    def is_rejected(self, exp: Exception) -> bool:
+        return isinstance(exp, REJECTED_ERRORS)
+
+    async def send_msg(
+        self,
+        msg: Union[str, bytes, memoryview],
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
         """Synchronously (no callback or async ACK) send the input message to the NATS
         configured Subject.
 
+        In JetStream mode the message is published through the JetStream context with
+        msg_id as its Nats-Msg-Id, and this returns once its own PubAck arrived.
+
         Note: An Exception will result if the send times out or fails for other reasons.
         """
-        assert isinstance(msg, (str, bytes))
+        logger.info("Sending message to the NATS JetStream server", logging_code="HL7LLOG007")
+
+        with tracing.child_span("nats.publish"):
+            send_response = await self.publish(
+                msg, msg_id, destination, tracing.trace_context(), encoding=encoding
+            )
+        logger.info(
+            "Response from NATS request for sending an HL7 message",
+            logging_code="HL7LLOG008",
+            send_response=send_response
+        )
+
+    async def send_batch(self, msgs: List[OutboundMessage]) -> None:
+        """Send the messages as a burst of pipelined requests (or JetStream publishes)
+        on the one connection and wait for every reply.
+
+        Note: An Exception will result if any of the sends times out or fails.
+        """
+        logger.info(
+            "Sending message batch to the NATS JetStream server",
+            logging_code="HL7LLOG014",
+            batch_size=len(msgs)
+        )
+        await asyncio.gather(*(
+            self.publish(
+                msg.msg, msg.msg_id, msg.destination, msg.trace_context, encoding=msg.encoding
+            )
+            for msg in msgs
+        ))
+
+    @property
+    def supports_streaming(self) -> bool:
+        # Large messages go through a JetStream object store.
+        return self.js is not None
+
+    async def send_stream(
+        self,
+        stream: BinaryIO,
+        size: int,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+    ) -> None:
+        """Put a large message into the NATS_OBJECT_STORE_BUCKET object store and publish
+        a claim check for it.
+
+        The object store splits the message into chunk messages as it reads the
+        stream, so the message is never held in memory whole. The claim check is an
+        empty message published like any other (subject, Nats-Msg-Id), with headers
+        naming the bucket and object; consumers read the message with
+        object_store(bucket).get(name).
+        """
+        logger.info(
+            "Sending large message to the NATS JetStream object store",
+            logging_code="HL7LLOG026",
+            size=size
+        )
+        store = await self.object_store()
+        name = uuid.uuid4().hex
+        with tracing.child_span("nats.object_store.put"):
+            info = await store.put(name, stream)
+        claim_check = {
+            OBJECT_BUCKET_HEADER: msgr_config.settings.NATS_OBJECT_STORE_BUCKET,
+            OBJECT_NAME_HEADER: name,
+            OBJECT_SIZE_HEADER: str(info.size),
+            OBJECT_DIGEST_HEADER: info.digest,
+        }
+        with tracing.child_span("nats.publish"):
+            await self.publish("", msg_id, destination, tracing.trace_context(), claim_check)
+
+    async def object_store(self) -> ObjectStore:
+        if self._object_store is None:
+            bucket = msgr_config.settings.NATS_OBJECT_STORE_BUCKET
+            try:
+                self._object_store = await self.js.object_store(bucket)
+            except BucketNotFoundError:
+                self._object_store = await self.js.create_object_store(bucket)
+        return self._object_store
+
+    async def publish(
+        self,
+        msg: Union[str, bytes, memoryview],
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        trace_context: Optional[Dict[str, str]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        encoding: Optional[str] = None,
+    ):
+        kwargs = self.request_kwargs(msg, destination, encoding)
+        if self.compressor is not None:
+            kwargs["payload"], content_encoding = await self.compressor.compress(kwargs["payload"])
+            if content_encoding:
+                kwargs["headers"] = {
+                    **(kwargs.get("headers") or {}), CONTENT_ENCODING_HEADER: content_encoding
+                }
+        if trace_context:
+            # traceparent/tracestate, for consumers continuing the message's trace.
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **trace_context}
+        if headers:
+            kwargs["headers"] = {**(kwargs.get("headers") or {}), **headers}
+
+        started = time.perf_counter()
+        if self.js is None:
+            response = await self.conn.request(**kwargs)
+            metrics.BROKER_SEND_SECONDS["nats"].observe(time.perf_counter() - started)
+            return response
+
+        headers = dict(kwargs.get("headers") or {})
+        if msg_id:
+            # Lets the stream's duplicate window drop messages the HL7 sender
+            # retransmitted after a slow ACK.
+            headers[MSG_ID_HEADER] = msg_id
+        kwargs["headers"] = headers or None
+        kwargs["timeout"] = msgr_config.settings.NATS_PUBLISH_TIMEOUT
+        async with self._puback_window:
+            metrics.NATS_PUBACKS_OUTSTANDING.inc()
+            try:
+                pub_ack = await self.js.publish(**kwargs)
+            finally:
+                metrics.NATS_PUBACKS_OUTSTANDING.dec()
+        metrics.BROKER_SEND_SECONDS["nats"].observe(time.perf_counter() - started)
+        if pub_ack.duplicate:
+            logger.info(
+                "NATS JetStream dropped a duplicate HL7 message",
+                logging_code="HL7LLOG016",
+                stream=pub_ack.stream,
+                seq=pub_ack.seq
+            )
+        return pub_ack
+
+    def request_kwargs(
+        self,
+        msg: Union[str, bytes, memoryview],
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> dict:
+        assert isinstance(msg, (str, bytes, memoryview))
 
         to_send = msg
+        headers = None
         if isinstance(msg, str):
             to_send = msg.encode()
-
-        logger.info("Sending message to the NATS JetStream server", logging_code="HL7LLOG007")
+        else:
+            # Raw bytes are sent in the sender's charset, as received.
+            headers = charset_headers(encoding or listener_settings.HL7_MLLP_ENCODING)
 
         kwargs = {
-            "subject": msgr_config.settings.NATS_OUTGOING_SUBJECT,
+            "subject": destination or msgr_config.settings.NATS_OUTGOING_SUBJECT,
             "payload": to_send,
             "timeout": 10,
         }
 
         if msgr_config.settings.PILOT_MODE:
-            kwargs["headers"] = PILOT_HEADER
+            headers = {**PILOT_HEADER, **headers} if headers else PILOT_HEADER
 
-        send_response = await self.conn.request(**kwargs)
-        logger.info(
-            "Response from NATS request for sending an HL7 message",
-            logging_code="HL7LLOG008",
-            send_response=send_response
-        )
+        if headers:
+            kwargs["headers"] = headers
+
+        return kwargs
+
+
+@lru_cache
+def charset_headers(encoding: str) -> Optional[dict]:
+    """Headers telling consumers the payload's charset, unless it is UTF-8."""
+    if codecs.lookup(encoding).name == "utf-8":
+        return None
+    return {CONTENT_TYPE_HEADER: f"text/plain; charset={encoding}"}
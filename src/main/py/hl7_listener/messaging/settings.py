@@ -7,13 +7,18 @@ from hl7_listener.settings import (
     settings as settings_
 )
 
+import hl7_listener.messaging.batching as _batching
 import hl7_listener.messaging.cloud_messaging as _cloud_messaging
+import hl7_listener.messaging.compression as _compression
 import hl7_listener.messaging.nats as _nats
+import hl7_listener.messaging.spool as _spool
 
 
 class CloudMessagingSettings(BaseSettings):
     OUTBOUND_QUEUE_NAME: Optional[str] = None
     MSG_NAMESPACE:Optional[str] = None
+    # Number of long-lived Service Bus clients shared by all connections.
+    CLOUD_SENDER_POOL_SIZE: int = 4
 
     _instance: ClassVar["CloudMessagingSettings"] = None
 
@@ -28,6 +33,14 @@ class NATSSettings(BaseSettings):
     NATS_OUTGOING_SUBJECT: str = "HL7.MESSAGES"
     NATS_SERVER_URL: Optional[str] = None
     PILOT_MODE: bool = False
+    # Publish through JetStream (PubAck per message, Nats-Msg-Id dedupe) instead of
+    # core NATS request/reply.
+    NATS_JETSTREAM_ENABLED: bool = False
+    NATS_PUBACK_WINDOW: int = 256
+    NATS_PUBLISH_TIMEOUT: float = 10
+    # JetStream object store holding messages above HL7_STREAM_THRESHOLD_BYTES;
+    # created if missing.
+    NATS_OBJECT_STORE_BUCKET: str = "HL7_LARGE_MESSAGES"
 
     _instance: ClassVar["NATSSettings"] = None
 
@@ -45,4 +58,35 @@ MESSAGER_CONFIG_MAP = {
 
 
 settings = MESSAGER_CONFIG_MAP[settings_.OUTBOUND_QUEUE_TYPE]["settings"]
-messager = MESSAGER_CONFIG_MAP[settings_.OUTBOUND_QUEUE_TYPE]["messager"]()
\ No newline at end of file
+messager = MESSAGER_CONFIG_MAP[settings_.OUTBOUND_QUEUE_TYPE]["messager"]()
+
+if settings_.COMPRESSION_ALGORITHM:
+    messager.compressor = _compression.Compressor(
+        algorithm=settings_.COMPRESSION_ALGORITHM,
+        min_bytes=settings_.COMPRESSION_MIN_BYTES,
+        offload_bytes=settings_.COMPRESSION_OFFLOAD_BYTES,
+        level=settings_.COMPRESSION_LEVEL,
+    )
+
+if settings_.BATCH_ENABLED:
+    messager = _batching.BatchingMessager(
+        messager,
+        max_messages=settings_.BATCH_MAX_MESSAGES,
+        max_bytes=settings_.BATCH_MAX_BYTES,
+        max_delay_ms=settings_.BATCH_MAX_DELAY_MS,
+    )
+
+if settings_.SPOOL_ENABLED:
+    messager = _spool.SpoolingMessager(
+        messager,
+        _spool.Spool(
+            directory=settings_.SPOOL_DIR,
+            segment_bytes=settings_.SPOOL_SEGMENT_BYTES,
+            max_bytes=settings_.SPOOL_MAX_BYTES,
+            commit_interval_ms=settings_.SPOOL_COMMIT_INTERVAL_MS,
+        ),
+        drain_batch=settings_.SPOOL_DRAIN_BATCH,
+        retry_initial_s=settings_.SPOOL_RETRY_INITIAL_S,
+        retry_max_s=settings_.SPOOL_RETRY_MAX_S,
+        max_attempts=settings_.SPOOL_MAX_ATTEMPTS,
+    )
@@ -0,0 +1,550 @@
+import asyncio
+import mmap
+import os
+import struct
+import zlib
+from typing import (
+    Any,
+    List,
+    NamedTuple,
+    Optional,
+)
+
+from covera.loglib import configure_get_logger
+
+from hl7_listener.messaging.base import (
+    MessagingInterface,
+    OutboundMessage,
+)
+
+logger = configure_get_logger()
+
+# Record header: body length, CRC32 of the body, msg_id length, destination length,
+# flags. The body is the msg_id and the destination followed by the payload.
+_RECORD_HEADER = struct.Struct("<IIHHB")
+# The payload was a str and is stored UTF-8 encoded.
+_FLAG_TEXT = 0x01
+# The payload is raw bytes with a charset of their own, stored before the payload
+# as one length byte and the charset name.
+_FLAG_ENCODING = 0x02
+# Index file: segment number and offset of the first undelivered record.
+_CURSOR = struct.Struct("<QQ")
+_SEGMENT_SUFFIX = ".seg"
+_INDEX_FILE = "index"
+# Records that could not be delivered, in the segment record format.
+DEAD_LETTER_FILE = "dead-letter"
+
+
+class SpoolFullError(Exception):
+    pass
+
+
+class SpoolFailedError(Exception):
+    pass
+
+
+class SpoolPosition(NamedTuple):
+    segment: int
+    offset: int
+
+
+class SpoolBatch(NamedTuple):
+    messages: List[OutboundMessage]
+    # Position right after the last message of the batch.
+    end: SpoolPosition
+    size: int
+
+
+def _fsync(fds: List[int], directory: Optional[str]) -> None:
+    for fd in fds:
+        os.fsync(fd)
+    if directory:
+        # Make newly created segment files durable too.
+        dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+def _append_durably(path: str, parts: List[bytes]) -> None:
+    with open(path, "ab") as file:
+        for part in parts:
+            file.write(part)
+        file.flush()
+        os.fsync(file.fileno())
+
+
+def _record_parts(
+    msg: Any,
+    msg_id: Optional[str] = None,
+    destination: Optional[str] = None,
+    encoding: Optional[str] = None,
+) -> List[bytes]:
+    """Encode a message as a record, in parts that are written one after another.
+
+    The payload is not copied into the record, as it can be large.
+    """
+    flags = 0
+    payload = msg
+    # Counted as part of the payload in the record header.
+    charset = b""
+    if isinstance(msg, str):
+        payload = msg.encode()
+        flags |= _FLAG_TEXT
+    elif encoding:
+        charset = bytes([len(encoding)]) + encoding.encode()
+        flags |= _FLAG_ENCODING
+    msg_id_bytes = (msg_id or "").encode()
+    destination_bytes = (destination or "").encode()
+    length = len(msg_id_bytes) + len(destination_bytes) + len(charset) + len(payload)
+    crc = zlib.crc32(
+        payload, zlib.crc32(charset, zlib.crc32(destination_bytes, zlib.crc32(msg_id_bytes)))
+    )
+    return [
+        _RECORD_HEADER.pack(length, crc, len(msg_id_bytes), len(destination_bytes), flags),
+        msg_id_bytes,
+        destination_bytes,
+        charset,
+        payload,
+    ]
+
+
+def _valid_length(path: str) -> int:
+    """Length of the leading run of complete, uncorrupted records in a segment."""
+    offset = 0
+    with open(path, "rb") as segment:
+        while True:
+            header = segment.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                return offset
+            length, crc, _, _, _ = _RECORD_HEADER.unpack(header)
+            body = segment.read(length)
+            if len(body) < length or zlib.crc32(body) != crc:
+                return offset
+            offset += _RECORD_HEADER.size + length
+
+
+class Spool:
+    """Append-only on-disk log of messages that were accepted but not yet delivered.
+
+    Messages are appended to numbered segment files, and a new segment is started
+    once the current one reaches segment_bytes. Appends are fsync'd in groups: every
+    append waits for the next commit, which flushes and fsyncs everything appended
+    since the previous one. The position of the first undelivered message is kept
+    in a memory-mapped index file, so delivery progress survives a restart without
+    a write per message. Fully delivered segments are deleted.
+
+    When a commit fails, the records appended since the previous one are cut off
+    the spool again, so the messages whose appends failed are never delivered. If
+    that fails too, the spool rejects all further appends.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        segment_bytes: int,
+        max_bytes: int,
+        commit_interval_ms: float,
+    ):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.commit_interval = commit_interval_ms / 1000
+        self.records_committed = asyncio.Event()
+        self.undelivered_bytes = 0
+        # Exception that left the spool unusable, see _roll_back().
+        self.failure: Optional[Exception] = None
+        self._uncommitted_bytes = 0
+        self._index: Optional[mmap.mmap] = None
+        self._file = None
+        self._sealed = []
+        self._segment = 0
+        self._write_offset = 0
+        self._oldest_segment = 0
+        self._committed = SpoolPosition(0, 0)
+        self._delivered = SpoolPosition(0, 0)
+        self._pending: List[asyncio.Future] = []
+        self._commit_requested = asyncio.Event()
+        self._reader = None
+        self._reader_segment = None
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:012d}{_SEGMENT_SUFFIX}")
+
+    def open(self) -> None:
+        """Open the spool, picking up whatever a previous run left undelivered."""
+        os.makedirs(self.directory, exist_ok=True)
+        index_fd = os.open(os.path.join(self.directory, _INDEX_FILE), os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(index_fd).st_size < _CURSOR.size:
+                os.ftruncate(index_fd, _CURSOR.size)
+            self._index = mmap.mmap(index_fd, _CURSOR.size)
+        finally:
+            os.close(index_fd)
+
+        segments = sorted(
+            int(name[:-len(_SEGMENT_SUFFIX)])
+            for name in os.listdir(self.directory)
+            if name.endswith(_SEGMENT_SUFFIX)
+        )
+        delivered = SpoolPosition(*_CURSOR.unpack_from(self._index))
+        if not segments:
+            segments = [max(delivered.segment, 1)]
+        if delivered.segment < segments[0]:
+            delivered = SpoolPosition(segments[0], 0)
+        for segment in segments:
+            if segment < delivered.segment:
+                os.remove(self.segment_path(segment))
+        segments = [segment for segment in segments if segment >= delivered.segment]
+
+        # A crash can leave a partly written record at the end of the last segment.
+        self._segment = segments[-1]
+        path = self.segment_path(self._segment)
+        if os.path.exists(path):
+            valid_length = _valid_length(path)
+            if valid_length < os.path.getsize(path):
+                os.truncate(path, valid_length)
+        self._file = open(path, "ab")
+        self._write_offset = self._file.tell()
+
+        self._oldest_segment = delivered.segment
+        self._delivered = delivered
+        self._committed = SpoolPosition(self._segment, self._write_offset)
+        self.undelivered_bytes = sum(
+            os.path.getsize(self.segment_path(segment)) for segment in segments
+        ) - delivered.offset
+        self.records_committed.set()
+        logger.info(
+            "Opened message spool",
+            logging_code="HL7LLOG017",
+            spool_dir=self.directory,
+            undelivered_bytes=self.undelivered_bytes
+        )
+
+    async def append(
+        self,
+        msg: Any,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
+        """Append a message and return once it has been fsync'd."""
+        if self.failure is not None:
+            raise SpoolFailedError("Spool failed, see the previous errors") from self.failure
+        record = _record_parts(msg, msg_id, destination, encoding)
+        size = sum(len(part) for part in record)
+        if self.undelivered_bytes + size > self.max_bytes:
+            raise SpoolFullError(f"Spool holds {self.undelivered_bytes} undelivered bytes")
+
+        if self._write_offset >= self.segment_bytes:
+            self._rotate()
+        for part in record:
+            self._file.write(part)
+        self._write_offset += size
+        self.undelivered_bytes += size
+        self._uncommitted_bytes += size
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(future)
+        self._commit_requested.set()
+        await future
+
+    def _rotate(self) -> None:
+        # The full segment is fsync'd and closed by the next commit.
+        self._sealed.append(self._file)
+        self._segment += 1
+        self._write_offset = 0
+        self._file = open(self.segment_path(self._segment), "ab")
+
+    async def run_commits(self) -> None:
+        """Commit appended messages for as long as the spool is open."""
+        while True:
+            await self._commit_requested.wait()
+            if self.commit_interval:
+                # Give concurrent appends a moment to join this commit.
+                await asyncio.sleep(self.commit_interval)
+            await self.commit()
+
+    async def commit(self) -> None:
+        self._commit_requested.clear()
+        if self.failure is not None:
+            return
+        files, self._sealed = self._sealed + [self._file], []
+        pending, self._pending = self._pending, []
+        uncommitted, self._uncommitted_bytes = self._uncommitted_bytes, 0
+        committed = SpoolPosition(self._segment, self._write_offset)
+        try:
+            for file in files:
+                file.flush()
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                _fsync,
+                [file.fileno() for file in files],
+                self.directory if len(files) > 1 else None,
+            )
+        except Exception as exp:
+            self._roll_back(pending, uncommitted, exp)
+            return
+        finally:
+            for file in files[:-1]:
+                file.close()
+
+        self._committed = committed
+        self.records_committed.set()
+        for future in pending:
+            if not future.done():
+                future.set_result(None)
+
+    def _roll_back(self, pending: List[asyncio.Future], uncommitted: int, exp: Exception) -> None:
+        """Fail the appends since the last commit and truncate the spool back to it.
+
+        That includes the appends made while the failed commit was running. Their
+        records must go: the next successful commit would otherwise cover them, and
+        messages whose senders got an error would be delivered.
+        """
+        pending += self._pending
+        self._pending = []
+        self.undelivered_bytes -= uncommitted + self._uncommitted_bytes
+        self._uncommitted_bytes = 0
+        for future in pending:
+            if not future.done():
+                future.set_exception(exp)
+        committed = self._committed
+        logger.error(
+            "Could not commit the message spool, rolled back its uncommitted messages",
+            logging_code="HL7LERR015",
+            rejected_messages=len(pending),
+            exception=exp
+        )
+        try:
+            for file in self._sealed + [self._file]:
+                file.close()
+            self._sealed = []
+            for segment in range(committed.segment + 1, self._segment + 1):
+                os.remove(self.segment_path(segment))
+            path = self.segment_path(committed.segment)
+            os.truncate(path, committed.offset)
+            self._file = open(path, "ab")
+        except OSError as rollback_exp:
+            self.failure = rollback_exp
+            logger.error(
+                "Could not roll back the message spool, rejecting all messages",
+                logging_code="HL7LERR016",
+                exception=rollback_exp
+            )
+            return
+        self._segment, self._write_offset = committed
+
+    def read_batch(self, max_messages: int) -> SpoolBatch:
+        """Read up to max_messages committed messages, oldest undelivered first."""
+        position = self._delivered
+        messages = []
+        size = 0
+        while len(messages) < max_messages and position < self._committed:
+            if self._reader_segment != position.segment:
+                if self._reader:
+                    self._reader.close()
+                self._reader = open(self.segment_path(position.segment), "rb")
+                self._reader_segment = position.segment
+                self._reader.seek(position.offset)
+            elif not messages:
+                self._reader.seek(position.offset)
+            header = self._reader.read(_RECORD_HEADER.size)
+            if len(header) < _RECORD_HEADER.size:
+                # End of a full segment; continue with the next one.
+                position = SpoolPosition(position.segment + 1, 0)
+                continue
+            length, _, msg_id_length, destination_length, flags = _RECORD_HEADER.unpack(header)
+            body = self._reader.read(length)
+            destination_end = payload_start = msg_id_length + destination_length
+            encoding = None
+            if flags & _FLAG_ENCODING:
+                encoding_length = body[payload_start]
+                encoding = body[payload_start + 1:payload_start + 1 + encoding_length].decode()
+                payload_start += 1 + encoding_length
+            payload = body[payload_start:]
+            messages.append(OutboundMessage(
+                msg=payload.decode() if flags & _FLAG_TEXT else payload,
+                msg_id=body[:msg_id_length].decode() or None,
+                destination=body[msg_id_length:destination_end].decode() or None,
+                encoding=encoding,
+            ))
+            position = SpoolPosition(position.segment, position.offset + _RECORD_HEADER.size + length)
+            size += _RECORD_HEADER.size + length
+        return SpoolBatch(messages, position, size)
+
+    def mark_delivered(self, batch: SpoolBatch) -> None:
+        """Move the delivery cursor past a batch and drop fully delivered segments."""
+        _CURSOR.pack_into(self._index, 0, *batch.end)
+        self._delivered = batch.end
+        self.undelivered_bytes -= batch.size
+        while self._oldest_segment < batch.end.segment:
+            if self._reader_segment == self._oldest_segment:
+                self._reader.close()
+                self._reader = self._reader_segment = None
+            os.remove(self.segment_path(self._oldest_segment))
+            self._oldest_segment += 1
+
+    async def dead_letter(self, message: OutboundMessage) -> None:
+        """Append an undeliverable message to the dead-letter file and fsync it."""
+        await asyncio.get_running_loop().run_in_executor(
+            None,
+            _append_durably,
+            os.path.join(self.directory, DEAD_LETTER_FILE),
+            _record_parts(message.msg, message.msg_id, message.destination, message.encoding),
+        )
+
+    async def close(self) -> None:
+        if self._file is None:
+            return
+        await self.commit()
+        self._file.close()
+        self._file = None
+        if self._reader:
+            self._reader.close()
+            self._reader = self._reader_segment = None
+        self._index.flush()
+        self._index.close()
+
+
+class SpoolingMessager(MessagingInterface):
+    """Accepts messages into a local Spool and delivers them in the background.
+
+    send_msg returns once the message is durable on local disk, so the HL7 sender is
+    ACKed without waiting on the broker. A background task forwards spooled messages
+    in order, in batches, to the wrapped messager and retries with exponential
+    backoff while the broker is unavailable. Messages still in the spool at shutdown
+    are delivered after the next start.
+
+    A batch the broker rejects, or that fails max_attempts times for other reasons
+    than the broker being unavailable, is split in halves that are sent on their
+    own. A single message that cannot be delivered is moved to the spool's
+    dead-letter file, so it does not hold up the messages behind it.
+    """
+
+    def __init__(
+        self,
+        messager: MessagingInterface,
+        spool: Spool,
+        drain_batch: int,
+        retry_initial_s: float,
+        retry_max_s: float,
+        max_attempts: int,
+    ):
+        self.messager = messager
+        self.spool = spool
+        self.drain_batch = drain_batch
+        self.retry_initial = retry_initial_s
+        self.retry_max = retry_max_s
+        self.max_attempts = max_attempts
+        self._tasks: List[asyncio.Task] = []
+
+    @property
+    def conn(self):
+        return self.messager.conn
+
+    async def connect(self) -> bool:
+        """Open the spool and start delivering; the broker may still be unavailable."""
+        self.spool.open()
+        self._tasks = [
+            asyncio.create_task(self.spool.run_commits()),
+            asyncio.create_task(self.drain()),
+        ]
+        return True
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self.spool.close()
+        await self.messager.close()
+
+    async def send_msg(
+        self,
+        msg: Any,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
+        await self.spool.append(msg, msg_id, destination, encoding)
+
+    async def drain(self) -> None:
+        await self.retry(self.messager.connect)
+        batch_limit = self.drain_batch
+        # End of the batch that could not be delivered. Up to there, messages are sent
+        # in ever smaller batches, until the ones failing are found.
+        narrowed_until: Optional[SpoolPosition] = None
+        while True:
+            self.spool.records_committed.clear()
+            batch = self.spool.read_batch(batch_limit)
+            if not batch.messages:
+                await self.spool.records_committed.wait()
+                continue
+            delivered = await self.retry(
+                self.messager.send_batch, batch.messages, max_attempts=self.max_attempts
+            )
+            if not delivered and len(batch.messages) > 1:
+                batch_limit = len(batch.messages) // 2
+                if narrowed_until is None:
+                    narrowed_until = batch.end
+                continue
+            if not delivered:
+                message = batch.messages[0]
+                await self.retry(self.spool.dead_letter, message)
+                logger.error(
+                    "Moved an undeliverable message to the dead-letter file",
+                    logging_code="HL7LERR018",
+                    msg_id=message.msg_id,
+                    destination=message.destination,
+                    dead_letter_file=os.path.join(self.spool.directory, DEAD_LETTER_FILE)
+                )
+            self.spool.mark_delivered(batch)
+            if narrowed_until is not None and batch.end >= narrowed_until:
+                batch_limit, narrowed_until = self.drain_batch, None
+
+    async def retry(self, operation, *args, max_attempts: Optional[int] = None) -> bool:
+        """Run operation until it succeeds, backing off exponentially between tries.
+
+        With max_attempts, gives up and returns False once operation failed that many
+        times, not counting failures the wrapped messager reports as the broker being
+        unavailable, or at once when it reports the messages as rejected.
+        """
+        delay = self.retry_initial
+        failed = False
+        attempts = 0
+        while True:
+            try:
+                await operation(*args)
+            except Exception as exp:
+                if max_attempts is not None:
+                    rejected = self.messager.is_rejected(exp)
+                    if not rejected and not self.messager.is_unavailable(exp):
+                        attempts += 1
+                    if rejected or attempts >= max_attempts:
+                        logger.warning(
+                            "Giving up on delivering a batch from the spool",
+                            logging_code="HL7LERR017",
+                            attempts=attempts,
+                            rejected=rejected,
+                            exception=exp
+                        )
+                        return False
+                logger.warning(
+                    "Delivery from the spool failed, retrying",
+                    logging_code="HL7LERR011",
+                    retry_in_seconds=delay,
+                    undelivered_bytes=self.spool.undelivered_bytes,
+                    exception=exp
+                )
+                failed = True
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.retry_max)
+                continue
+            if failed:
+                logger.info(
+                    "Delivery from the spool resumed",
+                    logging_code="HL7LLOG018",
+                    undelivered_bytes=self.spool.undelivered_bytes
+                )
+            return True
@@ -0,0 +1,381 @@
+"""In-process metrics, served in the Prometheus text format by the health check server.
+
+Metrics are created once at import time and updated in place on the hot path: an
+update is an attribute increment or, for histograms, a bisect into a fixed bucket
+list. Nothing is allocated per message. Rates (messages or bytes per second) are
+derived from the counters by the scraper.
+"""
+import asyncio
+import time
+from bisect import bisect_left
+from typing import (
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+
+# Latency buckets, in seconds, from 50 microseconds to 10 seconds.
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# (metric name, label string, value)
+Sample = Tuple[str, str, float]
+# (metric name, help, type, samples); what a process reports to the supervisor.
+Family = Tuple[str, str, str, List[Sample]]
+
+
+def _labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+
+class Counter:
+    type = "counter"
+    __slots__ = ("name", "help", "labels", "value")
+
+    def __init__(self, name: str, help: str, labels: Optional[Dict[str, str]] = None):
+        self.name = name
+        self.help = help
+        self.labels = _labels(labels or {})
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> Iterator[Sample]:
+        yield self.name, self.labels, self.value
+
+
+class Gauge(Counter):
+    type = "gauge"
+    __slots__ = ()
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Histogram:
+    type = "histogram"
+    __slots__ = ("name", "help", "labels", "buckets", "counts", "sum", "count")
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        labels: Optional[Dict[str, str]] = None,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels or {}
+        self.buckets = tuple(buckets)
+        # One count per bucket plus the +Inf bucket; cumulated when rendered.
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self) -> Iterator[Sample]:
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            yield f"{self.name}_bucket", _labels({**self.labels, "le": le}), cumulative
+        yield f"{self.name}_sum", _labels(self.labels), self.sum
+        yield f"{self.name}_count", _labels(self.labels), self.count
+
+
+class GaugeFamily:
+    """Gauges keyed by one label whose values are only known at runtime (e.g. peers).
+
+    Children are created when a label value is first seen, which happens per
+    connection rather than per message, and are dropped again once back at zero.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.children: Dict[str, Gauge] = {}
+
+    def inc(self, label_value: str) -> None:
+        child = self.children.get(label_value)
+        if child is None:
+            child = self.children[label_value] = Gauge(
+                self.name, self.help, {self.label: label_value}
+            )
+        child.inc()
+
+    def dec(self, label_value: str) -> None:
+        child = self.children.get(label_value)
+        if child is None:
+            return
+        child.dec()
+        if child.value <= 0:
+            del self.children[label_value]
+
+    def samples(self) -> Iterator[Sample]:
+        for child in list(self.children.values()):
+            yield from child.samples()
+
+
+class WaitAgeFamily:
+    """Per label value, the time its waiting items have waited so far, summed.
+
+    Computed when scraped from the start times of the items. A sum rather than the
+    oldest wait, so workers' samples merge; divided by the number of waiting items
+    it is their average wait. Like GaugeFamily's children, a label value is dropped
+    once none of its items wait.
+    """
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, label: str):
+        self.name = name
+        self.help = help
+        self.label = label
+        # label value -> {item: perf_counter() when it started waiting}
+        self.children: Dict[str, Dict[int, float]] = {}
+
+    def start(self, label_value: str, item: int, started: float) -> None:
+        self.children.setdefault(label_value, {})[item] = started
+
+    def stop(self, label_value: str, item: int) -> None:
+        waiting = self.children.get(label_value)
+        if waiting is None:
+            return
+        waiting.pop(item, None)
+        if not waiting:
+            del self.children[label_value]
+
+    def samples(self) -> Iterator[Sample]:
+        now = time.perf_counter()
+        for label_value, waiting in list(self.children.items()):
+            started = list(waiting.values())
+            yield self.name, _labels({self.label: label_value}), now * len(started) - sum(started)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name: str, help: str, **kwargs) -> Histogram:
+        return self.register(Histogram(name, help, **kwargs))
+
+    def snapshot(self) -> List[Family]:
+        return [
+            (metric.name, metric.help, metric.type, list(metric.samples()))
+            for metric in self.metrics
+        ]
+
+    def render(self) -> str:
+        return render(self.snapshot())
+
+
+def render(snapshot: Iterable[Family]) -> str:
+    # The text format requires all samples of a family to follow its HELP and TYPE
+    # lines; families registered more than once (e.g. per feed) are grouped first.
+    families: Dict[str, Tuple[str, str, List[Sample]]] = {}
+    for family, help, type, samples in snapshot:
+        if family not in families:
+            families[family] = (help, type, [])
+        families[family][2].extend(samples)
+    lines = []
+    for family, (help, type, samples) in families.items():
+        lines.append(f"# HELP {family} {help}")
+        lines.append(f"# TYPE {family} {type}")
+        for name, labels, value in samples:
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def merge(snapshots: Iterable[List[Family]]) -> List[Family]:
+    """Sum the samples of several processes' snapshots, series by series."""
+    families: Dict[str, Tuple[str, str, Dict[Tuple[str, str], float]]] = {}
+    for snapshot in snapshots:
+        for family, help, type, samples in snapshot:
+            if family not in families:
+                families[family] = (help, type, {})
+            series = families[family][2]
+            for name, labels, value in samples:
+                series[name, labels] = series.get((name, labels), 0) + value
+    return [
+        (family, help, type, [(name, labels, value) for (name, labels), value in series.items()])
+        for family, (help, type, series) in families.items()
+    ]
+
+
+REGISTRY = Registry()
+
+FRAME_READ_SECONDS = REGISTRY.histogram(
+    "hl7_listener_frame_read_seconds",
+    "Time waiting for the next MLLP frame on a connection, including sender idle time.",
+)
+PARSE_SECONDS = REGISTRY.histogram(
+    "hl7_listener_parse_seconds", "Time reading the MSH header and validating a message."
+)
+PUBLISH_SECONDS = REGISTRY.histogram(
+    "hl7_listener_publish_seconds", "Time until the messager accepted a message."
+)
+ACK_DRAIN_SECONDS = REGISTRY.histogram(
+    "hl7_listener_ack_drain_seconds", "Time writing an ACK and draining it to the sender."
+)
+MESSAGES_RECEIVED = REGISTRY.counter(
+    "hl7_listener_messages_received_total", "HL7 messages received."
+)
+BYTES_RECEIVED = REGISTRY.counter(
+    "hl7_listener_received_bytes_total", "Bytes of HL7 messages received."
+)
+ACTIVE_CONNECTIONS = REGISTRY.register(GaugeFamily(
+    "hl7_listener_active_connections", "Open MLLP connections per sender peer.", "peer"
+))
+ACKS_SENT = {
+    ack_code: REGISTRY.counter(
+        "hl7_listener_acks_total", "ACKs sent, by acknowledgment code.", {"code": ack_code}
+    )
+    for ack_code in ("AA", "AE", "AR")
+}
+PUBLISHES_IN_FLIGHT = REGISTRY.gauge(
+    "hl7_listener_publishes_in_flight", "Messages handed to the messager and not yet accepted."
+)
+ADMITTED_BYTES = REGISTRY.gauge(
+    "hl7_listener_admitted_bytes", "Bytes of the messages being published, across connections."
+)
+ADMISSION_PAUSED = REGISTRY.gauge(
+    "hl7_listener_admission_paused", "1 while reads are paused because in-flight limits were reached."
+)
+CONNECTIONS_REFUSED = REGISTRY.counter(
+    "hl7_listener_connections_refused_total", "Connections closed because of the connection cap."
+)
+EVENT_LOOP_LAG_SECONDS = REGISTRY.histogram(
+    "hl7_listener_event_loop_lag_seconds", "Delay of the event loop in running a due callback."
+)
+BROKER_SEND_SECONDS = {
+    backend: REGISTRY.histogram(
+        "hl7_listener_broker_send_seconds",
+        "Time of one send (message or batch) to the broker.",
+        labels={"backend": backend},
+    )
+    for backend in ("nats", "cloud")
+}
+COMPRESSION_SECONDS = REGISTRY.histogram(
+    "hl7_listener_compression_seconds", "Time compressing one outbound payload."
+)
+COMPRESSION_INPUT_BYTES = REGISTRY.counter(
+    "hl7_listener_compression_input_bytes_total", "Bytes of payloads sent compressed, before compression."
+)
+COMPRESSION_OUTPUT_BYTES = REGISTRY.counter(
+    "hl7_listener_compression_output_bytes_total", "Bytes of payloads sent compressed, after compression."
+)
+OFFLOAD_PENDING = REGISTRY.gauge(
+    "hl7_listener_offload_pending", "Tasks waiting for or running in the offload pool."
+)
+OFFLOAD_QUEUE_SECONDS = REGISTRY.histogram(
+    "hl7_listener_offload_queue_seconds", "Time an offloaded task waited for a slot in the pool."
+)
+OFFLOAD_SECONDS = REGISTRY.histogram(
+    "hl7_listener_offload_seconds", "Time until an offloaded task completed, including the wait."
+)
+LOG_EVENTS_DROPPED = REGISTRY.counter(
+    "hl7_listener_log_events_dropped_total", "Log events dropped because the log queue was full."
+)
+DUPLICATE_LOOKUPS = {
+    result: REGISTRY.counter(
+        "hl7_listener_duplicate_cache_lookups_total",
+        "Duplicate cache lookups, by whether the message was a retransmission (hit) or not (miss).",
+        {"result": result},
+    )
+    for result in ("hit", "miss")
+}
+DUPLICATE_CACHE_ENTRIES = REGISTRY.gauge(
+    "hl7_listener_duplicate_cache_entries", "Messages remembered by the duplicate cache."
+)
+SCHEDULER_QUEUED = REGISTRY.register(GaugeFamily(
+    "hl7_listener_scheduler_queued", "Messages waiting for a send slot, per flow (peer or sending facility).", "flow"
+))
+SCHEDULER_WAITING_SECONDS = REGISTRY.register(WaitAgeFamily(
+    "hl7_listener_scheduler_waiting_seconds", "Time the messages waiting for a send slot have waited so far, summed per flow.", "flow"
+))
+NATS_PUBACKS_OUTSTANDING = REGISTRY.gauge(
+    "hl7_listener_nats_pubacks_outstanding", "JetStream publishes waiting for their PubAck."
+)
+CLOUD_SENDS = {
+    client: REGISTRY.counter(
+        "hl7_listener_cloud_sends_total",
+        "Cloud sends, by whether the pooled client was already open (warm) or not (cold).",
+        {"client": client},
+    )
+    for client in ("warm", "cold")
+}
+
+
+def feed_admission_metrics(feed: str) -> Tuple[Gauge, Gauge, Counter]:
+    """One listener's counterparts of ADMITTED_BYTES, ADMISSION_PAUSED and
+    CONNECTIONS_REFUSED."""
+    labels = {"feed": feed}
+    return (
+        REGISTRY.gauge(
+            "hl7_listener_feed_admitted_bytes",
+            "Bytes of the messages being published, per listener.",
+            labels,
+        ),
+        REGISTRY.gauge(
+            "hl7_listener_feed_admission_paused",
+            "1 while a listener's reads are paused because its in-flight limits were reached.",
+            labels,
+        ),
+        REGISTRY.counter(
+            "hl7_listener_feed_connections_refused_total",
+            "Connections closed because of a listener's connection cap.",
+            labels,
+        ),
+    )
+
+
+def peer_label(peername) -> str:
+    """The peer host of a connection; its ephemeral port would make every connection
+    a new series."""
+    if isinstance(peername, (tuple, list)) and peername:
+        return str(peername[0])
+    return str(peername)
+
+
+async def push_snapshots(connection, interval_s: float) -> None:
+    """Send this process's metrics to the supervisor every interval_s."""
+    while True:
+        connection.send(REGISTRY.snapshot())
+        await asyncio.sleep(interval_s)
+
+
+async def monitor_event_loop_lag(interval_s: float) -> None:
+    """Measure how late the event loop wakes up from a sleep of interval_s."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval_s)
+        EVENT_LOOP_LAG_SECONDS.observe(max(0.0, loop.time() - started - interval_s))
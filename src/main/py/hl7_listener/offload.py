@@ -0,0 +1,96 @@
+"""Run CPU-heavy per-message work in a pool instead of on the event loop.
+
+Every connection is served by the one event loop, so a message that takes long to
+parse holds up the ACKs of all other connections, and the health check with them.
+Work on messages of at least min_bytes is handed to a pool of threads or, for work
+that holds the GIL like hl7.parse, of processes. Smaller messages are handled
+inline, where the round trip to the pool costs more than the work itself.
+
+At most max_pending tasks wait for or run in the pool. Further callers wait for a
+slot, which pauses their connection's reads like admission control does.
+"""
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+)
+from typing import (
+    Callable,
+    Optional,
+    TypeVar,
+    Union,
+)
+
+import hl7
+
+from hl7_listener import metrics
+
+THREAD = "thread"
+PROCESS = "process"
+
+T = TypeVar("T")
+
+
+class Offloader:
+    def __init__(
+        self,
+        executor: Optional[str] = None,
+        workers: int = 2,
+        min_bytes: int = 65536,
+        max_pending: int = 32,
+    ):
+        if executor not in (None, THREAD, PROCESS):
+            raise ValueError(f"Unsupported offload executor {executor!r}")
+        self.executor = executor
+        self.workers = workers
+        self.min_bytes = min_bytes
+        self._slots = asyncio.Semaphore(max_pending)
+        # Started on first use, so that a listener without large messages never
+        # starts the pool's threads or processes.
+        self._pool: Optional[Executor] = None
+
+    def pool(self) -> Executor:
+        if self._pool is None:
+            if self.executor == PROCESS:
+                # Spawned like the listener workers, so the pool's processes do not
+                # inherit the listener's threads and sockets.
+                self._pool = ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context("spawn")
+                )
+            else:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="hl7-offload")
+        return self._pool
+
+    async def run(self, size: int, fn: Callable[..., T], *args) -> T:
+        """Return fn(*args), computed in the pool if the message has at least min_bytes.
+
+        With a process pool, fn must be a module-level function; memoryview arguments
+        are copied to bytes, as they cannot be pickled.
+        """
+        if self.executor is None or size < self.min_bytes:
+            return fn(*args)
+        if self.executor == PROCESS:
+            args = tuple(bytes(arg) if isinstance(arg, memoryview) else arg for arg in args)
+        started = time.perf_counter()
+        metrics.OFFLOAD_PENDING.inc()
+        try:
+            async with self._slots:
+                metrics.OFFLOAD_QUEUE_SECONDS.observe(time.perf_counter() - started)
+                return await asyncio.get_running_loop().run_in_executor(self.pool(), fn, *args)
+        finally:
+            metrics.OFFLOAD_PENDING.dec()
+            metrics.OFFLOAD_SECONDS.observe(time.perf_counter() - started)
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+
+def validate(data: Union[bytes, memoryview], encoding: str) -> None:
+    """Fully parse an HL7 message; raises hl7.exceptions.ParseException if it is not
+    valid. The parsed message is dropped, so that nothing is sent back from a process."""
+    hl7.parse(str(data, encoding))
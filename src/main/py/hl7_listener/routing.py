@@ -0,0 +1,60 @@
+"""Content-based routing of received messages to NATS subjects or Cloud queues.
+
+ROUTING_RULES map MSH fields (message type and trigger from MSH-9, sending facility
+MSH-4, processing ID MSH-11) to a destination, so consumers only receive the
+messages they handle instead of re-parsing and discarding everything. The rules
+are compiled once into dictionaries keyed by the fields each rule matches on;
+routing a message is a few dictionary lookups on fields scan_msh already read.
+"""
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+from hl7_listener.header import MSHHeader
+from hl7_listener.settings import RoutingRule
+
+# The MSH fields rules can match on, in key order.
+_FIELDS = ("message_type", "trigger_event", "sending_facility", "processing_id")
+# Bound on the number of distinct field combinations whose route is remembered.
+_ROUTE_CACHE_SIZE = 4096
+
+RouteKey = Tuple[str, str, str, str]
+
+
+class Router:
+    def __init__(self, rules: List[RoutingRule]):
+        # One index per combination of fields that some rule matches on: which fields
+        # (as a mask over _FIELDS) -> their values -> (rule priority, destination).
+        self._indexes: Dict[Tuple[bool, ...], Dict[Tuple[str, ...], Tuple[int, str]]] = {}
+        for priority, rule in enumerate(rules):
+            mask = tuple(getattr(rule, field) is not None for field in _FIELDS)
+            values = tuple(getattr(rule, field) for field in _FIELDS if getattr(rule, field) is not None)
+            # An earlier rule with the same fields and values takes precedence.
+            self._indexes.setdefault(mask, {}).setdefault(values, (priority, rule.destination))
+        self._cache: Dict[RouteKey, Optional[str]] = {}
+
+    def route(self, header: MSHHeader) -> Optional[str]:
+        """The destination of the first rule matching the message, or None."""
+        key = (
+            header.message_type,
+            header.trigger_event,
+            header.sending_facility,
+            header.processing_id,
+        )
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        best = None
+        for mask, index in self._indexes.items():
+            match = index.get(tuple(value for value, used in zip(key, mask) if used))
+            if match is not None and (best is None or match[0] < best[0]):
+                best = match
+        destination = best[1] if best else None
+        if len(self._cache) < _ROUTE_CACHE_SIZE:
+            self._cache[key] = destination
+        return destination
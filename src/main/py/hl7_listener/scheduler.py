@@ -0,0 +1,129 @@
+"""Fair scheduling of sends to the messager between senders.
+
+All connections share one messager. Without a scheduler, a sender replaying a
+backlog keeps as many sends outstanding as it has connections and pipeline
+window, and real-time feeds from other senders queue behind it on the broker
+connection. The FairScheduler caps the sends in flight. While the cap is reached,
+waiting messages are granted the next free slot in weighted fair queuing order
+across flows, so every flow gets a share of the sends in proportion to its weight,
+however much the others send.
+
+A flow is a sender, identified by its peer host or by its sending facility (MSH-4),
+within a priority class. Classes are matched on MSH fields like routing rules and
+give their messages a weight; unmatched messages weigh 1. A message costs its size
+divided by its weight: a flow of weight 4 gets four times the bytes of a flow of
+weight 1 while both are waiting.
+
+Tags are start-time fair queuing tags. They only matter while messages are waiting
+and are reset once none are, so a sender is not held back during contention for
+what it sent while there was none.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import (
+    Dict,
+    List,
+    Tuple,
+)
+
+from hl7_listener import metrics
+from hl7_listener.header import MSHHeader
+from hl7_listener.routing import Router
+from hl7_listener.settings import (
+    PriorityClass,
+    RoutingRule,
+)
+
+PEER = "peer"
+SENDING_FACILITY = "sending_facility"
+# Class of the messages no priority class matches.
+DEFAULT_CLASS = "default"
+
+Flow = Tuple[str, str]
+
+
+class FairScheduler:
+    def __init__(
+        self,
+        max_concurrent: int,
+        classes: List[PriorityClass] = (),
+        flow_key: str = PEER,
+    ):
+        if flow_key not in (PEER, SENDING_FACILITY):
+            raise ValueError(f"Unsupported scheduler flow key {flow_key!r}")
+        self.available = max_concurrent
+        self.flow_key = flow_key
+        # The classes are matched like routing rules, with the class as destination.
+        self._classes = Router([
+            RoutingRule(
+                destination=priority_class.name,
+                **priority_class.model_dump(exclude={"name", "weight"}),
+            )
+            for priority_class in classes
+        ])
+        self._weights = {priority_class.name: priority_class.weight for priority_class in classes}
+        self._weights.setdefault(DEFAULT_CLASS, 1.0)
+        self._wait_seconds = {
+            name: metrics.REGISTRY.histogram(
+                "hl7_listener_scheduler_wait_seconds",
+                "Time a message waited for a send slot, per priority class.",
+                labels={"class": name},
+            )
+            for name in self._weights
+        }
+        # (start tag, arrival order, waiter, flow)
+        self._waiting: List[Tuple[float, int, asyncio.Future, Flow]] = []
+        self._finish_tags: Dict[Flow, float] = {}
+        self._virtual_time = 0.0
+        self._arrivals = itertools.count()
+
+    def flow(self, header: MSHHeader, peer: str) -> Flow:
+        """The priority class and sender of a message."""
+        sender = header.sending_facility if self.flow_key == SENDING_FACILITY else peer
+        return self._classes.route(header) or DEFAULT_CLASS, sender
+
+    async def acquire(self, flow: Flow, size: int) -> None:
+        """Return once the message may be sent; release() must follow."""
+        if self.available > 0 and not self._waiting:
+            self.available -= 1
+            self._wait_seconds[flow[0]].observe(0)
+            return
+
+        started = time.perf_counter()
+        start_tag = max(self._virtual_time, self._finish_tags.get(flow, 0.0))
+        self._finish_tags[flow] = start_tag + max(size, 1) / self._weights[flow[0]]
+        waiter = asyncio.get_running_loop().create_future()
+        arrival = next(self._arrivals)
+        heapq.heappush(self._waiting, (start_tag, arrival, waiter, flow))
+        metrics.SCHEDULER_QUEUED.inc(flow[1])
+        metrics.SCHEDULER_WAITING_SECONDS.start(flow[1], arrival, started)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Granted a slot just before being cancelled.
+                self.release()
+            else:
+                metrics.SCHEDULER_QUEUED.dec(flow[1])
+                metrics.SCHEDULER_WAITING_SECONDS.stop(flow[1], arrival)
+            raise
+        self._wait_seconds[flow[0]].observe(time.perf_counter() - started)
+
+    def release(self) -> None:
+        """Free the slot of a message that was sent, successfully or not."""
+        self.available += 1
+        while self.available > 0 and self._waiting:
+            start_tag, arrival, waiter, flow = heapq.heappop(self._waiting)
+            if waiter.cancelled():
+                continue
+            self._virtual_time = start_tag
+            self.available -= 1
+            metrics.SCHEDULER_QUEUED.dec(flow[1])
+            metrics.SCHEDULER_WAITING_SECONDS.stop(flow[1], arrival)
+            waiter.set_result(None)
+        if not self._waiting:
+            # The end of a busy period; every flow starts the next one even.
+            self._finish_tags.clear()
+            self._virtual_time = 0.0
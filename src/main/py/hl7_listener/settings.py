@@ -1,4 +1,5 @@
-from typing import ClassVar
+from typing import ClassVar, Dict, List, Optional
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 from enum import Enum
 
@@ -7,11 +8,148 @@ class QueueType(str, Enum):
     CLOUD = "CLOUD"
 
 
+class RoutingRule(BaseModel):
+    """Send messages whose MSH fields match to destination (a NATS subject or Cloud
+    queue). Fields left unset match any value."""
+    destination: str
+    message_type: Optional[str] = None
+    trigger_event: Optional[str] = None
+    sending_facility: Optional[str] = None
+    processing_id: Optional[str] = None
+
+
+class PriorityClass(BaseModel):
+    """Messages whose MSH fields match are scheduled with weight, relative to the
+    weight 1 of unmatched messages. Fields left unset match any value."""
+    name: str
+    weight: float
+    message_type: Optional[str] = None
+    trigger_event: Optional[str] = None
+    sending_facility: Optional[str] = None
+    processing_id: Optional[str] = None
+
+
+class ListenerConfig(BaseModel):
+    """An additional MLLP listener (feed) served by the same process. Unset fields
+    take the value of the main listener's settings; unset limits are unlimited."""
+    name: str
+    port: int
+    host: Optional[str] = None
+    encoding: Optional[str] = None
+    # NATS subject or Cloud queue of the feed's messages; routing rules take
+    # precedence.
+    destination: Optional[str] = None
+    max_connections: Optional[int] = None
+    max_inflight_messages: Optional[int] = None
+    max_inflight_bytes: Optional[int] = None
+
+
 class Settings(BaseSettings):
     HL7_MLLP_HOST: str
     HL7_MLLP_PORT: int
+    HL7_MLLP_ENCODING: str = "UTF-8"
+    # More listeners served next to HL7_MLLP_PORT, a JSON list of ListenerConfig.
+    HL7_LISTENERS: List[ListenerConfig] = []
+    # Forward received messages as the bytes read from the socket instead of
+    # decoding and re-encoding them.
+    HL7_RAW_BYTES: bool = False
+    # Fully parse every message and reject (AR) the ones that fail. Otherwise only
+    # the MSH header is read.
+    HL7_VALIDATE_MESSAGES: bool = False
+    # Frames larger than this are read and discarded in chunks, and rejected (AR).
+    HL7_MAX_FRAME_BYTES: int = 16777216
+    # With NATS JetStream, frames larger than this are spilled to a temporary file
+    # as they arrive and sent through the object store instead of being held in
+    # memory; unset, whole frames up to HL7_MAX_FRAME_BYTES are held in memory.
+    HL7_STREAM_THRESHOLD_BYTES: Optional[int] = None
     OUTBOUND_QUEUE_TYPE: QueueType = QueueType.NATS
     LOG_LEVEL: str = "INFO"
+    # Format and write log lines on a background thread.
+    LOG_ASYNC_ENABLED: bool = False
+    LOG_QUEUE_SIZE: int = 10000
+    # Per logging_code: share of info events kept, and maximum events per second.
+    # Warnings and errors are always logged.
+    LOG_SAMPLING: Dict[str, float] = {}
+    LOG_RATE_LIMITS: Dict[str, int] = {}
+    # Log a summary of message and ACK counts this often; 0 disables it.
+    LOG_SUMMARY_INTERVAL_S: float = 0
+    # Messages published within the TTL are remembered, and retransmissions of
+    # them are ACKed without being published again.
+    DEDUPE_ENABLED: bool = False
+    DEDUPE_MAX_ENTRIES: int = 100000
+    DEDUPE_TTL_S: float = 300
+    # Share of messages traced with a per-message span; 0 traces none.
+    TRACING_SAMPLE_RATIO: float = 0
+    # Pipelined mode reads ahead while earlier publishes are outstanding; ACKs are
+    # still written in arrival order.
+    HL7_PIPELINE_ENABLED: bool = False
+    HL7_PIPELINE_WINDOW: int = 16
+    # Fair scheduling of sends between senders: at most SCHEDULER_MAX_CONCURRENT_SENDS
+    # are in flight, and waiting messages are granted slots in weighted fair order
+    # across flows, keyed by "peer" or "sending_facility" and by priority class
+    # (a JSON list of PriorityClass, first match wins).
+    SCHEDULER_ENABLED: bool = False
+    SCHEDULER_MAX_CONCURRENT_SENDS: int = 64
+    SCHEDULER_FLOW_KEY: str = "peer"
+    SCHEDULER_CLASSES: List[PriorityClass] = []
+    # Micro-batching of outbound messages across all connections.
+    BATCH_ENABLED: bool = False
+    BATCH_MAX_MESSAGES: int = 100
+    BATCH_MAX_BYTES: int = 1048576
+    BATCH_MAX_DELAY_MS: float = 5
+    # Local write-ahead spool: messages are ACKed once on disk and delivered to the
+    # broker in the background.
+    SPOOL_ENABLED: bool = False
+    SPOOL_DIR: str = "spool"
+    SPOOL_SEGMENT_BYTES: int = 67108864
+    SPOOL_MAX_BYTES: int = 1073741824
+    SPOOL_COMMIT_INTERVAL_MS: float = 1
+    SPOOL_DRAIN_BATCH: int = 100
+    SPOOL_RETRY_INITIAL_S: float = 0.5
+    SPOOL_RETRY_MAX_S: float = 30
+    SPOOL_MAX_ATTEMPTS: int = 5
+    # Global admission control: reads pause at the high water marks and resume once
+    # below ADMISSION_LOW_WATER_RATIO of them.
+    ADMISSION_ENABLED: bool = False
+    ADMISSION_MAX_INFLIGHT_MESSAGES: int = 1000
+    ADMISSION_MAX_INFLIGHT_BYTES: int = 67108864
+    ADMISSION_LOW_WATER_RATIO: float = 0.5
+    ADMISSION_MAX_CONNECTIONS: int = 256
+    # Outbound compression ("gzip" or "zstd") of payloads of at least
+    # COMPRESSION_MIN_BYTES; from COMPRESSION_OFFLOAD_BYTES on it runs in a thread.
+    COMPRESSION_ALGORITHM: Optional[str] = None
+    COMPRESSION_MIN_BYTES: int = 16384
+    COMPRESSION_OFFLOAD_BYTES: int = 262144
+    COMPRESSION_LEVEL: Optional[int] = None
+    # Content-based routing, a JSON list of RoutingRule; the first matching rule
+    # wins and unmatched messages go to the configured subject or queue.
+    ROUTING_RULES: List[RoutingRule] = []
+    # Validation of messages of at least OFFLOAD_MIN_BYTES runs in a pool of
+    # OFFLOAD_WORKERS threads or processes ("thread" or "process") instead of on the
+    # event loop; at most OFFLOAD_MAX_PENDING tasks wait for or run in the pool.
+    OFFLOAD_EXECUTOR: Optional[str] = None
+    OFFLOAD_WORKERS: int = 2
+    OFFLOAD_MIN_BYTES: int = 65536
+    OFFLOAD_MAX_PENDING: int = 32
+    # Append every received message, with its arrival time and peer, to a capture
+    # file for replaying offline (benchmark.replay). Messages may be compressed and
+    # passed through an encryption hook ("module:function", bytes to bytes).
+    CAPTURE_ENABLED: bool = False
+    CAPTURE_PATH: str = "hl7-capture.bin"
+    CAPTURE_COMPRESS: bool = False
+    CAPTURE_ENCRYPT_HOOK: Optional[str] = None
+    CAPTURE_MAX_BYTES: int = 1073741824
+    METRICS_LOOP_LAG_INTERVAL_S: float = 0.5
+    # Workers only: how often each reports its metrics to the supervisor.
+    METRICS_PUSH_INTERVAL_S: float = 1
+    # Number of listener processes sharing HL7_MLLP_PORT; 1 runs a single process.
+    HL7_WORKERS: int = 1
+    HL7_WORKER_STOP_TIMEOUT_S: float = 30
+    # On SIGTERM, /ready reports not ready this long before the port is closed, so
+    # the load balancer stops routing new connections first.
+    SHUTDOWN_NOT_READY_DELAY_S: float = 0
+    # Deadline for the messages in flight to be sent and ACKed once the port is closed.
+    SHUTDOWN_DRAIN_TIMEOUT_S: float = 20
 
 
     _instance: ClassVar["Settings"] = None
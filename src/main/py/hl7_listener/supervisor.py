@@ -0,0 +1,183 @@
+"""Run the listener as several worker processes that share the MLLP port.
+
+Parsing and logging hold the GIL, so a single process is limited to one core no
+matter how many senders connect. With HL7_WORKERS > 1 the supervisor starts that
+many worker processes; each binds the MLLP ports with SO_REUSEPORT, so the kernel
+spreads incoming connections across them, and each keeps its own messager
+connection. The supervisor serves the health check and the metrics of all workers
+summed, restarts workers that die, and on SIGTERM/SIGINT reports not ready, then
+stops them all before exiting; each worker drains its connections as it stops.
+
+A worker that dies soon after it was started, e.g. because of a bad setting or an
+unreachable dependency, is restarted after a delay that doubles with every such
+death, so it does not crash in a loop.
+"""
+import asyncio
+import multiprocessing
+import os
+import signal
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+)
+
+from covera.loglib import configure_get_logger
+
+from hl7_listener import metrics
+from hl7_listener.healthcheck import start_health_check_server
+
+logger = configure_get_logger()
+
+# How often the supervisor checks that its workers are alive.
+_MONITOR_INTERVAL_S = 1
+# Delay before restarting a worker that died within _STABLE_S of being started,
+# doubled for every consecutive such death up to _RESTART_MAX_S. A worker that ran
+# for longer is restarted right away.
+_RESTART_INITIAL_S = 1
+_RESTART_MAX_S = 60
+_STABLE_S = 60
+
+
+class Supervisor:
+    def __init__(
+        self,
+        workers: int,
+        target: Callable,
+        stop_timeout_s: float,
+        worker_env: Callable[[int], Dict[str, str]] = lambda index: {},
+        not_ready_delay_s: float = 0,
+    ):
+        """target(index, metrics_connection) is run in each worker process;
+        worker_env(index) gives environment variables set for that worker only.
+
+        stop_timeout_s must leave the workers time to drain their connections.
+        """
+        self.workers = workers
+        self.target = target
+        self.stop_timeout = stop_timeout_s
+        self.worker_env = worker_env
+        self.not_ready_delay = not_ready_delay_s
+        # Workers are spawned, not forked, so they start without the supervisor's
+        # event loop and open connections.
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: List[multiprocessing.Process] = [None] * workers
+        self.started_at: List[float] = [0.0] * workers
+        self.restart_delays: List[float] = [0.0] * workers
+        # Workers that died, by index: when to restart them.
+        self.restarts: Dict[int, float] = {}
+        self.snapshots: Dict[int, List[metrics.Family]] = {}
+        # Counters and histograms of the last snapshots of workers that exited, so
+        # the sums do not go backwards when a worker is replaced.
+        self.retired: List[metrics.Family] = []
+        self.stopping = asyncio.Event()
+
+    def start_worker(self, index: int) -> None:
+        loop = asyncio.get_running_loop()
+        receiver, sender = self.context.Pipe(duplex=False)
+        env = self.worker_env(index)
+        saved = {name: os.environ.get(name) for name in env}
+        # A spawned process reads its settings from the environment it inherits.
+        os.environ.update(env)
+        try:
+            process = self.context.Process(
+                target=self.target, args=(index, sender), name=f"hl7-listener-worker-{index}"
+            )
+            process.start()
+        finally:
+            for name, value in saved.items():
+                if value is None:
+                    os.environ.pop(name, None)
+                else:
+                    os.environ[name] = value
+        sender.close()
+        loop.add_reader(receiver.fileno(), self.receive_snapshot, index, receiver)
+        self.processes[index] = process
+        self.started_at[index] = time.monotonic()
+        logger.info(
+            "HL7 Listener worker started",
+            logging_code="HL7LLOG019",
+            worker=index,
+            pid=process.pid
+        )
+
+    def restart_delay(self, index: int, now: float) -> float:
+        """How long to wait before restarting a worker that just died."""
+        if now - self.started_at[index] >= _STABLE_S:
+            delay = 0.0
+        else:
+            delay = min(max(self.restart_delays[index] * 2, _RESTART_INITIAL_S), _RESTART_MAX_S)
+        self.restart_delays[index] = delay
+        return delay
+
+    def receive_snapshot(self, index: int, receiver) -> None:
+        try:
+            self.snapshots[index] = receiver.recv()
+        except (EOFError, OSError):
+            # The worker exited. Its gauges are dropped with it; its counts are kept.
+            asyncio.get_running_loop().remove_reader(receiver.fileno())
+            receiver.close()
+            snapshot = self.snapshots.pop(index, [])
+            self.retired = metrics.merge([
+                self.retired, [family for family in snapshot if family[2] != metrics.Gauge.type]
+            ])
+
+    def is_ready(self) -> bool:
+        # Workers report metrics only once they listen on the port.
+        return bool(self.snapshots) and not self.stopping.is_set()
+
+    def render_metrics(self) -> str:
+        return metrics.render(metrics.merge([self.retired, *self.snapshots.values()]))
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.stopping.set)
+        for index in range(self.workers):
+            self.start_worker(index)
+        await start_health_check_server(self.render_metrics, self.is_ready)
+
+        while not self.stopping.is_set():
+            now = time.monotonic()
+            for index, process in enumerate(self.processes):
+                if index in self.restarts:
+                    if now >= self.restarts[index]:
+                        del self.restarts[index]
+                        self.start_worker(index)
+                elif not process.is_alive():
+                    delay = self.restart_delay(index, now)
+                    logger.error(
+                        "HL7 Listener worker exited, restarting it",
+                        logging_code="HL7LERR012",
+                        worker=index,
+                        exitcode=process.exitcode,
+                        restart_in_seconds=delay
+                    )
+                    if delay:
+                        self.restarts[index] = now + delay
+                    else:
+                        self.start_worker(index)
+            try:
+                await asyncio.wait_for(self.stopping.wait(), _MONITOR_INTERVAL_S)
+            except asyncio.TimeoutError:
+                pass
+        # Let the load balancer see /ready fail before the workers close the port.
+        await asyncio.sleep(self.not_ready_delay)
+        await self.stop()
+
+    async def stop(self) -> None:
+        """Ask every worker to finish, and kill the ones still running after the timeout."""
+        logger.info("Stopping HL7 Listener workers", logging_code="HL7LLOG020")
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(None, process.join, self.stop_timeout)
+            for process in self.processes
+        ))
+        for process in self.processes:
+            if process.is_alive():
+                process.kill()
+                process.join()
@@ -0,0 +1,91 @@
+"""Per-message tracing with head sampling.
+
+covera.tracelib's @traced on the connection handlers produced one span per
+connection, which for a long-lived sender connection is a single span lasting days,
+and put a span around every broker send. Instead, a sampled share of messages
+(TRACING_SAMPLE_RATIO) gets one "hl7.message" span from the moment it is handed to
+the messager until the broker accepted it, with the broker send as a child span.
+
+The sampling decision is taken before any span exists, so a message that is not
+traced costs one counter increment: no span, no attributes, no context propagation.
+Span attributes are built once per sender and message type and reused. The trace
+context of a traced message is sent along in NATS headers or Service Bus message
+properties, so consumers can continue the trace.
+"""
+import contextlib
+import itertools
+from typing import (
+    ContextManager,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+from opentelemetry import (
+    propagate,
+    trace,
+)
+
+from hl7_listener.header import MSHHeader
+
+# Bound on the number of distinct sender and message type attribute sets kept.
+_ATTRIBUTES_CACHE_SIZE = 4096
+_NO_SPAN = contextlib.nullcontext()
+
+tracer = trace.get_tracer("hl7_listener")
+
+
+class MessageTracer:
+    """Starts the span of every n-th message, n following from sample_ratio."""
+
+    def __init__(self, sample_ratio: float):
+        # Taking every n-th message is cheaper and steadier than a random draw.
+        self.sample_every = round(1 / sample_ratio) if sample_ratio > 0 else 0
+        self._messages = itertools.count(1)
+        self._attributes: Dict[Tuple[str, ...], Dict[str, str]] = {}
+
+    def message_span(self, header: MSHHeader, peer: str = "") -> ContextManager:
+        """The span of one message, or a no-op context if it is not sampled."""
+        if not self.sample_every or next(self._messages) % self.sample_every:
+            return _NO_SPAN
+        return tracer.start_as_current_span(
+            "hl7.message",
+            kind=trace.SpanKind.CONSUMER,
+            attributes=self.attributes(header, peer),
+        )
+
+    def attributes(self, header: MSHHeader, peer: str) -> Dict[str, str]:
+        key = (
+            peer,
+            header.message_type,
+            header.trigger_event,
+            header.sending_application,
+            header.sending_facility,
+        )
+        attributes = self._attributes.get(key)
+        if attributes is None:
+            attributes = {
+                "net.peer.name": peer,
+                "hl7.message_type": header.type,
+                "hl7.sending_application": header.sending_application,
+                "hl7.sending_facility": header.sending_facility,
+            }
+            if len(self._attributes) < _ATTRIBUTES_CACHE_SIZE:
+                self._attributes[key] = attributes
+        return attributes
+
+
+def child_span(name: str) -> ContextManager:
+    """A span below the current message's span; a no-op for untraced messages."""
+    if not trace.get_current_span().is_recording():
+        return _NO_SPAN
+    return tracer.start_as_current_span(name, kind=trace.SpanKind.PRODUCER)
+
+
+def trace_context() -> Optional[Dict[str, str]]:
+    """The W3C trace context headers of the current message, if it is traced."""
+    if not trace.get_current_span().get_span_context().is_valid:
+        return None
+    carrier = {}
+    propagate.inject(carrier)
+    return carrier
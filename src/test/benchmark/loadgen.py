@@ -0,0 +1,126 @@
+"""MLLP load generator: replays synthetic ADT/ORU messages over many connections.
+
+Each connection keeps up to `window` messages unacknowledged (1 behaves like a
+typical interface engine, more exercises HL7_PIPELINE_ENABLED) and measures the
+time from writing a message to reading its ACK. A message answered with anything
+but AA, or lost with the connection, is resent on a new connection, the way a
+sender retransmits unacknowledged messages.
+"""
+
+import asyncio
+import time
+from typing import (
+    List,
+    NamedTuple,
+)
+
+START_BLOCK = b"\x0b"
+FRAME_END = b"\x1c\r"
+
+_ADT_A01 = (
+    "MSH|^~\\&|BENCH|BENCH FAC|HL7LISTENER|COVERA|20240101120000||ADT^A01|{control_id}|P|2.5\r"
+    "EVN|A01|20240101120000\r"
+    "PID|1||{control_id}^^^BENCH^MR||DOE^JANE||19800101|F|||1 MAIN ST^^CITY^ST^00000\r"
+    "PV1|1|I|WARD^101^1|||||||MED\r"
+)
+_ORU_R01 = (
+    "MSH|^~\\&|BENCH|BENCH FAC|HL7LISTENER|COVERA|20240101120000||ORU^R01|{control_id}|P|2.5\r"
+    "PID|1||{control_id}^^^BENCH^MR||DOE^JANE||19800101|F\r"
+    "OBR|1|ORD{control_id}|FIL{control_id}|11502-2^Laboratory report^LN\r"
+)
+TEMPLATES = {"adt": _ADT_A01, "oru": _ORU_R01}
+
+
+def make_message(kind: str, control_id: str, size: int) -> bytes:
+    """Build an MLLP frame holding a synthetic message of about size bytes.
+
+    ADT messages are padded with NTE segments, ORU messages with an embedded
+    (base64-like) document in OBX-5, which is what makes real ORU traffic large.
+    """
+    message = TEMPLATES[kind].format(control_id=control_id)
+    missing = size - len(message)
+    if missing > 0:
+        if kind == "oru":
+            message += "OBX|1|ED|PDF^Report^LN||^AP^PDF^Base64^" + "QUJD" * (missing // 4) + "\r"
+        else:
+            line = "NTE|1||" + "x" * 72 + "\r"
+            message += line * (missing // len(line) + 1)
+    return START_BLOCK + message.encode() + FRAME_END
+
+
+class LoadResult(NamedTuple):
+    # Seconds from writing each acknowledged message to reading its AA.
+    latencies: List[float]
+    elapsed: float
+    retransmits: int
+    rejected: int
+
+
+async def _run_connection(host, port, frames, window, latencies, counts) -> None:
+    pending = list(reversed(frames))
+    while pending:
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+        except OSError:
+            await asyncio.sleep(0.05)
+            continue
+        unacked = []
+        try:
+            while pending or unacked:
+                while pending and len(unacked) < window:
+                    frame = pending.pop()
+                    writer.write(frame)
+                    unacked.append((frame, time.perf_counter()))
+                await writer.drain()
+                ack = await reader.readuntil(FRAME_END)
+                frame, sent = unacked.pop(0)
+                if b"MSA|AA|" in ack:
+                    latencies.append(time.perf_counter() - sent)
+                else:
+                    counts["rejected"] += 1
+                    # The listener closes the connection after AE/AR; resend
+                    # everything not yet acknowledged.
+                    unacked.insert(0, (frame, sent))
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for frame, _ in reversed(unacked):
+                pending.append(frame)
+                counts["retransmits"] += 1
+            writer.close()
+
+
+async def generate_load(
+    host: str,
+    port: int,
+    connections: int,
+    messages: int,
+    kind: str = "adt",
+    size: int = 1024,
+    window: int = 1,
+) -> LoadResult:
+    """Send messages spread evenly over connections and wait for every AA."""
+    per_connection = [
+        [
+            make_message(kind, f"BENCH{connection}-{index}", size)
+            for index in range(connection, messages, connections)
+        ]
+        for connection in range(connections)
+    ]
+    latencies: List[float] = []
+    counts = {"retransmits": 0, "rejected": 0}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _run_connection(host, port, frames, window, latencies, counts)
+        for frames in per_connection
+    ))
+    return LoadResult(
+        latencies, time.perf_counter() - started, counts["retransmits"], counts["rejected"]
+    )
+
+
+def run_load(result_pipe, host, port, **kwargs) -> None:
+    """Entry point of the load generator process."""
+    result_pipe.send(asyncio.run(generate_load(host, port, **kwargs)))
+    result_pipe.close()
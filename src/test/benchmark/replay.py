@@ -0,0 +1,185 @@
+"""Replay a capture of MLLP traffic into the listener to profile its hot path.
+
+    PYTHONPATH=src/main/py:src/test python -m benchmark.replay CAPTURE [--speed N] [--profile FILE]
+
+Captures are recorded by a listener running with CAPTURE_ENABLED. hl7_receiver
+runs in this process against StubMessager, with its settings read from the
+environment as usual. The captured frames are sent from a process of their own,
+over one connection per captured peer. Each connection waits for the ACK of a
+frame before sending the next, like a typical interface engine. --speed 1
+replays at the recorded pace, N at N times it and 0 as fast as possible.
+
+--profile writes the listener's cProfile stats to FILE, for pstats or snakeviz.
+To sample with py-spy instead, run `py-spy record -- python -m benchmark.replay
+...`; without --subprocesses it only records the listener's process.
+"""
+
+import argparse
+import asyncio
+import cProfile
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import defaultdict
+from typing import (
+    Dict,
+    List,
+    Optional,
+)
+
+# The listener reads its settings at import time.
+os.environ.setdefault("HL7_MLLP_HOST", "127.0.0.1")
+os.environ.setdefault("HL7_MLLP_PORT", "0")
+os.environ.setdefault("OUTBOUND_QUEUE_TYPE", "NATS")
+
+from benchmark.loadgen import (  # noqa: E402
+    FRAME_END,
+    START_BLOCK,
+    LoadResult,
+)
+from benchmark.run import (  # noqa: E402
+    _free_port,
+    _percentile,
+)
+from benchmark.stubs import StubMessager  # noqa: E402
+from hl7_listener.capture import (  # noqa: E402
+    CapturedFrame,
+    load_hook,
+    read_capture,
+)
+
+
+async def _replay_peer(host, port, frames, started, first, speed, latencies, counts) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for frame in frames:
+            if speed:
+                delay = started + (frame.timestamp - first) / speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            sent = time.perf_counter()
+            writer.write(START_BLOCK + frame.message + FRAME_END)
+            await writer.drain()
+            ack = await reader.readuntil(FRAME_END)
+            if b"MSA|AA|" in ack:
+                latencies.append(time.perf_counter() - sent)
+            else:
+                # The listener closes the connection after AE/AR.
+                counts["rejected"] += 1
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+    finally:
+        writer.close()
+
+
+async def replay(
+    host: str, port: int, path: str, speed: float = 1, decrypt: Optional[str] = None
+) -> LoadResult:
+    """Send the frames of a capture, each peer's in order over its own connection."""
+    by_peer: Dict[str, List[CapturedFrame]] = defaultdict(list)
+    first = None
+    for frame in read_capture(path, load_hook(decrypt)):
+        first = frame.timestamp if first is None else first
+        by_peer[frame.peer].append(frame)
+    latencies: List[float] = []
+    counts = {"rejected": 0}
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        _replay_peer(host, port, frames, started, first, speed, latencies, counts)
+        for frames in by_peer.values()
+    ))
+    return LoadResult(latencies, time.perf_counter() - started, 0, counts["rejected"])
+
+
+def run_replay(result_pipe, host, port, **kwargs) -> None:
+    """Entry point of the replaying process."""
+    result_pipe.send(asyncio.run(replay(host, port, **kwargs)))
+    result_pipe.close()
+
+
+async def _serve(args, context) -> dict:
+    from hl7_listener import main
+
+    messager = StubMessager(args.broker_latency_ms)
+    await messager.connect()
+    main.messager = messager
+    listening = asyncio.Event()
+    receiver = asyncio.create_task(main.hl7_receiver(listening=listening))
+    await listening.wait()
+
+    result_pipe, child_pipe = context.Pipe()
+    sender = context.Process(
+        target=run_replay,
+        args=(child_pipe, main.settings.HL7_MLLP_HOST, main.settings.HL7_MLLP_PORT),
+        kwargs={"path": args.capture, "speed": args.speed, "decrypt": args.decrypt},
+    )
+    profile = cProfile.Profile() if args.profile else None
+    cpu_started = time.process_time()
+    sender.start()
+    try:
+        if profile is not None:
+            profile.enable()
+        result = await asyncio.get_running_loop().run_in_executor(None, result_pipe.recv)
+    finally:
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+        cpu = time.process_time() - cpu_started
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        sender.join()
+
+    latencies = sorted(result.latencies)
+    messages = max(len(latencies), 1)
+    return {
+        "capture": args.capture,
+        "speed": args.speed,
+        "messages": len(latencies),
+        "msgs_per_sec": round(len(latencies) / result.elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.5), 3) if latencies else None,
+        "p99_ms": round(_percentile(latencies, 0.99), 3) if latencies else None,
+        "cpu_us_per_msg": round(cpu / messages * 1e6, 1),
+        "rejected": result.rejected,
+    }
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="Capture file written with CAPTURE_ENABLED")
+    parser.add_argument(
+        "--speed", type=float, default=1,
+        help="Multiple of the recorded pace; 0 sends as fast as possible (default: 1)",
+    )
+    parser.add_argument("--decrypt", help="module:function reversing CAPTURE_ENCRYPT_HOOK")
+    parser.add_argument("--broker-latency-ms", type=float, default=0)
+    parser.add_argument("--profile", help="Write the listener's cProfile stats to this file")
+    parser.add_argument("--show-logs", action="store_true")
+    args = parser.parse_args(argv)
+
+    if not args.show_logs:
+        # Log lines are still formatted, they just go nowhere.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        report_fd = os.dup(sys.stdout.fileno())
+        os.dup2(devnull, sys.stdout.fileno())
+        os.dup2(devnull, sys.stderr.fileno())
+        report = os.fdopen(report_fd, "w")
+    else:
+        report = sys.stdout
+
+    from hl7_listener.log_pipeline import configure_logging
+    from hl7_listener.settings import settings
+
+    settings.HL7_MLLP_PORT = _free_port()
+    log_pipeline = configure_logging(settings)
+    try:
+        result = asyncio.run(_serve(args, multiprocessing.get_context("spawn")))
+    finally:
+        log_pipeline.close()
+    print(json.dumps(result), file=report, flush=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,232 @@
+"""Benchmark the listener's hot loop under synthetic MLLP load.
+
+    PYTHONPATH=src/main/py:src/test python -m benchmark.run [scenario ...]
+
+Every scenario runs hl7_receiver in a fresh process against a stub broker, while
+the load generator (and, for the "nats" broker, StubNATSServer) run in processes
+of their own, so the CPU time and RSS reported are the listener's alone. The
+report of each scenario is compared with its stored baseline; a drop in
+throughput or a rise in p99 latency or CPU per message beyond --tolerance fails
+the run. --save-baseline records the current results instead. Baselines are only
+comparable on the machine they were recorded on.
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import resource
+import socket
+import sys
+import time
+from pathlib import Path
+from typing import (
+    Dict,
+    List,
+    NamedTuple,
+)
+
+# The listener reads its settings at import time.
+os.environ.setdefault("HL7_MLLP_HOST", "127.0.0.1")
+os.environ.setdefault("HL7_MLLP_PORT", "0")
+os.environ.setdefault("OUTBOUND_QUEUE_TYPE", "NATS")
+
+from benchmark.loadgen import run_load  # noqa: E402
+from benchmark.stubs import (  # noqa: E402
+    StubMessager,
+    StubNATSServer,
+)
+
+BASELINE_DIR = Path(__file__).parent / "baselines"
+
+
+class Scenario(NamedTuple):
+    name: str
+    broker: str = "stub"
+    latency_ms: float = 0
+    failure_rate: float = 0
+    connections: int = 8
+    messages: int = 20000
+    kind: str = "adt"
+    size: int = 1024
+    window: int = 1
+    # Listener settings overridden for the scenario.
+    listener: Dict[str, object] = {}
+
+
+SCENARIOS = {
+    scenario.name: scenario
+    for scenario in (
+        Scenario("adt-sequential"),
+        Scenario("oru-32k", kind="oru", size=32768, messages=5000),
+        Scenario(
+            "adt-pipelined-broker-2ms",
+            latency_ms=2,
+            window=16,
+            listener={"HL7_PIPELINE_ENABLED": True, "HL7_PIPELINE_WINDOW": 16},
+        ),
+        Scenario("adt-broker-failures", failure_rate=0.01),
+        Scenario("adt-nats-stub", broker="nats"),
+    )
+}
+
+# Report fields checked against the baseline; True where higher is better.
+_COMPARED = {"msgs_per_sec": True, "p99_ms": False, "cpu_us_per_msg": False}
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _percentile(ordered: List[float], quantile: float) -> float:
+    return ordered[min(len(ordered) - 1, int(quantile * len(ordered)))] * 1000
+
+
+def _serve_stub_nats(port_pipe) -> None:
+    async def serve():
+        server = StubNATSServer()
+        await server.start()
+        port_pipe.send(server.port)
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+
+async def _benchmark(scenario: Scenario, context) -> dict:
+    from hl7_listener import main
+    import hl7_listener.messaging.settings as msgr_config
+
+    helpers = []
+    if scenario.broker == "nats":
+        port_pipe, child_pipe = context.Pipe()
+        stub_nats = context.Process(target=_serve_stub_nats, args=(child_pipe,))
+        stub_nats.start()
+        helpers.append(stub_nats)
+        msgr_config.settings.NATS_SERVER_URL = f"nats://127.0.0.1:{port_pipe.recv()}"
+        messager = msgr_config.MESSAGER_CONFIG_MAP[main.settings.OUTBOUND_QUEUE_TYPE]["messager"]()
+    else:
+        messager = StubMessager(scenario.latency_ms, scenario.failure_rate)
+    await messager.connect()
+    main.messager = messager
+    receiver = asyncio.create_task(main.hl7_receiver())
+
+    result_pipe, child_pipe = context.Pipe()
+    load = context.Process(
+        target=run_load,
+        args=(child_pipe, main.settings.HL7_MLLP_HOST, main.settings.HL7_MLLP_PORT),
+        kwargs={
+            "connections": scenario.connections,
+            "messages": scenario.messages,
+            "kind": scenario.kind,
+            "size": scenario.size,
+            "window": scenario.window,
+        },
+    )
+    cpu_started = time.process_time()
+    load.start()
+    helpers.append(load)
+    try:
+        result = await asyncio.get_running_loop().run_in_executor(None, result_pipe.recv)
+        cpu = time.process_time() - cpu_started
+    finally:
+        receiver.cancel()
+        await asyncio.gather(receiver, return_exceptions=True)
+        await messager.close()
+        for helper in helpers:
+            helper.terminate()
+            helper.join()
+
+    latencies = sorted(result.latencies)
+    return {
+        "scenario": scenario.name,
+        "messages": len(latencies),
+        "msgs_per_sec": round(len(latencies) / result.elapsed, 1),
+        "p50_ms": round(_percentile(latencies, 0.5), 3),
+        "p99_ms": round(_percentile(latencies, 0.99), 3),
+        "p999_ms": round(_percentile(latencies, 0.999), 3),
+        "cpu_us_per_msg": round(cpu / len(latencies) * 1e6, 1),
+        # ru_maxrss is in KiB on Linux.
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "retransmits": result.retransmits,
+        "rejected": result.rejected,
+    }
+
+
+def run_scenario(scenario: Scenario, report_pipe, show_logs: bool) -> None:
+    """Entry point of the listener process of one scenario."""
+    if not show_logs:
+        # Log lines are still formatted, they just go nowhere.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        os.dup2(devnull, sys.stderr.fileno())
+
+    from hl7_listener.log_pipeline import configure_logging
+    from hl7_listener.settings import settings
+
+    settings.HL7_MLLP_PORT = _free_port()
+    for name, value in scenario.listener.items():
+        setattr(settings, name, value)
+    log_pipeline = configure_logging(settings)
+    context = multiprocessing.get_context("spawn")
+    try:
+        report_pipe.send(asyncio.run(_benchmark(scenario, context)))
+    finally:
+        log_pipeline.close()
+    report_pipe.close()
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    regressions = []
+    for field, higher_is_better in _COMPARED.items():
+        change = (report[field] - baseline[field]) / baseline[field]
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(
+                f"{report['scenario']}: {field} {baseline[field]} -> {report[field]}"
+            )
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"Any of {', '.join(SCENARIOS)}; default all")
+    parser.add_argument("--messages", type=int, help="Override the message count of every scenario")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    parser.add_argument("--show-logs", action="store_true")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    context = multiprocessing.get_context("spawn")
+    regressions = []
+    for name in args.scenarios or SCENARIOS:
+        scenario = SCENARIOS[name]
+        if args.messages:
+            scenario = scenario._replace(messages=args.messages)
+        report_pipe, child_pipe = context.Pipe()
+        listener = context.Process(
+            target=run_scenario, args=(scenario, child_pipe, args.show_logs)
+        )
+        listener.start()
+        report = report_pipe.recv()
+        listener.join()
+        print(json.dumps(report))
+
+        baseline_path = BASELINE_DIR / f"{name}.json"
+        if args.save_baseline:
+            BASELINE_DIR.mkdir(exist_ok=True)
+            baseline_path.write_text(json.dumps(report, indent=2) + "\n")
+        elif baseline_path.exists():
+            regressions += compare(report, json.loads(baseline_path.read_text()), args.tolerance)
+
+    for regression in regressions:
+        print(f"REGRESSION {regression}", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
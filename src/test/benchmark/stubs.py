@@ -0,0 +1,139 @@
+"""Stand-ins for the outbound brokers used by the benchmark harness."""
+
+import asyncio
+import json
+import random
+import re
+from typing import (
+    Any,
+    Dict,
+    Optional,
+)
+
+from hl7_listener.messaging.base import MessagingInterface
+
+
+class StubBrokerError(Exception):
+    pass
+
+
+class StubMessager(MessagingInterface):
+    """In-process messager that accepts every message after a fixed latency.
+
+    The given fraction of sends (failure_rate) fails, which the listener answers
+    with AE. Messages are not kept, only counted.
+    """
+
+    conn = None
+
+    def __init__(self, latency_ms: float = 0, failure_rate: float = 0, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.sent = 0
+        self.failed = 0
+
+    async def connect(self) -> bool:
+        return True
+
+    async def send_msg(
+        self,
+        msg: Any,
+        msg_id: Optional[str] = None,
+        destination: Optional[str] = None,
+        encoding: Optional[str] = None,
+    ) -> None:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            self.failed += 1
+            raise StubBrokerError("Stub broker rejected the message")
+        self.sent += 1
+
+
+_CONTROL_LINE_END = b"\r\n"
+
+
+class StubNATSServer:
+    """Just enough of the NATS client protocol for NATSMessager to run against.
+
+    Every published message that carries a reply subject is answered with a
+    JetStream-style PubAck, so both core request/reply and JetStream publishes
+    complete. Subscriptions are only used to route those replies back.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.published = 0
+
+    @property
+    def url(self) -> str:
+        return f"nats://{self.host}:{self.port}"
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle_client(self, reader, writer) -> None:
+        info = {
+            "server_id": "benchmark-stub",
+            "version": "2.10.0",
+            "proto": 1,
+            "headers": True,
+            "max_payload": 8 * 1024 * 1024,
+        }
+        writer.write(b"INFO " + json.dumps(info).encode() + _CONTROL_LINE_END)
+        # sid -> compiled subject pattern
+        subscriptions: Dict[bytes, re.Pattern] = {}
+        try:
+            while True:
+                line = await reader.readuntil(_CONTROL_LINE_END)
+                op, *args = line[:-2].split()
+                op = op.upper()
+                if op == b"PING":
+                    writer.write(b"PONG\r\n")
+                elif op == b"SUB":
+                    subscriptions[args[-1]] = _subject_pattern(args[0])
+                elif op == b"UNSUB":
+                    subscriptions.pop(args[0], None)
+                elif op in (b"PUB", b"HPUB"):
+                    # PUB <subject> [reply] <size>; HPUB adds <header size> before <size>.
+                    size = int(args[-1])
+                    await reader.readexactly(size + len(_CONTROL_LINE_END))
+                    self.published += 1
+                    reply = args[1] if len(args) == (4 if op == b"HPUB" else 3) else None
+                    if reply:
+                        self.reply(writer, subscriptions, reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def reply(self, writer, subscriptions, reply: bytes) -> None:
+        subject = reply.decode()
+        for sid, pattern in subscriptions.items():
+            if pattern.fullmatch(subject):
+                payload = json.dumps({"stream": "HL7", "seq": self.published}).encode()
+                writer.write(
+                    b"MSG %s %s %d\r\n%s\r\n" % (reply, sid, len(payload), payload)
+                )
+                return
+
+
+def _subject_pattern(subject: bytes) -> re.Pattern:
+    tokens = []
+    for token in subject.decode().split("."):
+        if token == "*":
+            tokens.append(r"[^.]+")
+        elif token == ">":
+            tokens.append(r".+")
+        else:
+            tokens.append(re.escape(token))
+    return re.compile(r"\.".join(tokens))
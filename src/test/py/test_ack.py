@@ -0,0 +1,53 @@
+"""Tests for ack.py."""
+
+import os
+
+import hl7
+import pytest
+
+from hl7_listener.ack import ack_frame
+from hl7_listener.header import scan_msh
+
+_hl7_messages_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "../resources/hl7_messages")
+
+# MSH-7 (timestamp) and MSH-10 (the ACK's own control ID) differ between runs.
+_VARYING_FIELDS = (7, 10)
+
+
+def comparable(ack: hl7.Message) -> list:
+    msh = ack.segment("MSH")
+    fields = [str(msh(n)) for n in range(1, len(msh)) if n not in _VARYING_FIELDS]
+    return fields + [str(ack.segment("MSA"))]
+
+
+def parse_frame(frame: bytes) -> hl7.Message:
+    assert frame[:1] == b"\x0b" and frame[-2:] == b"\x1c\r"
+    return hl7.parse(frame[1:-2].decode())
+
+
+@pytest.mark.parametrize("msh", [
+    *(
+        scan_msh(open(os.path.join(_hl7_messages_dir, name), "rb").read()).segment
+        for name in sorted(os.listdir(_hl7_messages_dir))
+    ),
+    b"MSH$%|*#&$APP$FAC$RECV$RFAC$20240101$$ORU%R01%ORU_R01$CTRL1$P%T$2.5%US",
+])
+@pytest.mark.parametrize("ack_code", ["AA", "AE", "AR"])
+def test_matches_hl7_create_ack(msh, ack_code):
+    expected = hl7.parse(msh.decode()).create_ack(ack_code=ack_code)
+    ack = parse_frame(ack_frame(msh, ack_code))
+    assert comparable(ack) == comparable(expected)
+    assert len(str(ack.segment("MSH")(10))) == 20
+
+
+def test_short_msh():
+    # hl7's create_ack fails on this header.
+    ack = parse_frame(ack_frame(b"MSH|^~\\&|APP|FAC", "AR"))
+    assert str(ack.segment("MSH")(5)) == "APP"
+    assert str(ack.segment("MSA")) == "MSA|AR|"
+
+
+def test_control_ids_are_unique():
+    msh = b"MSH|^~\\&|APP|FAC|RECV|RFAC|20240101||ADT^A01|CTRL1|P|2.5"
+    ids = {str(parse_frame(ack_frame(msh)).segment("MSH")(10)) for _ in range(1000)}
+    assert len(ids) == 1000
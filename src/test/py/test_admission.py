@@ -0,0 +1,42 @@
+"""Tests for admission.py."""
+
+import asyncio
+
+import pytest
+
+from hl7_listener.admission import AdmissionController
+
+
+@pytest.mark.asyncio
+async def test_reads_pause_at_high_water_and_resume_at_low_water():
+    admission = AdmissionController(max_messages=4, max_bytes=1000, low_water_ratio=0.5)
+    for _ in range(3):
+        admission.admit(100)
+    await asyncio.wait_for(admission.wait_for_capacity(), 1)
+
+    admission.admit(100)
+    assert admission.paused
+    waiter = asyncio.create_task(admission.wait_for_capacity())
+    admission.release(100)
+    await asyncio.sleep(0)
+    assert not waiter.done()
+
+    admission.release(100)
+    await asyncio.wait_for(waiter, 1)
+    assert not admission.paused
+
+
+def test_byte_limit_pauses_reads():
+    admission = AdmissionController(max_bytes=1000)
+    admission.admit(1000)
+    assert admission.paused
+    admission.release(1000)
+    assert not admission.paused
+
+
+def test_connection_cap():
+    admission = AdmissionController(max_connections=1)
+    assert admission.connect()
+    assert not admission.connect()
+    admission.disconnect()
+    assert admission.connect()
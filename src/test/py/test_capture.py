@@ -0,0 +1,49 @@
+"""Tests for capture.py."""
+
+import pytest
+
+from hl7_listener.capture import (
+    CaptureWriter,
+    read_capture,
+)
+
+MESSAGE = b"MSH|^~\\&|SENDER|FACILITY|||20240101||ADT^A01|MSG00001|P|2.5\rPID|1"
+
+
+def reverse(data: bytes) -> bytes:
+    return data[::-1]
+
+
+@pytest.mark.parametrize("compress,encrypt", [(False, None), (True, reverse)])
+def test_round_trip(tmp_path, compress, encrypt):
+    path = str(tmp_path / "capture.bin")
+    writer = CaptureWriter(path, compress=compress, encrypt=encrypt)
+    writer.record(memoryview(MESSAGE), "10.0.0.1")
+    writer.record(MESSAGE.replace(b"MSG00001", b"MSG00002"), "10.0.0.2")
+    writer.close()
+
+    frames = list(read_capture(path, decrypt=encrypt))
+    assert [(frame.peer, frame.message) for frame in frames] == [
+        ("10.0.0.1", MESSAGE),
+        ("10.0.0.2", MESSAGE.replace(b"MSG00001", b"MSG00002")),
+    ]
+    assert frames[0].timestamp <= frames[1].timestamp
+    if encrypt is not None:
+        assert MESSAGE not in open(path, "rb").read()
+        with pytest.raises(ValueError):
+            list(read_capture(path))
+
+
+def test_truncated_capture_and_size_limit(tmp_path):
+    path = str(tmp_path / "capture.bin")
+    writer = CaptureWriter(path, max_bytes=150)
+    writer.record(MESSAGE, "10.0.0.1")
+    # Beyond max_bytes nothing more is captured.
+    writer.record(MESSAGE, "10.0.0.1")
+    assert writer.full
+    writer.close()
+    # A capture cut short within a record is read up to its last complete record.
+    with open(path, "ab") as capture:
+        capture.write(open(path, "rb").read()[8:40])
+
+    assert [frame.message for frame in read_capture(path)] == [MESSAGE]
@@ -0,0 +1,69 @@
+"""Tests for messaging/compression.py."""
+
+import gzip
+import os
+from unittest.mock import AsyncMock
+
+import pytest
+from nats.aio.client import Client as NATS_Client
+
+# Imports the messagers in dependency order.
+import hl7_listener.messaging.settings  # noqa: F401
+from hl7_listener.messaging.compression import Compressor
+from hl7_listener.messaging.nats import (
+    CONTENT_ENCODING_HEADER,
+    NATSMessager,
+)
+
+LARGE_ORU = b"MSH|^~\\&|LAB||||||ORU^R01|MSG1|P|2.5\rOBX|1|ED|PDF||^AP^PDF^Base64^" + b"QUJD" * 4096
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("offload_bytes", [1 << 30, 0])
+async def test_gzip_round_trip(offload_bytes):
+    compressor = Compressor("gzip", min_bytes=1024, offload_bytes=offload_bytes)
+    data, encoding = await compressor.compress(LARGE_ORU)
+    assert encoding == "gzip"
+    assert len(data) < len(LARGE_ORU)
+    assert gzip.decompress(data) == LARGE_ORU
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("offload_bytes", [1 << 30, 0])
+async def test_zstd_round_trip(offload_bytes):
+    zstandard = pytest.importorskip("zstandard")
+    compressor = Compressor("zstd", min_bytes=1024, offload_bytes=offload_bytes)
+    for _ in range(2):
+        # The second compression reuses the thread's context.
+        data, encoding = await compressor.compress(LARGE_ORU)
+        assert encoding == "zstd"
+        assert len(data) < len(LARGE_ORU)
+        assert zstandard.ZstdDecompressor().decompress(data) == LARGE_ORU
+
+
+@pytest.mark.asyncio
+async def test_small_and_incompressible_payloads_are_sent_as_is():
+    compressor = Compressor("gzip", min_bytes=1024, offload_bytes=1 << 30)
+    assert await compressor.compress(b"MSH|short") == (b"MSH|short", None)
+    noise = os.urandom(4096)
+    assert await compressor.compress(noise) == (noise, None)
+
+
+def test_unsupported_algorithm():
+    with pytest.raises(ValueError):
+        Compressor("lz4", min_bytes=0, offload_bytes=0)
+
+
+@pytest.mark.asyncio
+async def test_nats_marks_compressed_payload(mocker):
+    mocker.patch.object(NATS_Client, "connect")
+    messager = NATSMessager()
+    await messager.connect()
+    messager.compressor = Compressor("gzip", min_bytes=1024, offload_bytes=1 << 30)
+    request = mocker.patch.object(messager.conn, "request", new=AsyncMock())
+
+    await messager.send_msg(LARGE_ORU)
+
+    kwargs = request.await_args.kwargs
+    assert kwargs["headers"][CONTENT_ENCODING_HEADER] == "gzip"
+    assert gzip.decompress(kwargs["payload"]) == LARGE_ORU
@@ -0,0 +1,67 @@
+"""Tests for dedupe.py."""
+
+import pytest
+
+from hl7_listener.dedupe import DuplicateCache
+from hl7_listener.header import scan_msh
+
+ADT = b"MSH|^~\\&|EPIC|HOSP|RECV|RFAC|20240101||ADT^A01|CTRL1|P|2.5\rPID|1"
+
+
+def key(cache: DuplicateCache, frame: bytes):
+    return cache.key(scan_msh(frame), frame)
+
+
+def publish(cache: DuplicateCache, frame: bytes) -> None:
+    assert cache.original(key(cache, frame)) is None
+    cache.finished(key(cache, frame), True)
+
+
+@pytest.mark.asyncio
+async def test_retransmission_is_a_hit(mocker):
+    clock = mocker.patch("hl7_listener.dedupe.time.monotonic", return_value=100.0)
+    cache = DuplicateCache(max_entries=10, ttl_s=60)
+    publish(cache, ADT)
+
+    assert await cache.original(cache.key(scan_msh(ADT), memoryview(ADT)))
+    # Same control ID, different content, or a different sending facility.
+    assert cache.original(key(cache, ADT + b"\rNTE|1")) is None
+    assert cache.original(key(cache, ADT.replace(b"HOSP", b"CLINIC"))) is None
+    clock.return_value = 161.0
+    assert cache.original(key(cache, ADT)) is None
+
+
+@pytest.mark.asyncio
+async def test_retransmission_waits_for_its_original():
+    cache = DuplicateCache(max_entries=10, ttl_s=60)
+    assert cache.original(key(cache, ADT)) is None
+    retransmission = cache.original(key(cache, ADT))
+    assert not retransmission.done()
+
+    cache.finished(key(cache, ADT), False)
+    # A failed original is not remembered; the next copy is published again.
+    assert await retransmission is False
+    assert cache.original(key(cache, ADT)) is None
+    cache.finished(key(cache, ADT), True)
+    assert await cache.original(key(cache, ADT)) is True
+
+
+@pytest.mark.asyncio
+async def test_eviction(mocker):
+    clock = mocker.patch("hl7_listener.dedupe.time.monotonic", return_value=100.0)
+    cache = DuplicateCache(max_entries=2, ttl_s=60)
+    first, second, third = (ADT + bytes([n]) for n in range(3))
+    publish(cache, first)
+    publish(cache, second)
+    # A hit makes first the most recently seen, so second is evicted.
+    assert cache.original(key(cache, first)) is not None
+    publish(cache, third)
+    assert len(cache) == 2
+    assert cache.original(key(cache, first)) is not None
+    assert cache.original(key(cache, third)) is not None
+    assert cache.original(key(cache, second)) is None
+    cache.finished(key(cache, second), False)
+
+    clock.return_value = 200.0
+    publish(cache, second)
+    assert len(cache) == 1
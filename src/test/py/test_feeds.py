@@ -0,0 +1,123 @@
+"""Tests for feeds.py."""
+
+from unittest.mock import (
+    AsyncMock,
+    Mock,
+)
+
+import pytest
+
+from hl7_listener import (
+    main,
+    metrics,
+)
+from hl7_listener.admission import AdmissionController
+from hl7_listener.feeds import build_feeds
+from hl7_listener.messaging.nats import NATSMessager
+from hl7_listener.settings import (
+    ListenerConfig,
+    Settings,
+)
+
+
+def feed_settings(**kwargs) -> Settings:
+    return Settings(
+        HL7_MLLP_HOST="0.0.0.0",
+        HL7_MLLP_PORT=2575,
+        HL7_LISTENERS=[
+            ListenerConfig(
+                name="lab",
+                port=2576,
+                encoding="ISO-8859-1",
+                destination="hl7.lab",
+                max_connections=1,
+            ),
+        ],
+        **kwargs,
+    )
+
+
+def test_build_feeds():
+    default, lab = build_feeds(feed_settings(HL7_RAW_BYTES=True), AdmissionController())
+    assert (default.name, default.host, default.port, default.encoding) == (
+        "default", "0.0.0.0", 2575, "UTF-8"
+    )
+    assert (lab.host, lab.port, lab.encoding, lab.destination) == (
+        "0.0.0.0", 2576, "ISO-8859-1", "hl7.lab"
+    )
+    # Raw bytes are labelled with each feed's own encoding.
+    assert default.raw_bytes and lab.raw_bytes
+
+    settings = feed_settings()
+    settings.HL7_LISTENERS.append(ListenerConfig(name="lab", port=2577))
+    with pytest.raises(ValueError):
+        build_feeds(settings, AdmissionController())
+
+
+def test_feed_metrics_render_grouped(mocker):
+    registry = mocker.patch.object(metrics, "REGISTRY", metrics.Registry())
+    build_feeds(feed_settings(), AdmissionController())
+
+    lines = registry.render().splitlines()
+    families = [line.split()[2] for line in lines if line.startswith("# TYPE")]
+    assert len(families) == len(set(families))
+    # Every sample follows the HELP/TYPE lines of its own family.
+    family = None
+    for line in lines:
+        if line.startswith("# TYPE"):
+            family = line.split()[2]
+        elif not line.startswith("#"):
+            assert line.startswith(family)
+    assert 'hl7_listener_feed_admitted_bytes{feed="default"} 0' in lines
+    assert 'hl7_listener_feed_admitted_bytes{feed="lab"} 0' in lines
+
+
+def test_feed_limits_are_separate():
+    shared = AdmissionController(max_connections=3)
+    default, lab = build_feeds(feed_settings(), shared)
+    assert lab.connect()
+    assert not lab.connect()
+    assert default.connect() and default.connect()
+    assert shared.connections == 3
+    lab.disconnect()
+    assert shared.connections == 2 and lab.admission.connections == 0
+
+
+@pytest.mark.asyncio
+async def test_feed_message_goes_to_feed_destination(mocker):
+    _, lab = build_feeds(feed_settings(), AdmissionController())
+    message = "MSH|^~\\&|LAB|HOSP|||20240101||ORU^R01|C1|P|2.5\rOBX|1|ST|||Zoë\r"
+    asyncmock_reader = AsyncMock()
+    asyncmock_reader.at_eof = Mock(side_effect=[False, True])
+    mocker.patch.object(
+        asyncmock_reader, "readuntil",
+        side_effect=[b"\x0b" + message.encode("latin-1") + b"\x1c\r"]
+    )
+    asyncmock_writer = AsyncMock()
+    asyncmock_writer.close = Mock()
+    mocker.patch.object(asyncmock_writer, "write")
+    send_msg = mocker.patch.object(NATSMessager, "send_msg")
+
+    await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer, feed=lab)
+
+    send_msg.assert_awaited_once_with(
+        msg=message, msg_id="C1", destination="hl7.lab", encoding=None
+    )
+
+
+@pytest.mark.asyncio
+async def test_raw_feed_message_keeps_feed_charset(mocker):
+    _, lab = build_feeds(feed_settings(HL7_RAW_BYTES=True), AdmissionController())
+    message = "MSH|^~\\&|LAB|HOSP|||20240101||ORU^R01|C1|P|2.5\rOBX|1|ST|||Zoë\r".encode("latin-1")
+    asyncmock_reader = AsyncMock()
+    asyncmock_reader.at_eof = Mock(side_effect=[False, True])
+    mocker.patch.object(asyncmock_reader, "readuntil", side_effect=[b"\x0b" + message + b"\x1c\r"])
+    asyncmock_writer = AsyncMock()
+    asyncmock_writer.close = Mock()
+    mocker.patch.object(asyncmock_writer, "write")
+    send_msg = mocker.patch.object(NATSMessager, "send_msg")
+
+    await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer, feed=lab)
+
+    assert bytes(send_msg.await_args.kwargs["msg"]) == message
+    assert send_msg.await_args.kwargs["encoding"] == "ISO-8859-1"
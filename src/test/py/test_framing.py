@@ -0,0 +1,71 @@
+"""Tests for framing.py."""
+
+import asyncio
+
+import pytest
+
+from hl7_listener.framing import (
+    FrameTooLarge,
+    LargeFrame,
+    read_frame,
+)
+
+
+def reader(*frames: bytes, limit: int = 64) -> asyncio.StreamReader:
+    stream = asyncio.StreamReader(limit=limit)
+    for frame in frames:
+        stream.feed_data(b"\x0b" + frame + b"\x1c\r")
+    stream.feed_eof()
+    return stream
+
+
+@pytest.mark.asyncio
+async def test_read_frame():
+    frame = await read_frame(reader(b"MSH|^~\\&|A"))
+    assert bytes(frame) == b"MSH|^~\\&|A"
+
+
+@pytest.mark.asyncio
+async def test_frame_too_large_keeps_the_connection_in_sync():
+    message = b"MSH|^~\\&|A\r" + b"x" * 500
+    stream = reader(message, b"MSH|^~\\&|B")
+
+    with pytest.raises(FrameTooLarge) as exp:
+        await read_frame(stream, max_bytes=200)
+    assert exp.value.size == len(message)
+    assert exp.value.head.startswith(b"MSH|^~\\&|A")
+    # The rest of the frame was discarded; the next one is read as usual.
+    assert bytes(await read_frame(stream, max_bytes=200)) == b"MSH|^~\\&|B"
+
+    # Frames that fit the buffer are checked too.
+    with pytest.raises(FrameTooLarge):
+        await read_frame(reader(b"MSH|^~\\&|A"), max_bytes=5)
+
+
+@pytest.mark.asyncio
+async def test_large_frame_is_spilled():
+    message = b"MSH|^~\\&|A\r" + b"x" * 500
+    stream = reader(message, b"MSH|^~\\&|B")
+
+    frame = await read_frame(stream, max_bytes=1000, spill_bytes=200)
+    assert isinstance(frame, LargeFrame)
+    assert len(frame) == len(message)
+    assert frame.head.startswith(b"MSH|^~\\&|A")
+    assert frame.file.read() == message
+    frame.close()
+
+    assert bytes(await read_frame(stream, spill_bytes=200)) == b"MSH|^~\\&|B"
+
+    with pytest.raises(FrameTooLarge):
+        await read_frame(reader(message), max_bytes=200, spill_bytes=100)
+
+
+@pytest.mark.asyncio
+async def test_frame_larger_than_the_buffer_is_collected():
+    message = b"MSH|^~\\&|A\r" + b"x" * 500
+    stream = reader(message, b"MSH|^~\\&|B")
+
+    frame = await read_frame(stream, max_bytes=1000)
+    assert isinstance(frame, memoryview)
+    assert bytes(frame) == message
+    assert bytes(await read_frame(stream)) == b"MSH|^~\\&|B"
@@ -0,0 +1,67 @@
+"""Tests for header.py."""
+
+import os
+
+import hl7
+import pytest
+
+from hl7_listener.header import scan_msh
+
+package_directory = os.path.dirname(os.path.abspath(__file__))
+_hl7_messages_relative_dir = os.path.join(package_directory + "/../resources", "hl7_messages")
+
+
+@pytest.mark.parametrize(
+    "file_name", ["adt-a01-sample01.hl7", "adt-a01-sample04.hl7", "oru-r01-sample01.hl7", "oru-r01-sample06.hl7"]
+)
+def test_scan_msh_matches_full_parse(file_name):
+    with open(os.path.join(_hl7_messages_relative_dir, file_name), "rb") as file:
+        data = file.read()
+    # Senders terminate segments with <CR>; the sample files use <LF>.
+    data = data.replace(b"\n", b"\r")
+    parsed = hl7.parse(data)
+
+    header = scan_msh(memoryview(data))
+
+    assert header.message_type == parsed["MSH.F9.R1.1"]
+    assert header.trigger_event == parsed["MSH.F9.R1.2"]
+    assert header.control_id == parsed["MSH.F10"]
+    assert header.sending_facility == str(parsed.segment("MSH")(4))
+    assert header.processing_id == parsed["MSH.F11.R1.1"]
+    assert header.segment == str(parsed.segment("MSH")).encode()
+
+
+def test_scan_msh_honours_declared_separators():
+    header = scan_msh(b"MSH#$~\\&#APP#FAC#RAPP#RFAC#20240101##ORU$R01$ORU_R01#CTRL1#P#2.5\rPID#1")
+
+    assert header.field_separator == "#"
+    assert header.encoding_characters == "$~\\&"
+    assert header.type == "ORU^R01"
+    assert (header.sending_application, header.sending_facility) == ("APP", "FAC")
+    assert header.control_id == "CTRL1"
+
+
+def test_scan_msh_short_header():
+    header = scan_msh(b"MSH|^~\\&|APP")
+
+    assert header.sending_application == "APP"
+    assert header.type == "^"
+    assert header.control_id == ""
+
+
+@pytest.mark.parametrize("leading", [b"\r", b"\n", b"\r\n", b" \r\n" * 1000])
+def test_scan_msh_skips_leading_blank_lines(leading):
+    data = leading + b"MSH|^~\\&|APP|FAC|||20240101||ADT^A01|CTRL1|P|2.5\rPID|1"
+    parsed = hl7.parse(data.decode())
+
+    header = scan_msh(memoryview(data))
+
+    assert header.type == "ADT^A01"
+    assert header.control_id == "CTRL1"
+    assert header.segment == str(parsed.segment("MSH")).encode()
+
+
+@pytest.mark.parametrize("data", [b"not an hl7 message", b"", b"PID|1\rMSH|^~\\&|"])
+def test_scan_msh_rejects_non_msh(data):
+    with pytest.raises(hl7.exceptions.ParseException):
+        scan_msh(data)
@@ -0,0 +1,51 @@
+"""Tests for lifecycle.py."""
+
+import asyncio
+
+import pytest
+
+from hl7_listener.lifecycle import Connections
+
+
+async def connection(connections: Connections, message_s: float, handled: list) -> None:
+    connections.opened()
+    try:
+        while connections.ready_for_message():
+            await asyncio.sleep(0.01)
+            connections.busy()
+            await asyncio.sleep(message_s)
+            handled.append(message_s)
+    finally:
+        connections.closed()
+
+
+@pytest.mark.asyncio
+async def test_drain_finishes_messages_in_flight():
+    connections = Connections()
+    handled = []
+    idle = asyncio.create_task(connection(connections, 10, handled))
+    await asyncio.sleep(0)
+    busy = asyncio.create_task(connection(connections, 0.05, handled))
+    await asyncio.sleep(0.02)
+    assert len(connections) == 2
+
+    await connections.drain(timeout_s=1)
+
+    # The busy connection ACKed its message and closed; the other was interrupted.
+    assert handled == [0.05]
+    assert busy.done() and not busy.cancelled()
+    assert idle.cancelled()
+    assert len(connections) == 0
+
+
+@pytest.mark.asyncio
+async def test_drain_deadline():
+    connections = Connections()
+    handled = []
+    slow = asyncio.create_task(connection(connections, 10, handled))
+    await asyncio.sleep(0.02)
+
+    await asyncio.wait_for(connections.drain(timeout_s=0.05), 1)
+
+    assert slow.cancelled()
+    assert handled == []
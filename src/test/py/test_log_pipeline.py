@@ -0,0 +1,55 @@
+"""Tests for log_pipeline.py."""
+
+import io
+import json
+
+import structlog
+
+from hl7_listener.log_pipeline import (
+    LogSampler,
+    LogWriter,
+    QueueLogger,
+    _to_queue,
+)
+
+
+def run(sampler, method_name, **event_dict):
+    try:
+        return sampler(None, method_name, event_dict)
+    except structlog.DropEvent:
+        return None
+
+
+def test_sampling_keeps_every_nth_info_event():
+    sampler = LogSampler({"HL7LLOG007": 0.1, "HL7LLOG008": 0}, {})
+    kept = [run(sampler, "info", logging_code="HL7LLOG007") for _ in range(100)]
+    assert sum(event is not None for event in kept) == 10
+    assert run(sampler, "info", logging_code="HL7LLOG008") is None
+    # Other codes, and warnings or errors of any code, always pass.
+    assert run(sampler, "info", logging_code="HL7LLOG003") is not None
+    assert run(sampler, "error", logging_code="HL7LLOG008") is not None
+    assert sampler.take_suppressed() == {"HL7LLOG007": 90, "HL7LLOG008": 1}
+    assert sampler.take_suppressed() == {}
+
+
+def test_rate_limit_per_second(mocker):
+    clock = mocker.patch("hl7_listener.log_pipeline.time.monotonic", return_value=100.0)
+    sampler = LogSampler({}, {"HL7LLOG003": 2})
+    assert [run(sampler, "info", logging_code="HL7LLOG003") is not None for _ in range(3)] == [
+        True, True, False
+    ]
+    clock.return_value = 101.0
+    assert run(sampler, "info", logging_code="HL7LLOG003") is not None
+
+
+def test_writer_renders_on_background_thread():
+    stream = io.StringIO()
+    writer = LogWriter([structlog.processors.JSONRenderer()], 100, stream)
+    writer.start()
+    log = structlog.wrap_logger(QueueLogger(writer), processors=[_to_queue])
+    log.info("received", logging_code="HL7LLOG003", type="ADT^A01")
+    writer.stop()
+
+    assert json.loads(stream.getvalue()) == {
+        "event": "received", "logging_code": "HL7LLOG003", "type": "ADT^A01"
+    }
@@ -1,5 +1,6 @@
 """Tests for main.py."""
 
+import asyncio
 import json
 import os
 from pathlib import Path
@@ -9,6 +10,7 @@ from unittest.mock import (
 )
 from hl7_listener.messaging.settings import CloudMessagingSettings
 from covera_cloud_integration import CloudMessage
+import hl7
 import pytest
 import structlog
 from covera import loglib
@@ -16,6 +18,7 @@ from nats.aio.client import Client as NATS_Client
 from nats.aio.errors import ErrNoServers
 
 from hl7_listener import main
+from hl7_listener.dedupe import DuplicateCache
 from hl7_listener.messaging.nats import NATSMessager, PILOT_HEADER
 from hl7_listener.settings import settings
 
@@ -25,6 +28,14 @@ config_file = os.path.join(package_directory + root_path, "config.ini")
 _hl7_messages_relative_dir = os.path.join(package_directory + root_path, "hl7_messages")
 
 
+def mllp_frame(hl7_text: str) -> bytes:
+    return b"\x0b" + hl7_text.encode() + b"\x1c\r"
+
+
+def written_acks(writer) -> list:
+    """The ACK messages written to a mocked stream writer."""
+    return [hl7.parse(call.args[0][1:-2].decode()) for call in writer.write.call_args_list]
+
 
 @pytest.fixture
 def mock_pilot_settings(mocker) -> Mock:
@@ -32,6 +43,7 @@ def mock_pilot_settings(mocker) -> Mock:
     pilot_mode_mock.NATS_OUTGOING_SUBJECT = "test-subject"
     pilot_mode_mock.NATS_SERVER_URL = "test-url"
     pilot_mode_mock.PILOT_MODE.return_value = True
+    pilot_mode_mock.NATS_JETSTREAM_ENABLED = False
     return pilot_mode_mock
 
 
@@ -110,27 +122,31 @@ async def test_processed_received_hl7_messages(mocker, caplog):
     asyncmock_reader = AsyncMock()
     asyncmock_reader.at_eof = Mock()
     asyncmock_reader.at_eof.side_effect = [False, True]
-    mock_hl7_message = Mock()
-    mocker.patch.object(mock_hl7_message, "__str__", return_value=hl7_text)
-    mocker.patch.object(mock_hl7_message, "create_ack", return_value="ack")
-    mocker.patch.object(asyncmock_reader, "readmessage", return_value=mock_hl7_message)
+    mocker.patch.object(asyncmock_reader, "readuntil", return_value=mllp_frame(hl7_text))
 
     # Mock writer input parameter.
     asyncmock_writer = AsyncMock()
     mocker.patch.object(
         asyncmock_writer, "get_extra_info", return_value="test_hl7_peername"
     )
-    mocker.patch.object(asyncmock_writer, "writemessage")
+    mocker.patch.object(asyncmock_writer, "write")
     mocker.patch.object(asyncmock_writer, "drain")
 
     mocker.patch.object(NATSMessager, "send_msg", new=AsyncMock())
 
+    def written_ack():
+        ack = written_acks(asyncmock_writer)[-1]
+        return str(ack.segment("MSA")(1)), str(ack.segment("MSA")(2))
+
     # Above mocks setup to test the "happy" path.
     #
     await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer)
     # Expect default "Application Accept" (AA) ack_code.
-    mock_hl7_message.create_ack.assert_called_once_with()
-    asyncmock_writer.writemessage.assert_called_once_with("ack")
+    NATSMessager.send_msg.assert_awaited_once_with(
+        msg=hl7_text, msg_id="MSG00001", destination=None, encoding=None
+    )
+    asyncmock_writer.write.assert_called_once()
+    assert written_ack() == ("AA", "MSG00001")
     asyncmock_writer.drain.assert_called_once()
 
     # Test force hl7 parse exception.
@@ -138,39 +154,34 @@ async def test_processed_received_hl7_messages(mocker, caplog):
     #
     asyncmock_reader.reset_mock()
     asyncmock_reader.at_eof.side_effect = [False, True]
+    asyncmock_reader.readuntil.return_value = mllp_frame("not an hl7 message")
     asyncmock_writer.reset_mock()
-    mock_hl7_message.reset_mock()
-    # Last param needed to save mock calls.
-    mocker.patch.object(mock_hl7_message, "create_ack", mock_hl7_message)
-    mocker.patch.object(mock_hl7_message, "__str__", return_value="not an hl7 message")
     await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer)
-    assert "ack_code='AR'" in str(mock_hl7_message.mock_calls[0])
+    assert written_ack() == ("AR", "")
+
     # Test asyncio.IncompleteReadError.
     # The exception is raised with this scenario.
     #
     asyncmock_reader.reset_mock()
     asyncmock_reader.at_eof.side_effect = [False, False]
-    asyncmock_reader.readmessage.side_effect = Exception(
+    asyncmock_reader.readuntil.side_effect = Exception(
         "some bytes".encode(), 22
     )
     with pytest.raises(Exception):
         await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer)
 
-    # Test general Exception after hl7_message is defined. This should result in
+    # Test general Exception after a message was received. This should result in
     # an Application Error (AE) ack_code and no raised exception.
     #
     asyncmock_reader.reset_mock()
     asyncmock_reader.at_eof.side_effect = [False, True]
-    asyncmock_reader.readmessage.side_effect = None
+    asyncmock_reader.readuntil.side_effect = None
+    asyncmock_reader.readuntil.return_value = mllp_frame(hl7_text)
     asyncmock_writer.reset_mock()
-    mock_hl7_message.reset_mock()
-    # Last param needed to save mock calls.
-    mocker.patch.object(mock_hl7_message, "create_ack", mock_hl7_message)
-    mocker.patch.object(mock_hl7_message, "__str__", return_value=hl7_text)
     NATSMessager.send_msg.side_effect = Exception("force exception from mock")
     await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer)
 
-    assert "ack_code='AE'" in str(mock_hl7_message.mock_calls[0])
+    assert written_ack() == ("AE", "MSG00001")
 
     # Verify a specific log statement has been spooled and has the proper context arguments
     found_log_statement = False
@@ -188,4 +199,362 @@ async def test_hl7_receiver_exception(mocker):
     # Session config parameters should result in a connection error that
     # raises an Exception.
     with pytest.raises(Exception):
-        await main.hl7_receiver()
\ No newline at end of file
+        await main.hl7_receiver()
+
+
+@pytest.mark.asyncio
+async def test_processed_received_hl7_messages_pipelined(mocker):
+    with open(_hl7_messages_relative_dir + "/adt-a01-sample01.hl7", "r") as file:
+        hl7_text = str(file.read())
+    messages = [
+        mllp_frame(hl7_text.replace("MSG00001", f"MSG0000{i}")) for i in range(3)
+    ]
+
+    asyncmock_reader = AsyncMock()
+    asyncmock_reader.at_eof = Mock()
+    asyncmock_reader.at_eof.side_effect = [False, False, False, True]
+    mocker.patch.object(asyncmock_reader, "readuntil", side_effect=messages)
+
+    asyncmock_writer = AsyncMock()
+    asyncmock_writer.close = Mock()
+    mocker.patch.object(
+        asyncmock_writer, "get_extra_info", return_value="test_hl7_peername"
+    )
+    mocker.patch.object(asyncmock_writer, "write")
+
+    # The first publish completes last; its ACK must still be written first.
+    delays = iter([0.03, 0.01, 0])
+
+    async def send_msg(msg, msg_id=None, destination=None, encoding=None):
+        await asyncio.sleep(next(delays))
+
+    mocker.patch.object(NATSMessager, "send_msg", side_effect=send_msg)
+    mocker.patch.object(settings, "HL7_PIPELINE_WINDOW", 2)
+
+    await main.process_received_hl7_messages_pipelined(asyncmock_reader, asyncmock_writer)
+
+    acks = written_acks(asyncmock_writer)
+    assert [str(ack.segment("MSA")(1)) for ack in acks] == ["AA"] * 3
+    assert [str(ack.segment("MSA")(2)) for ack in acks] == [
+        "MSG00000", "MSG00001", "MSG00002"
+    ]
+    assert asyncmock_writer.drain.await_count == 3
+
+    # A failed publish is answered with AE and no later ACK is sent.
+    asyncmock_reader.at_eof.side_effect = [False, False, False, True]
+    asyncmock_reader.readuntil.side_effect = messages
+    asyncmock_writer.write.reset_mock()
+    NATSMessager.send_msg.side_effect = [None, Exception("force exception from mock"), None]
+
+    await main.process_received_hl7_messages_pipelined(asyncmock_reader, asyncmock_writer)
+
+    acks = written_acks(asyncmock_writer)
+    assert [str(ack.segment("MSA")(1)) for ack in acks] == ["AA", "AE"]
+
+
+@pytest.mark.asyncio
+async def test_retransmission_is_acked_without_publishing(mocker):
+    with open(_hl7_messages_relative_dir + "/adt-a01-sample01.hl7", "r") as file:
+        message = mllp_frame(str(file.read()))
+
+    asyncmock_reader = AsyncMock()
+    asyncmock_reader.at_eof = Mock()
+    asyncmock_reader.at_eof.side_effect = [False, False, True]
+    mocker.patch.object(asyncmock_reader, "readuntil", side_effect=[message, message])
+    asyncmock_writer = AsyncMock()
+    asyncmock_writer.close = Mock()
+    mocker.patch.object(asyncmock_writer, "write")
+    send_msg = mocker.patch.object(NATSMessager, "send_msg")
+    mocker.patch.object(main, "duplicates", DuplicateCache(max_entries=10, ttl_s=60))
+
+    await main.process_received_hl7_messages(asyncmock_reader, asyncmock_writer)
+
+    send_msg.assert_awaited_once()
+    acks = written_acks(asyncmock_writer)
+    assert [str(ack.segment("MSA")(1)) for ack in acks] == ["AA", "AA"]
+
+
+@pytest.mark.asyncio
+async def test_retransmission_during_publish_gets_the_originals_ack(mocker):
+    with open(_hl7_messages_relative_dir + "/adt-a01-sample01.hl7", "r") as file:
+        message = mllp_frame(str(file.read()))
+
+    async def slow_send(msg, msg_id=None, destination=None, encoding=None):
+        await asyncio.sleep(0.05)
+
+    send_msg = mocker.patch.object(NATSMessager, "send_msg", side_effect=slow_send)
+    mocker.patch.object(main, "duplicates", DuplicateCache(max_entries=10, ttl_s=60))
+    writers = []
+
+    async def connection():
+        reader = asyncio.StreamReader()
+        reader.feed_data(message)
+        reader.feed_eof()
+        writer = AsyncMock()
+        writer.close = Mock()
+        writer.write = Mock()
+        writer.get_extra_info = Mock(return_value="test_hl7_peername")
+        writers.append(writer)
+        await main.process_received_hl7_messages(reader, writer)
+
+    # The sender gave up on the first connection and retransmits on a second one.
+    await asyncio.gather(connection(), connection())
+
+    send_msg.assert_awaited_once()
+    assert [str(written_acks(writer)[0].segment("MSA")(1)) for writer in writers] == ["AA", "AA"]
+
+    # A retransmission of a message that failed to publish is answered with AE too.
+    mocker.patch.object(main, "duplicates", DuplicateCache(max_entries=10, ttl_s=60))
+
+    async def failing_send(msg, msg_id=None, destination=None, encoding=None):
+        await asyncio.sleep(0.05)
+        raise Exception("force exception from mock")
+
+    send_msg.side_effect = failing_send
+    writers.clear()
+    await asyncio.gather(connection(), connection())
+    assert [str(written_acks(writer)[0].segment("MSA")(1)) for writer in writers] == ["AE", "AE"]
+
+
+@pytest.mark.asyncio
+async def test_cloud_messaging_reuses_pooled_client(mocker):
+    from hl7_listener.messaging.cloud_messaging import CloudMessager
+    from hl7_listener.messaging import cloud_messaging
+    mock_create_client = mocker.patch.object(cloud_messaging, "create_client")
+    msgr_config_mock = mocker.patch.object(cloud_messaging, "msgr_config")
+    msgr_config_mock.settings = CloudMessagingSettings(CLOUD_SENDER_POOL_SIZE=1)
+
+    mock_client = AsyncMock()
+    mock_create_client.return_value.__aenter__.return_value = mock_client
+    cloud_messager = CloudMessager()
+    await cloud_messager.connect()
+    await cloud_messager.send_msg("first message")
+    await cloud_messager.send_msg("second message")
+    # One client for the whole pool, reused for both messages.
+    assert mock_create_client.call_count == 1
+    assert (cloud_messager.warm_sends, cloud_messager.cold_sends) == (2, 0)
+
+    # A failed link is rebuilt and the send retried on the new client.
+    mock_client.send_message.side_effect = [Exception("link detached"), None]
+    await cloud_messager.send_msg("third message")
+    assert mock_create_client.call_count == 2
+    assert (cloud_messager.warm_sends, cloud_messager.cold_sends) == (2, 1)
+
+    await cloud_messager.close()
+    assert mock_create_client.return_value.__aexit__.await_count == 2
+
+
+@pytest.mark.asyncio
+async def test_cloud_messaging_sends_batches_as_service_bus_batches(mocker):
+    from azure.servicebus import ServiceBusMessageBatch
+    from azure.servicebus.exceptions import MessageSizeExceededError
+    from hl7_listener.messaging.base import OutboundMessage
+    from hl7_listener.messaging.cloud_messaging import CloudMessager
+    from hl7_listener.messaging import cloud_messaging
+    mock_create_client = mocker.patch.object(cloud_messaging, "create_client")
+    mock_create_client.return_value.__aenter__.return_value = AsyncMock()
+    mocker.patch.object(cloud_messaging, "DefaultAzureCredential")
+    mock_service_bus = mocker.patch.object(cloud_messaging, "ServiceBusClient")
+    msgr_config_mock = mocker.patch.object(cloud_messaging, "msgr_config")
+    msgr_config_mock.settings = CloudMessagingSettings(CLOUD_SENDER_POOL_SIZE=1)
+
+    mock_sender = AsyncMock()
+    mock_sender.create_message_batch.side_effect = (
+        lambda: ServiceBusMessageBatch(max_size_in_bytes=1000)
+    )
+    mock_service_bus.return_value = Mock(
+        get_queue_sender=Mock(return_value=mock_sender), close=AsyncMock()
+    )
+    cloud_messager = CloudMessager()
+    await cloud_messager.connect()
+    await cloud_messager.send_batch([OutboundMessage("x" * 400) for _ in range(3)])
+    # Two messages fill the first Service Bus batch; the third goes in a second one.
+    batches = [call.args[0] for call in mock_sender.send_messages.await_args_list]
+    assert [len(batch._messages) for batch in batches] == [2, 1]
+    mock_service_bus.return_value.get_queue_sender.assert_called_once_with("test-queue")
+
+    with pytest.raises(MessageSizeExceededError):
+        await cloud_messager.send_batch([OutboundMessage("x" * 2000)] * 2)
+
+    await cloud_messager.close()
+    mock_sender.close.assert_awaited()
+    mock_service_bus.return_value.close.assert_awaited()
+
+
+@pytest.mark.asyncio
+async def test_batching_messager(mocker):
+    from hl7_listener.messaging.batching import BatchingMessager
+
+    mocker.patch.object(NATS_Client, "connect")
+    nats_messager = NATSMessager()
+    await nats_messager.connect()
+    my_asyncmock = AsyncMock()
+    mocker.patch.object(nats_messager.conn, "request", new=my_asyncmock)
+    messager = BatchingMessager(nats_messager, max_messages=3, max_bytes=1024, max_delay_ms=5)
+
+    # Three messages fill a batch and are flushed without waiting for the timer.
+    await asyncio.gather(*(messager.send_msg(f"message {i}") for i in range(3)))
+    assert my_asyncmock.await_count == 3
+
+    # A partial batch is flushed by the timer.
+    await messager.send_msg("message 3")
+    assert my_asyncmock.await_count == 4
+
+    # Every sender in a failed batch sees the error.
+    my_asyncmock.side_effect = [None, Exception("force exception from mock")]
+    results = await asyncio.gather(
+        messager.send_msg("message 4"), messager.send_msg("message 5"),
+        return_exceptions=True
+    )
+    assert all(isinstance(result, Exception) for result in results)
+
+    # max_bytes counts encoded bytes: 6 characters, 12 bytes in UTF-8.
+    my_asyncmock.side_effect = None
+    messager = BatchingMessager(nats_messager, max_messages=3, max_bytes=12, max_delay_ms=1000)
+    await asyncio.wait_for(messager.send_msg("éééééé"), 0.5)
+
+
+@pytest.mark.asyncio
+async def test_send_msg_jetstream(mock_pilot_settings, mocker):
+    from nats.js.api import PubAck
+
+    mock_pilot_settings.PILOT_MODE = False
+    mock_pilot_settings.NATS_JETSTREAM_ENABLED = True
+    mock_pilot_settings.NATS_PUBACK_WINDOW = 2
+    mock_pilot_settings.NATS_PUBLISH_TIMEOUT = 5
+    mocker.patch.object(NATS_Client, "connect")
+    mock_ = NATSMessager()
+    await mock_.connect()
+    publish_mock = AsyncMock(return_value=PubAck(stream="hl7", seq=1))
+    mocker.patch.object(mock_.js, "publish", new=publish_mock)
+
+    await mock_.send_msg("test message", msg_id="MSG00001")
+    publish_mock.assert_awaited_once_with(
+        subject=mock_pilot_settings.NATS_OUTGOING_SUBJECT,
+        payload="test message".encode(),
+        timeout=5,
+        headers={"Nats-Msg-Id": "MSG00001"}
+    )
+
+    # Messages without a control ID are published without a dedupe header.
+    publish_mock.reset_mock()
+    await mock_.send_msg("test message")
+    assert publish_mock.await_args.kwargs["headers"] is None
+
+
+@pytest.mark.asyncio
+async def test_send_stream_publishes_claim_check(mock_pilot_settings, mocker):
+    import io
+    from nats.js.api import ObjectInfo, PubAck
+
+    mock_pilot_settings.PILOT_MODE = False
+    mock_pilot_settings.NATS_JETSTREAM_ENABLED = True
+    mock_pilot_settings.NATS_PUBACK_WINDOW = 2
+    mock_pilot_settings.NATS_PUBLISH_TIMEOUT = 5
+    mock_pilot_settings.NATS_OBJECT_STORE_BUCKET = "large"
+    mocker.patch.object(NATS_Client, "connect")
+    mock_ = NATSMessager()
+    await mock_.connect()
+    assert mock_.supports_streaming
+    store = Mock()
+    store.put = AsyncMock(return_value=ObjectInfo(
+        name="x", bucket="large", nuid="n", size=11, digest="SHA-256=abc"
+    ))
+    mocker.patch.object(mock_.js, "object_store", new=AsyncMock(return_value=store))
+    publish_mock = AsyncMock(return_value=PubAck(stream="hl7", seq=1))
+    mocker.patch.object(mock_.js, "publish", new=publish_mock)
+
+    stream = io.BytesIO(b"MSH|^~\\&|A")
+    await mock_.send_stream(stream, 11, msg_id="MSG00001")
+
+    name, file = store.put.await_args.args
+    assert file is stream
+    kwargs = publish_mock.await_args.kwargs
+    assert kwargs["payload"] == b""
+    assert kwargs["headers"] == {
+        "Nats-Msg-Id": "MSG00001",
+        "HL7-Object-Bucket": "large",
+        "HL7-Object-Name": name,
+        "HL7-Object-Size": "11",
+        "HL7-Object-Digest": "SHA-256=abc",
+    }
+
+
+@pytest.mark.asyncio
+async def test_oversized_frame_is_rejected(mocker):
+    with open(_hl7_messages_relative_dir + "/adt-a01-sample01.hl7", "r") as file:
+        hl7_text = str(file.read())
+    stream = asyncio.StreamReader(limit=64)
+    stream.feed_data(mllp_frame(hl7_text))
+    stream.feed_eof()
+    asyncmock_writer = AsyncMock()
+    asyncmock_writer.close = Mock()
+    asyncmock_writer.get_extra_info = Mock(return_value="test_hl7_peername")
+    mocker.patch.object(asyncmock_writer, "write")
+    send_msg = mocker.patch.object(NATSMessager, "send_msg")
+    mocker.patch.object(settings, "HL7_MAX_FRAME_BYTES", len(hl7_text) - 1)
+
+    await main.process_received_hl7_messages(stream, asyncmock_writer)
+
+    send_msg.assert_not_awaited()
+    acks = written_acks(asyncmock_writer)
+    # The reject is addressed to the message, read from the start of the frame.
+    assert [str(ack.segment("MSA")(1)) for ack in acks] == ["AR"]
+    assert [str(ack.segment("MSA")(2)) for ack in acks] == ["MSG00001"]
+
+
+@pytest.mark.asyncio
+async def test_unread_connection_stops_reading_from_its_socket():
+    readers = []
+    connected = asyncio.Event()
+
+    async def paused_handler(hl7_reader, hl7_writer):
+        # Like a connection held back by admission control: nothing is read.
+        readers.append(hl7_reader)
+        connected.set()
+        await asyncio.sleep(1)
+        hl7_writer.close()
+
+    server = await hl7.mllp.start_hl7_server(
+        paused_handler, host="127.0.0.1", port=0, limit=main.reader_limit()
+    )
+    async with server:
+        port = server.sockets[0].getsockname()[1]
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"\x0bMSH|^~\\&|A\r" + b"x" * 4194304 + b"\x1c\r")
+        await connected.wait()
+        await asyncio.sleep(0.2)
+        # The rest of the frame is left to TCP backpressure.
+        assert len(readers[0]._buffer) < 1048576
+        writer.transport.abort()
+
+
+@pytest.mark.asyncio
+async def test_send_msg_raw_bytes(mock_pilot_settings, mocker):
+    mock_pilot_settings.PILOT_MODE = False
+    mocker.patch.object(NATS_Client, "connect")
+    mock_ = NATSMessager()
+    await mock_.connect()
+    my_asyncmock = AsyncMock()
+    mocker.patch.object(mock_.conn, "request", new=my_asyncmock)
+    payload = memoryview("MSH|^~\\&|Zoë".encode("latin-1"))
+
+    # UTF-8 bytes are forwarded unchanged and need no charset header.
+    await mock_.send_msg(payload)
+    assert my_asyncmock.await_args.kwargs["payload"] is payload
+    assert "headers" not in my_asyncmock.await_args.kwargs
+
+    # Other charsets are forwarded unchanged and labelled.
+    mocker.patch.object(settings, "HL7_MLLP_ENCODING", "ISO-8859-1")
+    await mock_.send_msg(payload)
+    assert my_asyncmock.await_args.kwargs["payload"] is payload
+    assert my_asyncmock.await_args.kwargs["headers"] == {
+        "Content-Type": "text/plain; charset=ISO-8859-1"
+    }
+
+    # A feed's own charset takes precedence.
+    await mock_.send_msg(payload, encoding="windows-1252")
+    assert my_asyncmock.await_args.kwargs["payload"] is payload
+    assert my_asyncmock.await_args.kwargs["headers"] == {
+        "Content-Type": "text/plain; charset=windows-1252"
+    }
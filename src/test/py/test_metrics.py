@@ -0,0 +1,75 @@
+"""Tests for metrics.py."""
+
+from hl7_listener.metrics import (
+    GaugeFamily,
+    Registry,
+    WaitAgeFamily,
+    merge,
+    peer_label,
+    render,
+)
+
+
+def test_registry_renders_prometheus_text():
+    registry = Registry()
+    counter = registry.counter("messages_total", "Messages.", {"code": "AA"})
+    histogram = registry.histogram("latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    counter.inc()
+    counter.inc(2)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5)
+
+    assert registry.render().splitlines() == [
+        "# HELP messages_total Messages.",
+        "# TYPE messages_total counter",
+        'messages_total{code="AA"} 3',
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+    ]
+
+
+def test_gauge_family_drops_idle_children():
+    registry = Registry()
+    connections = registry.register(GaugeFamily("connections", "Connections.", "peer"))
+    peer = peer_label(("10.0.0.1", 52100))
+    connections.inc(peer)
+    connections.inc(peer_label(("10.0.0.1", 52101)))
+    assert 'connections{peer="10.0.0.1"} 2' in registry.render()
+
+    connections.dec(peer)
+    connections.dec(peer)
+    assert "connections{" not in registry.render()
+
+
+def test_wait_age_family_sums_waits_and_drops_idle_children(mocker):
+    registry = Registry()
+    waiting = registry.register(WaitAgeFamily("waiting_seconds", "Waits.", "flow"))
+    mocker.patch("hl7_listener.metrics.time.perf_counter", return_value=10.0)
+    waiting.start("lab", 1, 7.0)
+    waiting.start("lab", 2, 9.0)
+    assert 'waiting_seconds{flow="lab"} 4.0' in registry.render()
+
+    waiting.stop("lab", 1)
+    assert 'waiting_seconds{flow="lab"} 1.0' in registry.render()
+    waiting.stop("lab", 2)
+    assert "waiting_seconds{" not in registry.render()
+
+
+def test_merge_sums_worker_snapshots():
+    snapshots = []
+    for messages in (2, 3):
+        registry = Registry()
+        registry.counter("messages_total", "Messages.").inc(messages)
+        registry.histogram("latency_seconds", "Latency.", buckets=(1.0,)).observe(0.5)
+        snapshots.append(registry.snapshot())
+
+    rendered = render(merge(snapshots)).splitlines()
+    assert "messages_total 5" in rendered
+    assert 'latency_seconds_bucket{le="1.0"} 2' in rendered
+    assert rendered.count("# TYPE messages_total counter") == 1
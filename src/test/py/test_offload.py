@@ -0,0 +1,73 @@
+"""Tests for offload.py."""
+
+import asyncio
+import threading
+
+import hl7
+import pytest
+
+from hl7_listener import metrics
+from hl7_listener.offload import (
+    Offloader,
+    validate,
+)
+
+MESSAGE = memoryview(b"MSH|^~\\&|SENDER|FACILITY|||20240101||ADT^A01|MSG00001|P|2.5\rPID|1")
+
+
+def thread_name(_: bytes) -> str:
+    return threading.current_thread().name
+
+
+@pytest.mark.asyncio
+async def test_small_messages_run_inline():
+    offloader = Offloader("thread", min_bytes=100)
+    try:
+        assert await offloader.run(99, thread_name, b"") == threading.current_thread().name
+        assert (await offloader.run(100, thread_name, b"")).startswith("hl7-offload")
+    finally:
+        offloader.shutdown()
+
+    # Without an executor everything runs inline.
+    assert await Offloader().run(10 ** 9, thread_name, b"") == threading.current_thread().name
+
+
+@pytest.mark.asyncio
+async def test_pending_tasks_are_bounded():
+    offloader = Offloader("thread", workers=2, min_bytes=0, max_pending=1)
+    release = threading.Event()
+    started = []
+
+    def work():
+        started.append(1)
+        release.wait()
+
+    try:
+        first = asyncio.create_task(offloader.run(1, work))
+        second = asyncio.create_task(offloader.run(1, work))
+        await asyncio.sleep(0.05)
+        # The second task waits for a slot instead of occupying the idle worker.
+        assert metrics.OFFLOAD_PENDING.value == 2
+        assert len(started) == 1
+        release.set()
+        await asyncio.gather(first, second)
+        assert metrics.OFFLOAD_PENDING.value == 0
+    finally:
+        release.set()
+        offloader.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_validate_in_process_pool():
+    offloader = Offloader("process", workers=1, min_bytes=0)
+    try:
+        await offloader.run(len(MESSAGE), validate, MESSAGE, "UTF-8")
+        with pytest.raises(hl7.exceptions.ParseException):
+            await offloader.run(3, validate, memoryview(b"xyz"), "UTF-8")
+    finally:
+        offloader.shutdown()
+
+
+def test_unsupported_executor():
+    with pytest.raises(ValueError):
+        Offloader("fiber")
@@ -0,0 +1,38 @@
+"""Tests for routing.py."""
+
+import pytest
+
+from hl7_listener.header import scan_msh
+from hl7_listener.routing import Router
+from hl7_listener.settings import RoutingRule
+
+
+def header(message_type, facility="LAB", processing_id="P"):
+    return scan_msh(
+        f"MSH|^~\\&|APP|{facility}|RECV|RFAC|20240101||{message_type}|MSG1|{processing_id}|2.5\r"
+        .encode()
+    )
+
+
+@pytest.fixture
+def router():
+    return Router([
+        RoutingRule(processing_id="T", destination="hl7.test"),
+        RoutingRule(message_type="ADT", trigger_event="A08", destination="hl7.ADT.A08"),
+        RoutingRule(message_type="ORU", sending_facility="LAB", destination="hl7.ORU.lab"),
+        RoutingRule(message_type="ORU", destination="hl7.ORU"),
+    ])
+
+
+@pytest.mark.parametrize("message_type,facility,processing_id,destination", [
+    ("ADT^A08", "LAB", "P", "hl7.ADT.A08"),
+    ("ADT^A01", "LAB", "P", None),
+    ("ORU^R01", "LAB", "P", "hl7.ORU.lab"),
+    ("ORU^R01", "CLINIC", "P", "hl7.ORU"),
+    # The first matching rule wins.
+    ("ADT^A08", "LAB", "T", "hl7.test"),
+])
+def test_route(router, message_type, facility, processing_id, destination):
+    assert router.route(header(message_type, facility, processing_id)) == destination
+    # Served from the route cache the second time.
+    assert router.route(header(message_type, facility, processing_id)) == destination
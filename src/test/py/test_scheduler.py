@@ -0,0 +1,88 @@
+"""Tests for scheduler.py."""
+
+import asyncio
+
+import pytest
+
+from hl7_listener import metrics
+from hl7_listener.header import scan_msh
+from hl7_listener.scheduler import FairScheduler
+from hl7_listener.settings import PriorityClass
+
+
+def header(message_type, facility="LAB"):
+    return scan_msh(
+        f"MSH|^~\\&|APP|{facility}|RECV|RFAC|20240101||{message_type}|MSG1|P|2.5\r".encode()
+    )
+
+
+async def send_order(scheduler: FairScheduler, messages) -> list:
+    """Queue (header, peer, size) messages behind a held slot and return the order in
+    which they are granted, one slot at a time."""
+    sent = []
+
+    async def send(name, msg_header, peer, size):
+        await scheduler.acquire(scheduler.flow(msg_header, peer), size)
+        sent.append(name)
+        await asyncio.sleep(0)
+        scheduler.release()
+
+    await scheduler.acquire(scheduler.flow(header("ADT^A01"), "holder"), 1)
+    tasks = [asyncio.create_task(send(name, *message)) for name, message in messages]
+    await asyncio.sleep(0)
+    scheduler.release()
+    await asyncio.gather(*tasks)
+    return sent
+
+
+@pytest.mark.asyncio
+async def test_senders_share_slots():
+    scheduler = FairScheduler(max_concurrent=1)
+    bulk = [(f"bulk{i}", (header("ORU^R01"), "10.0.0.1", 100)) for i in range(4)]
+    adt = [(f"adt{i}", (header("ADT^A01"), "10.0.0.2", 100)) for i in range(2)]
+
+    # The replay queued first does not hold back the other sender.
+    assert await send_order(scheduler, bulk + adt) == [
+        "bulk0", "adt0", "bulk1", "adt1", "bulk2", "bulk3"
+    ]
+    assert metrics.SCHEDULER_QUEUED.children == {}
+    assert metrics.SCHEDULER_WAITING_SECONDS.children == {}
+    assert scheduler.available == 1
+
+
+@pytest.mark.asyncio
+async def test_priority_classes_and_facility_flows():
+    scheduler = FairScheduler(
+        max_concurrent=1,
+        classes=[PriorityClass(name="adt", weight=4, message_type="ADT")],
+        flow_key="sending_facility",
+    )
+    # One peer, two facilities; ADT weighs four times as much as the rest.
+    bulk = [(f"bulk{i}", (header("ORU^R01", "LAB"), "10.0.0.1", 100)) for i in range(3)]
+    adt = [(f"adt{i}", (header("ADT^A01", "ER"), "10.0.0.1", 100)) for i in range(4)]
+
+    assert await send_order(scheduler, bulk + adt) == [
+        "bulk0", "adt0", "adt1", "adt2", "adt3", "bulk1", "bulk2"
+    ]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_waiter_frees_its_place():
+    scheduler = FairScheduler(max_concurrent=1)
+    flow = scheduler.flow(header("ADT^A01"), "10.0.0.1")
+    await scheduler.acquire(flow, 1)
+    waiter = asyncio.create_task(scheduler.acquire(flow, 1))
+    await asyncio.sleep(0)
+    assert 'hl7_listener_scheduler_waiting_seconds{flow="10.0.0.1"}' in metrics.REGISTRY.render()
+    waiter.cancel()
+    await asyncio.gather(waiter, return_exceptions=True)
+
+    assert metrics.SCHEDULER_WAITING_SECONDS.children == {}
+    scheduler.release()
+    assert scheduler.available == 1
+    await asyncio.wait_for(scheduler.acquire(flow, 1), 1)
+
+
+def test_unsupported_flow_key():
+    with pytest.raises(ValueError):
+        FairScheduler(1, flow_key="receiving_facility")
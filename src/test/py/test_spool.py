@@ -0,0 +1,221 @@
+"""Tests for messaging/spool.py."""
+
+import asyncio
+import os
+from unittest.mock import (
+    AsyncMock,
+    Mock,
+)
+
+import pytest
+
+from hl7_listener.messaging.base import OutboundMessage
+from hl7_listener.messaging.spool import (
+    DEAD_LETTER_FILE,
+    Spool,
+    SpoolFailedError,
+    SpoolFullError,
+    SpoolingMessager,
+)
+
+
+def make_spool(directory, segment_bytes=1024, max_bytes=1048576):
+    return Spool(
+        directory=str(directory),
+        segment_bytes=segment_bytes,
+        max_bytes=max_bytes,
+        commit_interval_ms=0,
+    )
+
+
+async def append_and_commit(spool, *messages):
+    commits = asyncio.create_task(spool.run_commits())
+    try:
+        await asyncio.gather(*(spool.append(*message) for message in messages))
+    finally:
+        commits.cancel()
+
+
+@pytest.mark.asyncio
+async def test_spool_replays_undelivered_messages_after_restart(tmp_path):
+    spool = make_spool(tmp_path, segment_bytes=32)
+    spool.open()
+    await append_and_commit(
+        spool, *[(f"message {i}" * 4, f"MSG{i}") for i in range(5)], (b"lab \xe9" * 8, "LAB1", None, "ISO-8859-1"),
+        (b"raw \xe9", None, "hl7.ORU"),
+    )
+    # Small segments force a rotation per message.
+    assert len([name for name in os.listdir(tmp_path) if name.endswith(".seg")]) == 7
+
+    batch = spool.read_batch(2)
+    assert batch.messages == [
+        OutboundMessage("message 0" * 4, "MSG0"), OutboundMessage("message 1" * 4, "MSG1")
+    ]
+    spool.mark_delivered(batch)
+    await spool.close()
+
+    spool = make_spool(tmp_path, segment_bytes=32)
+    spool.open()
+    batch = spool.read_batch(10)
+    assert [message.msg_id for message in batch.messages] == ["MSG2", "MSG3", "MSG4", "LAB1", None]
+    assert batch.messages[-2] == OutboundMessage(b"lab \xe9" * 8, "LAB1", encoding="ISO-8859-1")
+    assert batch.messages[-1] == OutboundMessage(b"raw \xe9", None, "hl7.ORU")
+    spool.mark_delivered(batch)
+    assert spool.undelivered_bytes == 0
+    assert spool.read_batch(10).messages == []
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_drops_torn_record_on_open(tmp_path):
+    spool = make_spool(tmp_path)
+    spool.open()
+    await append_and_commit(spool, ("first", "MSG1"), ("second", "MSG2"))
+    await spool.close()
+    segment = spool.segment_path(1)
+    os.truncate(segment, os.path.getsize(segment) - 3)
+
+    spool = make_spool(tmp_path)
+    spool.open()
+    assert spool.read_batch(10).messages == [OutboundMessage("first", "MSG1")]
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_full(tmp_path):
+    spool = make_spool(tmp_path, max_bytes=64)
+    spool.open()
+    await append_and_commit(spool, ("x" * 40, None))
+    with pytest.raises(SpoolFullError):
+        await spool.append("x" * 40)
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_drops_messages_of_failed_commit(tmp_path, mocker):
+    spool = make_spool(tmp_path, segment_bytes=32)
+    spool.open()
+    await append_and_commit(spool, ("message 0" * 4, "MSG0"))
+    fsync = mocker.patch("hl7_listener.messaging.spool._fsync", side_effect=OSError("EIO"))
+    with pytest.raises(OSError):
+        await append_and_commit(spool, ("message 1" * 4, "MSG1"), ("message 2" * 4, "MSG2"))
+
+    # The failed messages are not delivered after the next successful commit.
+    fsync.side_effect = None
+    await append_and_commit(spool, ("message 3" * 4, "MSG3"))
+    batch = spool.read_batch(10)
+    assert [message.msg_id for message in batch.messages] == ["MSG0", "MSG3"]
+    spool.mark_delivered(batch)
+    assert spool.undelivered_bytes == 0
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spool_fails_when_rollback_fails(tmp_path, mocker):
+    spool = make_spool(tmp_path)
+    spool.open()
+    mocker.patch("hl7_listener.messaging.spool._fsync", side_effect=OSError("EIO"))
+    mocker.patch("hl7_listener.messaging.spool.os.truncate", side_effect=OSError("EIO"))
+    with pytest.raises(OSError):
+        await append_and_commit(spool, ("message", "MSG1"))
+    with pytest.raises(SpoolFailedError):
+        await spool.append("message")
+    await spool.close()
+
+
+@pytest.mark.asyncio
+async def test_spooling_messager_retries_until_delivered(tmp_path):
+    inner = AsyncMock()
+    inner.send_batch.side_effect = [Exception("broker unavailable")] * 3 + [None]
+    inner.is_unavailable = Mock(return_value=True)
+    inner.is_rejected = Mock(return_value=False)
+    # Failures from the broker being unavailable do not count as attempts.
+    messager = SpoolingMessager(
+        inner,
+        make_spool(tmp_path),
+        drain_batch=10,
+        retry_initial_s=0.01,
+        retry_max_s=0.01,
+        max_attempts=1,
+    )
+    await messager.connect()
+
+    await messager.send_msg("message", msg_id="MSG1")
+    for _ in range(100):
+        if messager.spool.undelivered_bytes == 0:
+            break
+        await asyncio.sleep(0.01)
+
+    assert inner.send_batch.await_count == 4
+    inner.send_batch.assert_awaited_with([OutboundMessage("message", "MSG1")])
+    assert messager.spool.undelivered_bytes == 0
+    assert not os.path.exists(tmp_path / DEAD_LETTER_FILE)
+    await messager.close()
+    inner.close.assert_awaited_once()
+
+
+async def drain_with_poison_message(tmp_path, inner, max_attempts):
+    """Spool five messages, the third of which inner fails to send, and drain them."""
+    delivered = []
+
+    async def send_batch(msgs):
+        if any(msg.msg == "poison" for msg in msgs):
+            raise ValueError("message refused")
+        delivered.extend(msg.msg for msg in msgs)
+
+    inner.send_batch.side_effect = send_batch
+    messager = SpoolingMessager(
+        inner,
+        make_spool(tmp_path),
+        drain_batch=4,
+        retry_initial_s=0.001,
+        retry_max_s=0.001,
+        max_attempts=max_attempts,
+    )
+    spool = messager.spool
+    spool.open()
+    await append_and_commit(spool, *(
+        (msg, f"MSG{number}") for number, msg in enumerate(["m1", "m2", "poison", "m4", "m5"], 1)
+    ))
+    drain = asyncio.create_task(messager.drain())
+    for _ in range(500):
+        if spool.undelivered_bytes == 0:
+            break
+        await asyncio.sleep(0.001)
+    drain.cancel()
+    await spool.close()
+    return delivered
+
+
+@pytest.mark.asyncio
+async def test_spooling_messager_dead_letters_poison_message(tmp_path):
+    inner = AsyncMock()
+    inner.is_unavailable = Mock(return_value=False)
+    inner.is_rejected = Mock(return_value=False)
+
+    delivered = await drain_with_poison_message(tmp_path, inner, max_attempts=2)
+
+    # The messages around the poison message are delivered, in order.
+    assert delivered == ["m1", "m2", "m4", "m5"]
+    # Each failing batch, down to the poison message alone, was tried twice.
+    failed_batches = [
+        len(call.args[0]) for call in inner.send_batch.await_args_list
+        if "poison" in [msg.msg for msg in call.args[0]]
+    ]
+    assert failed_batches == [4, 4, 2, 2, 1, 1]
+    with open(tmp_path / DEAD_LETTER_FILE, "rb") as dead_letter:
+        assert dead_letter.read().endswith(b"MSG3poison")
+
+
+@pytest.mark.asyncio
+async def test_spooling_messager_does_not_retry_rejected_message(tmp_path):
+    inner = AsyncMock()
+    inner.is_unavailable = Mock(return_value=False)
+    inner.is_rejected = Mock(side_effect=lambda exp: isinstance(exp, ValueError))
+
+    delivered = await drain_with_poison_message(tmp_path, inner, max_attempts=100)
+
+    assert delivered == ["m1", "m2", "m4", "m5"]
+    # Split right away: the batch of four, its first half, and the poison message.
+    assert inner.send_batch.await_count == 6
+    assert os.path.getsize(tmp_path / DEAD_LETTER_FILE) > 0
@@ -0,0 +1,59 @@
+"""Tests for supervisor.py."""
+
+import multiprocessing
+
+import pytest
+
+from hl7_listener.supervisor import Supervisor
+
+
+def test_restart_delay_backs_off_for_workers_dying_at_startup():
+    supervisor = Supervisor(workers=1, target=None, stop_timeout_s=1)
+    delays = []
+    for started_at in range(0, 100, 10):
+        supervisor.started_at[0] = started_at
+        delays.append(supervisor.restart_delay(0, started_at + 1))
+    assert delays == [1, 2, 4, 8, 16, 32, 60, 60, 60, 60]
+
+    # A worker that ran for a while is restarted right away, and backs off anew.
+    supervisor.started_at[0] = 1000
+    assert supervisor.restart_delay(0, 2000) == 0
+    assert supervisor.restart_delay(0, 2001) == 0
+    supervisor.started_at[0] = 2001
+    assert supervisor.restart_delay(0, 2002) == 1
+
+
+def worker_snapshot(messages, connections):
+    return [
+        ("hl7_listener_messages", "Messages.", "counter", [
+            ("hl7_listener_messages_total", "", messages),
+        ]),
+        ("hl7_listener_connections", "Connections.", "gauge", [
+            ("hl7_listener_connections", "", connections),
+        ]),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_counters_of_exited_workers_are_kept():
+    supervisor = Supervisor(workers=2, target=None, stop_timeout_s=1)
+    receivers = []
+    for index, snapshot in enumerate([worker_snapshot(5, 1), worker_snapshot(3, 2)]):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        sender.send(snapshot)
+        supervisor.receive_snapshot(index, receiver)
+        receivers.append((receiver, sender))
+    assert "hl7_listener_messages_total 8" in supervisor.render_metrics()
+
+    # Worker 0 exits and its replacement starts counting from zero.
+    receiver, sender = receivers[0]
+    sender.close()
+    supervisor.receive_snapshot(0, receiver)
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    sender.send(worker_snapshot(1, 1))
+    supervisor.receive_snapshot(0, receiver)
+
+    rendered = supervisor.render_metrics()
+    assert "hl7_listener_messages_total 9" in rendered
+    # Gauges describe running workers only.
+    assert "hl7_listener_connections 3" in rendered
@@ -0,0 +1,70 @@
+"""Tests for tracing.py."""
+
+from unittest.mock import AsyncMock
+
+import pytest
+from nats.aio.client import Client as NATS_Client
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+# Imports the messagers in dependency order.
+import hl7_listener.messaging.settings  # noqa: F401
+from hl7_listener.header import scan_msh
+from hl7_listener.messaging.nats import NATSMessager
+from hl7_listener.tracing import MessageTracer
+
+ADT = b"MSH|^~\\&|EPIC|HOSP|RECV|RFAC|20240101||ADT^A01|CTRL1|P|2.5\rPID|1"
+
+
+@pytest.fixture
+def spans(mocker) -> InMemorySpanExporter:
+    exporter = InMemorySpanExporter()
+    provider = TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    mocker.patch("hl7_listener.tracing.tracer", provider.get_tracer("test"))
+    return exporter
+
+
+def test_head_sampling(spans):
+    header = scan_msh(ADT)
+    tracer = MessageTracer(0.25)
+    for _ in range(8):
+        with tracer.message_span(header, "10.0.0.1"):
+            pass
+    finished = spans.get_finished_spans()
+    assert len(finished) == 2
+    assert dict(finished[0].attributes) == {
+        "net.peer.name": "10.0.0.1",
+        "hl7.message_type": "ADT^A01",
+        "hl7.sending_application": "EPIC",
+        "hl7.sending_facility": "HOSP",
+    }
+
+    untraced = MessageTracer(0)
+    with untraced.message_span(header, "10.0.0.1"):
+        pass
+    assert len(spans.get_finished_spans()) == 2
+
+
+@pytest.mark.asyncio
+async def test_nats_propagates_trace_context(spans, mocker):
+    mocker.patch.object(NATS_Client, "connect")
+    messager = NATSMessager()
+    await messager.connect()
+    request = mocker.patch.object(messager.conn, "request", new=AsyncMock())
+    tracer = MessageTracer(0.5)
+    header = scan_msh(ADT)
+
+    for _ in range(2):
+        with tracer.message_span(header):
+            await messager.send_msg("test message")
+
+    untraced, traced = (call.kwargs.get("headers") or {} for call in request.await_args_list)
+    assert "traceparent" not in untraced
+    publish, message = spans.get_finished_spans()
+    assert (publish.name, message.name) == ("nats.publish", "hl7.message")
+    assert publish.parent.span_id == message.context.span_id
+    assert traced["traceparent"] == (
+        f"00-{publish.context.trace_id:032x}-{publish.context.span_id:016x}-01"
+    )